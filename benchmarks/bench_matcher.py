@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# Compare per-message topic filter matching, as done for the callbacks of
+# message_callback_add(), between a linear scan with topic_matches_sub() and
+# MQTTMatcher, with and without its result cache.
+#
+# Usage: python benchmarks/bench_matcher.py [topic]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from paho.mqtt.client import topic_matches_sub
+from paho.mqtt.matcher import MQTTMatcher
+
+
+def filters(count):
+    # The filter of interest plus count-1 others that share its first
+    # levels, so that the trie has to look at several branches.
+    result = ["/yee/light"]
+    for i in range(count - 1):
+        result.append("home/%d/+/bulb%d/#" % (i % 50, i))
+    return result
+
+
+def main():
+    if len(sys.argv) > 1:
+        topic = sys.argv[1]
+    else:
+        topic = "/yee/light"
+
+    print("%8s %12s %12s %12s" % ("filters", "linear", "trie", "trie+cache"))
+    for count in (10, 100, 10000):
+        subs = filters(count)
+        cached = MQTTMatcher()
+        uncached = MQTTMatcher(cache_size=0)
+        for sub in subs:
+            cached[sub] = sub
+            uncached[sub] = sub
+
+        number = max(1, 20000 // count)
+        results = []
+        for fn in (lambda: [sub for sub in subs if topic_matches_sub(sub, topic)],
+                   lambda: uncached.match(topic),
+                   lambda: cached.match(topic)):
+            results.append(min(timeit.repeat(fn, number=number, repeat=3)) / number)
+        print("%8d %9.2f us %9.2f us %9.2f us" % ((count,) + tuple(t * 1e6 for t in results)))
+
+
+if __name__ == '__main__':
+    main()
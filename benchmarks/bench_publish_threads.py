@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# Measure publish() throughput with several threads publishing through one
+# Client driven by loop_start(), for 1, 2, 4 and 8 threads at QoS 0 and 1.
+#
+# Needs a broker, by default on localhost:1883. To compare two versions of
+# the client, run the script once with each, pointing --paho at the
+# directory that contains the paho package:
+#
+#   git worktree add /tmp/before <commit>
+#   python benchmarks/bench_publish_threads.py --paho /tmp/before/lambda
+#   python benchmarks/bench_publish_threads.py
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+
+def run(paho, host, port, qos, threads, total, size):
+    client = paho.Client()
+    client.max_inflight_messages_set(0)
+    client.connect(host, port)
+    client.loop_start()
+    while not client.is_connected():
+        time.sleep(0.01)
+
+    count = total // threads
+    infos = [None] * threads
+    payload = b'x' * size
+
+    def worker(index):
+        topic = 'bench/%d' % index
+        published = []
+        for i in range(count):
+            published.append(client.publish(topic, payload, qos))
+        infos[index] = published
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    queued = time.time() - start
+    for published in infos:
+        for info in published:
+            info.wait_for_publish()
+    elapsed = time.time() - start
+
+    client.disconnect()
+    client.loop_stop()
+    return (count * threads / elapsed, count * threads / queued)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--total', type=int, default=40000, help='messages per run')
+    parser.add_argument('--size', type=int, default=64, help='payload bytes')
+    parser.add_argument('--paho', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'),
+                        help='directory containing the paho package to measure')
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.paho)
+    import paho.mqtt.client as paho
+
+    print("%5s %8s %14s %16s" % ("qos", "threads", "msg/s", "publish() /s"))
+    for qos in (0, 1):
+        for threads in (1, 2, 4, 8):
+            (rate, calls) = run(paho, args.host, args.port, qos, threads, args.total, args.size)
+            print("%5d %8d %14.0f %16.0f" % (qos, threads, rate, calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,33 @@ http://amzn.to/1LGWsLG
 
 from __future__ import print_function
 import ssl
+import time
 import paho.mqtt.client as paho
-import paho.mqtt.publish as publish
+
+MQTT_HOST = "A3D2G35UDO4LZ5.iot.eu-west-1.amazonaws.com"
+MQTT_PORT = 8883
+MQTT_TOPIC = "/yee/light"
+MQTT_KEEPALIVE = 60
+# Seconds allowed for the TCP connection and TLS handshake, and to wait for
+# CONNACK/PUBACK before treating the connection as dead.
+MQTT_TIMEOUT = 5
+# Seconds to wait for the PUBACK on a reused connection, which may have died
+# silently while the container was frozen, before retrying on a new one.
+MQTT_WARM_TIMEOUT = 1
+
+MQTT_TLS = {
+    "ca_certs": "cert/rootCA.pem",
+    "certfile": "cert/841dbd710a-certificate.pem.crt",
+    "keyfile": "cert/841dbd710a-private.pem.key",
+    "tls_version": ssl.PROTOCOL_SSLv23,
+    "ciphers": None
+}
+
+# The client lives at module level so that warm Lambda invocations reuse the
+# already established TLS/MQTT session instead of paying for a new one.
+_mqtt_client = None
+_mqtt_connected = False
+_mqtt_last_seen = 0
 
 
 def lambda_handler(event, context):
@@ -122,19 +147,112 @@ def handle_session_end_request():
         card_title, speech_output, None, should_end_session))
 
 
+def _on_mqtt_connect(client, userdata, flags, rc):
+    global _mqtt_connected
+    _mqtt_connected = (rc == 0)
+
+
+def _on_mqtt_disconnect(client, userdata, rc):
+    global _mqtt_connected
+    _mqtt_connected = False
+
+
+def _mqtt_wait(client, done, timeout=MQTT_TIMEOUT):
+    """ Drive the client network loop until done() is true. Returns False if
+    the connection fails or timeout expires first.
+    """
+    deadline = time.time() + timeout
+    while not done():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        if client.loop(timeout=remaining) != paho.MQTT_ERR_SUCCESS:
+            return False
+    return True
+
+
+def _mqtt_drop():
+    global _mqtt_client, _mqtt_connected
+    client = _mqtt_client
+    _mqtt_client = None
+    _mqtt_connected = False
+    if client is not None:
+        # disconnect() writes the DISCONNECT and closes the socket when it
+        # can, but not on a connection that is already dead.
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+        sock = client.socket()
+        if sock is not None:
+            try:
+                sock.close()
+            except Exception:
+                pass
+
+
+def get_mqtt_client():
+    """ Return a connected client, reusing the one from a previous invocation
+    when it is still alive.
+
+    The Lambda container is frozen between invocations, so nothing services
+    the keepalive while we are idle. A connection that has been quiet for
+    longer than the keepalive has most likely been closed by the broker and is
+    replaced straight away rather than discovered dead by a publish timeout.
+    Otherwise whatever arrived while frozen is read first, so that a
+    connection the broker has closed is noticed here.
+    """
+    global _mqtt_client, _mqtt_last_seen
+
+    if _mqtt_client is not None:
+        if (_mqtt_connected and time.time() - _mqtt_last_seen < MQTT_KEEPALIVE
+                and _mqtt_client.loop(timeout=0) == paho.MQTT_ERR_SUCCESS
+                and _mqtt_connected):
+            return _mqtt_client
+        _mqtt_drop()
+
+    client = paho.Client(protocol=paho.MQTTv31)
+    client.on_connect = _on_mqtt_connect
+    client.on_disconnect = _on_mqtt_disconnect
+    client.tls_set(MQTT_TLS["ca_certs"], MQTT_TLS["certfile"],
+                   MQTT_TLS["keyfile"], tls_version=MQTT_TLS["tls_version"],
+                   ciphers=MQTT_TLS["ciphers"])
+    client.connect_timeout_set(MQTT_TIMEOUT)
+    _mqtt_client = client
+    client.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
+    if not _mqtt_wait(client, lambda: _mqtt_connected):
+        _mqtt_drop()
+        raise IOError("Timed out connecting to " + MQTT_HOST)
+
+    _mqtt_last_seen = time.time()
+    return client
+
+
 def publish_to_topic(msg):
+    """ Publish msg with QoS 1, retrying once on a new connection if no
+    PUBACK arrives.
+
+    A warm connection can have died without the socket noticing, so its
+    PUBACK is only waited for MQTT_WARM_TIMEOUT seconds, the probe that
+    finds out. If it was the PUBACK rather than the PUBLISH that was lost,
+    the retry delivers the command twice. That is harmless here because
+    every command sets the light to an absolute state.
+    """
+    global _mqtt_last_seen
     try:
-        tls_set = {
-            "ca_certs": "cert/rootCA.pem",
-            "certfile": "cert/841dbd710a-certificate.pem.crt",
-            "keyfile": "cert/841dbd710a-private.pem.key",
-            "tls_version": ssl.PROTOCOL_SSLv23,
-            "ciphers": None
-        }
-
-        publish.single("/yee/light", payload=msg, qos=1,
-                       hostname="A3D2G35UDO4LZ5.iot.eu-west-1.amazonaws.com",
-                       port=8883, tls=tls_set, protocol=paho.MQTTv31, )
+        for attempt in range(2):
+            previous = _mqtt_client
+            client = get_mqtt_client()
+            if client is previous:
+                timeout = MQTT_WARM_TIMEOUT
+            else:
+                timeout = MQTT_TIMEOUT
+            info = client.publish(MQTT_TOPIC, payload=msg, qos=1)
+            if info.rc == paho.MQTT_ERR_SUCCESS and _mqtt_wait(client, info.is_published, timeout):
+                _mqtt_last_seen = time.time()
+                return
+            _mqtt_drop()
+        print("Failed to publish to " + MQTT_TOPIC)
     except Exception as e:
         print(e)
 
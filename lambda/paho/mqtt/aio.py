@@ -0,0 +1,336 @@
+"""
+This module provides AsyncClient, which runs an MQTT client on an asyncio
+event loop. The client socket is registered with the loop's add_reader() and
+add_writer(), so no network thread or select() call of its own is needed and
+MQTT traffic can share a loop with other asyncio I/O. Requires Python 3.6 or
+later.
+"""
+
+import asyncio
+import collections
+import socket
+
+from . import MQTTException
+from .client import (
+    Client, MQTTMessage, MQTTv311, CONNACK_ACCEPTED, MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN,
+    MQTT_ERR_CONN_LOST, connack_string, error_string, time_func)
+
+
+class AsyncClient(object):
+    """asyncio interface to paho.mqtt.client.Client.
+
+    The underlying Client is available as the client attribute and can be
+    configured as usual (tls_set(), username_pw_set(), will_set(), ...)
+    before connect() is awaited. Its on_connect, on_disconnect, on_message,
+    on_publish, on_subscribe and on_unsubscribe callbacks are used by
+    AsyncClient and must not be replaced.
+
+    client = AsyncClient()
+    await client.connect("localhost")
+    await client.subscribe("/yee/#", 1)
+    await client.publish("/yee/light", payload, qos=1)
+    async for message in client.messages():
+        ...
+    """
+    def __init__(self, client_id="", clean_session=True, userdata=None,
+                 protocol=MQTTv311, transport="tcp", max_packets=64):
+        """The arguments are as for paho.mqtt.client.Client. max_packets is
+        the number of packets handled per readiness event before yielding to
+        other tasks on the loop."""
+        self.client = Client(client_id, clean_session, userdata, protocol, transport)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.on_publish = self._on_publish
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_unsubscribe = self._on_unsubscribe
+
+        self._max_packets = max_packets
+        self._loop = None
+        self._fd = None
+        self._writing = False
+        self._misc_handle = None
+        self._read_handle = None
+        self._connect_future = None
+        self._disconnect_future = None
+        # (fd, write) of the sockets watched while connecting, and the timer
+        # for the connection's next deadline.
+        self._connect_fds = []
+        self._connect_handle = None
+        # mid -> future for publish, subscribe and unsubscribe requests.
+        self._pending = {}
+        # Received messages for messages(), followed by None after a
+        # requested disconnect or an MQTTException after a lost connection.
+        self._messages = collections.deque()
+        self._messages_waiter = None
+
+    async def connect(self, host, port=1883, keepalive=60, bind_address=""):
+        """Connect to a remote broker and wait for its CONNACK.
+
+        The arguments are as for Client.connect(). Raises MQTTException if the
+        broker refuses the connection and socket.error if it can't be reached.
+        """
+        self.client.connect_async(host, port, keepalive, bind_address)
+        await self._connect()
+
+    async def reconnect(self):
+        """Reconnect to the broker given to connect(). Unacknowledged QoS>0
+        messages are resent once the broker accepts the connection."""
+        self._unregister()
+        await self._connect()
+
+    async def disconnect(self):
+        """Disconnect cleanly and wait for the connection to close."""
+        if self._fd is None:
+            return
+        self._disconnect_future = self._loop.create_future()
+        self.client.disconnect()
+        self._update_writer()
+        await self._disconnect_future
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        """Publish a message and wait until it has been delivered: written to
+        the network for QoS 0, PUBACK received for QoS 1 and PUBCOMP received
+        for QoS 2. Returns the mid.
+
+        A QoS>0 message published while disconnected is queued and the call
+        waits until reconnect() has delivered it. Otherwise MQTTException is
+        raised if the client is not connected, or if the connection is lost
+        before the flow completes; QoS>0 messages then stay queued and are
+        resent by reconnect()."""
+        info = self.client.publish(topic, payload, qos, retain)
+        if info.rc != MQTT_ERR_SUCCESS and not (info.rc == MQTT_ERR_NO_CONN and qos > 0):
+            raise MQTTException(error_string(info.rc))
+        if not info.is_published():
+            future = self._loop.create_future()
+            self._pending[info.mid] = future
+            self._update_writer()
+            await future
+        return info.mid
+
+    async def subscribe(self, topic, qos=0):
+        """Subscribe to one or more topics, taking the same arguments as
+        Client.subscribe(), and wait for the SUBACK. Returns the tuple of
+        granted QoS levels."""
+        (rc, mid) = self.client.subscribe(topic, qos)
+        if rc != MQTT_ERR_SUCCESS:
+            raise MQTTException(error_string(rc))
+        future = self._loop.create_future()
+        self._pending[mid] = future
+        self._update_writer()
+        return await future
+
+    async def unsubscribe(self, topic):
+        """Unsubscribe from one or more topics and wait for the UNSUBACK."""
+        (rc, mid) = self.client.unsubscribe(topic)
+        if rc != MQTT_ERR_SUCCESS:
+            raise MQTTException(error_string(rc))
+        future = self._loop.create_future()
+        self._pending[mid] = future
+        self._update_writer()
+        await future
+
+    async def messages(self):
+        """Asynchronous iterator over received messages. It finishes after
+        disconnect() has been called, and raises MQTTException if the
+        connection is lost. It may be started before connect().
+
+        async for message in client.messages():
+            print(message.topic, bytes(message.payload))
+        """
+        while True:
+            if not self._messages:
+                self._messages_waiter = asyncio.get_event_loop().create_future()
+                try:
+                    await self._messages_waiter
+                finally:
+                    self._messages_waiter = None
+                continue
+            message = self._messages.popleft()
+            if message is None:
+                return
+            if isinstance(message, Exception):
+                raise message
+            yield message
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    async def _connect(self):
+        # Connect with the client's non-blocking connector, whose sockets are
+        # watched by the event loop. Only name resolution, and a WebSocket
+        # handshake, still block.
+        self._loop = asyncio.get_event_loop()
+        # The end of an earlier connection's messages() no longer applies.
+        self._messages = collections.deque(m for m in self._messages if isinstance(m, MQTTMessage))
+        self._connect_future = self._loop.create_future()
+
+        self.client.reconnect_start()
+        self._connect_poll()
+        try:
+            rc = await self._connect_future
+        except asyncio.CancelledError:
+            self._connect_unwatch()
+            self.client.reconnect_cancel()
+            raise
+        if rc != CONNACK_ACCEPTED:
+            raise MQTTException(connack_string(rc))
+
+    def _connect_poll(self):
+        # Failed attempts are closed by reconnect_poll(), so stop watching
+        # them first.
+        self._connect_unwatch()
+        try:
+            connected = self.client.reconnect_poll()
+            if connected:
+                self._register()
+        except (socket.error, ValueError, MQTTException) as err:
+            if not self._connect_future.done():
+                self._connect_future.set_exception(err)
+            return
+        if connected:
+            return
+
+        for (sock, write) in self.client.reconnect_sockets():
+            fd = sock.fileno()
+            if write:
+                self._loop.add_writer(fd, self._connect_poll)
+            else:
+                self._loop.add_reader(fd, self._connect_poll)
+            self._connect_fds.append((fd, write))
+        deadline = self.client.reconnect_deadline()
+        if deadline is not None:
+            self._connect_handle = self._loop.call_later(
+                max(0.0, deadline - time_func()), self._connect_poll)
+
+    def _connect_unwatch(self):
+        for (fd, write) in self._connect_fds:
+            if write:
+                self._loop.remove_writer(fd)
+            else:
+                self._loop.remove_reader(fd)
+        self._connect_fds = []
+        if self._connect_handle is not None:
+            self._connect_handle.cancel()
+            self._connect_handle = None
+
+    def _messages_put(self, item):
+        self._messages.append(item)
+        if self._messages_waiter is not None and not self._messages_waiter.done():
+            self._messages_waiter.set_result(None)
+
+    def _register(self):
+        sock = self.client.socket()
+        if sock is None:
+            raise MQTTException(error_string(MQTT_ERR_NO_CONN))
+        self._fd = sock.fileno()
+        self._loop.add_reader(self._fd, self._do_read)
+        self._update_writer()
+        self._schedule_misc()
+
+    def _unregister(self):
+        if self._fd is None:
+            return
+        self._loop.remove_reader(self._fd)
+        if self._writing:
+            self._loop.remove_writer(self._fd)
+            self._writing = False
+        if self._misc_handle is not None:
+            self._misc_handle.cancel()
+            self._misc_handle = None
+        if self._read_handle is not None:
+            self._read_handle.cancel()
+            self._read_handle = None
+        self._fd = None
+
+    def _update_writer(self):
+        # Only watch for writability while there is something to write.
+        if self._fd is None:
+            return
+        if self.client.socket() is None:
+            self._unregister()
+            if self.client.is_reconnecting():
+                # The client is connecting again by itself, to fall back to
+                # MQTT v3.1.
+                self._connect_poll()
+        elif self.client.want_write():
+            if not self._writing:
+                self._loop.add_writer(self._fd, self._do_write)
+                self._writing = True
+        elif self._writing:
+            self._loop.remove_writer(self._fd)
+            self._writing = False
+
+    def _do_read(self):
+        self._read_handle = None
+        self.client.loop_read(self._max_packets)
+        if self.client.read_pending() and self._fd is not None:
+            # More complete packets are buffered; handle them after giving
+            # other tasks a turn.
+            self._read_handle = self._loop.call_soon(self._do_read)
+        self._update_writer()
+
+    def _do_write(self):
+        self.client.loop_write(self._max_packets)
+        self._update_writer()
+
+    def _schedule_misc(self):
+        deadline = self.client.misc_deadline()
+        if deadline is None:
+            delay = 1.0
+        else:
+            delay = max(0.0, deadline - time_func())
+        self._misc_handle = self._loop.call_later(delay, self._do_misc)
+
+    def _do_misc(self):
+        self._misc_handle = None
+        self.client.loop_misc()
+        self._update_writer()
+        if self._fd is not None:
+            self._schedule_misc()
+
+    def _resolve(self, mid, result):
+        future = self._pending.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if self._connect_future is not None and not self._connect_future.done():
+            self._connect_future.set_result(rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._unregister()
+        if rc == MQTT_ERR_SUCCESS:
+            error = error_string(MQTT_ERR_NO_CONN)
+        else:
+            error = error_string(MQTT_ERR_CONN_LOST)
+
+        pending = self._pending
+        self._pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(MQTTException(error))
+        if self._connect_future is not None and not self._connect_future.done():
+            self._connect_future.set_exception(MQTTException(error))
+        if self._disconnect_future is not None and not self._disconnect_future.done():
+            self._disconnect_future.set_result(rc)
+
+        # A requested disconnect ends messages(), a lost connection makes it
+        # raise.
+        if rc == MQTT_ERR_SUCCESS:
+            self._messages_put(None)
+        else:
+            self._messages_put(MQTTException(error))
+
+    def _on_message(self, client, userdata, message):
+        self._messages_put(message)
+
+    def _on_publish(self, client, userdata, mid):
+        self._resolve(mid, mid)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        self._resolve(mid, granted_qos)
+
+    def _on_unsubscribe(self, client, userdata, mid):
+        self._resolve(mid, None)
@@ -26,8 +26,14 @@ try:
     import ssl
     cert_reqs = ssl.CERT_REQUIRED
     tls_version = ssl.PROTOCOL_TLSv1
+    # SSLContext with hostname checking, Python 2.7.9 and 3.4 or later.
+    HAVE_SSL_CONTEXT = hasattr(ssl, 'create_default_context')
+    # Session resumption, Python 3.6 or later.
+    HAVE_SSL_SESSION = hasattr(ssl, 'SSLSession')
 except:
     HAVE_SSL = False
+    HAVE_SSL_CONTEXT = False
+    HAVE_SSL_SESSION = False
     cert_reqs = None
     tls_version = None
 import struct
@@ -36,8 +42,19 @@ import threading
 
 import time
 import uuid
+import zlib
 import base64
+import binascii
+import bisect
+import collections
 import hashlib
+import heapq
+import logging
+import os
+import weakref
+
+from .matcher import MQTTMatcher
+
 try:
     # Use monotionic clock if available
     time_func = time.monotonic
@@ -50,6 +67,13 @@ try:
 except ImportError:
     HAVE_DNS = False
 
+HAVE_FUTURES = True
+try:
+    # Python 2 needs the futures backport.
+    import concurrent.futures
+except ImportError:
+    HAVE_FUTURES = False
+
 if platform.system() == 'Windows':
     EAGAIN = errno.WSAEWOULDBLOCK
 else:
@@ -86,12 +110,24 @@ PINGREQ = 0xC0
 PINGRESP = 0xD0
 DISCONNECT = 0xE0
 
+PACKET_NAMES = (
+    None, "CONNECT", "CONNACK", "PUBLISH", "PUBACK", "PUBREC", "PUBREL",
+    "PUBCOMP", "SUBSCRIBE", "SUBACK", "UNSUBSCRIBE", "UNSUBACK", "PINGREQ",
+    "PINGRESP", "DISCONNECT", None)
+
 # Log levels
 MQTT_LOG_INFO = 0x01
 MQTT_LOG_NOTICE = 0x02
 MQTT_LOG_WARNING = 0x04
 MQTT_LOG_ERR = 0x08
 MQTT_LOG_DEBUG = 0x10
+LOGGING_LEVEL = {
+    MQTT_LOG_DEBUG: logging.DEBUG,
+    MQTT_LOG_INFO: logging.INFO,
+    MQTT_LOG_NOTICE: logging.INFO,  # This has no direct equivalent level
+    MQTT_LOG_WARNING: logging.WARNING,
+    MQTT_LOG_ERR: logging.ERROR,
+}
 
 # CONNACK codes
 CONNACK_ACCEPTED = 0
@@ -137,6 +173,7 @@ MQTT_ERR_ACL_DENIED = 12
 MQTT_ERR_UNKNOWN = 13
 MQTT_ERR_ERRNO = 14
 MQTT_ERR_QUEUE_SIZE = 15
+MQTT_ERR_BACKPRESSURE = 16
 
 if sys.version_info[0] < 3:
     sockpair_data = "0"
@@ -175,6 +212,10 @@ def error_string(mqtt_errno):
         return "Unknown error."
     elif mqtt_errno == MQTT_ERR_ERRNO:
         return "Error defined by errno."
+    elif mqtt_errno == MQTT_ERR_QUEUE_SIZE:
+        return "Message queue full."
+    elif mqtt_errno == MQTT_ERR_BACKPRESSURE:
+        return "Outgoing packet queue is above its high watermark."
     else:
         return "Unknown error."
 
@@ -205,61 +246,28 @@ def topic_matches_sub(sub, topic):
     foo/bar would match the subscription foo/# or +/bar
     non/matching would not match the subscription non/+/+
     """
-    result = True
-    multilevel_wildcard = False
-
-    slen = len(sub)
-    tlen = len(topic)
-
-    if slen > 0 and tlen > 0:
-        if (sub[0] == '$' and topic[0] != '$') or (topic[0] == '$' and sub[0] != '$'):
+    sub_levels = sub.split('/')
+    topic_levels = topic.split('/')
+
+    # Wildcards at the first level don't match topics beginning with $.
+    if topic.startswith('$') and sub_levels[0] in ('+', '#'):
+        return False
+
+    for (i, level) in enumerate(sub_levels):
+        if level == '#':
+            # Only valid as the last level; "foo/#" also matches "foo".
+            return i == len(sub_levels) - 1
+        if i >= len(topic_levels):
             return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(sub_levels) == len(topic_levels)
 
-    spos = 0
-    tpos = 0
-
-    while spos < slen and tpos < tlen:
-        if sub[spos] == topic[tpos]:
-            if tpos == tlen-1:
-                # Check for e.g. foo matching foo/#
-                if spos == slen-3 and sub[spos+1] == '/' and sub[spos+2] == '#':
-                    result = True
-                    multilevel_wildcard = True
-                    break
-
-            spos += 1
-            tpos += 1
-
-            if tpos == tlen and spos == slen-1 and sub[spos] == '+':
-                spos += 1
-                result = True
-                break
-        else:
-            if sub[spos] == '+':
-                spos += 1
-                while tpos < tlen and topic[tpos] != '/':
-                    tpos += 1
-                if tpos == tlen and spos == slen:
-                    result = True
-                    break
-
-            elif sub[spos] == '#':
-                multilevel_wildcard = True
-                if spos+1 != slen:
-                    result = False
-                    break
-                else:
-                    result = True
-                    break
-
-            else:
-                result = False
-                break
-
-    if not multilevel_wildcard and (tpos < tlen or spos < slen):
-        result = False
 
-    return result
+def _packet_counts(counts):
+    # Convert a list of packet counts indexed by command >> 4 to a dict
+    # keyed by packet name.
+    return dict((PACKET_NAMES[i], n) for (i, n) in enumerate(counts) if n)
 
 
 def _socketpair_compat():
@@ -283,6 +291,484 @@ def _socketpair_compat():
     return (sock1, sock2)
 
 
+# SSLContexts built by tls_set(), keyed by its arguments and the
+# modification times of the files they name, and the TLS sessions of the
+# latest connections made with them, keyed by (context, host, port). They
+# are shared by all clients so that a new client, like the one created by
+# each publish.single() call, neither reloads the certificates nor needs a
+# full handshake.
+_tls_cache_mutex = threading.Lock()
+_tls_contexts = {}
+_tls_sessions = collections.OrderedDict()
+_TLS_SESSIONS_MAX = 64
+
+
+def _tls_context(ca_certs, certfile, keyfile, cert_reqs, tls_version, ciphers, insecure):
+    key = [ca_certs, certfile, keyfile, cert_reqs, tls_version, ciphers, bool(insecure)]
+    for path in (ca_certs, certfile, keyfile):
+        if path is not None:
+            key.append(os.stat(path).st_mtime)
+    key = tuple(key)
+
+    _tls_cache_mutex.acquire()
+    context = _tls_contexts.get(key)
+    _tls_cache_mutex.release()
+    if context is not None:
+        return context
+
+    if tls_version is None:
+        tls_version = getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23)
+    context = ssl.SSLContext(tls_version)
+    # Some protocols start with hostname checking on, which has to be off
+    # to change verify_mode.
+    context.check_hostname = False
+    context.verify_mode = cert_reqs
+    context.load_verify_locations(ca_certs)
+    if certfile is not None:
+        context.load_cert_chain(certfile, keyfile)
+    if ciphers is not None:
+        context.set_ciphers(ciphers)
+    context.check_hostname = cert_reqs != ssl.CERT_NONE and not insecure
+
+    _tls_cache_mutex.acquire()
+    context = _tls_contexts.setdefault(key, context)
+    _tls_cache_mutex.release()
+    return context
+
+
+def _tls_session_get(context, host, port):
+    _tls_cache_mutex.acquire()
+    session = _tls_sessions.get((context, host, port))
+    _tls_cache_mutex.release()
+    return session
+
+
+def _tls_session_put(context, host, port, session):
+    key = (context, host, port)
+    _tls_cache_mutex.acquire()
+    _tls_sessions.pop(key, None)
+    _tls_sessions[key] = session
+    if len(_tls_sessions) > _TLS_SESSIONS_MAX:
+        _tls_sessions.popitem(last=False)
+    _tls_cache_mutex.release()
+
+
+class _PacketReader(object):
+    """Incremental decoder that splits the incoming byte stream into MQTT
+    packets.
+
+    Network data is read into a reusable buffer in large chunks, either
+    directly from a socket with read_from() or by passing it to feed().
+    next_packet() then returns each complete packet held in the buffer
+    without any further socket calls. A packet that does not fit in the
+    buffer causes it to grow; it returns to its default size once drained.
+    """
+    def __init__(self, bufsize=65536):
+        self._bufsize = bufsize
+        self._buf = bytearray(bufsize)
+        self._start = 0
+        self._end = 0
+
+    def reset(self):
+        """Discard any buffered data."""
+        self._start = 0
+        self._end = 0
+
+    def pending(self):
+        """Return the number of buffered bytes not yet returned as packets."""
+        return self._end - self._start
+
+    def has_packet(self):
+        """Return True if a complete packet is buffered."""
+        try:
+            header = self._parse_header()
+        except ValueError:
+            # Let next_packet() report the error.
+            return True
+        return header is not None and header[1] + header[2] <= self._end - self._start
+
+    def _reserve(self, size):
+        # Make room for at least size bytes after the buffered data.
+        if self._end + size <= len(self._buf):
+            return
+        pending = self._end - self._start
+        if pending + size <= len(self._buf):
+            self._buf[0:pending] = self._buf[self._start:self._end]
+        else:
+            buf = bytearray(pending + size)
+            buf[0:pending] = self._buf[self._start:self._end]
+            self._buf = buf
+        self._start = 0
+        self._end = pending
+
+    def _missing(self):
+        # Bytes still needed to complete the packet at the head of the buffer,
+        # if its fixed header has already arrived.
+        header = self._parse_header()
+        if header is None:
+            return 0
+        return header[1] + header[2] - (self._end - self._start)
+
+    def read_from(self, sock):
+        """Read as much data as fits in the buffer from sock. Returns the
+        number of bytes read, 0 meaning the connection was closed. Socket
+        errors are propagated to the caller."""
+        self._reserve(max(self._missing(), 4096))
+        if hasattr(sock, 'recv_into'):
+            view = memoryview(self._buf)[self._end:]
+            length = sock.recv_into(view)
+            del view
+        else:
+            data = sock.recv(len(self._buf) - self._end)
+            length = len(data)
+            self._buf[self._end:self._end+length] = data
+        self._end += length
+        return length
+
+    def feed(self, data):
+        """Append data that has been read by the caller."""
+        self._reserve(len(data))
+        self._buf[self._end:self._end+len(data)] = data
+        self._end += len(data)
+
+    def _parse_header(self):
+        # Returns (command, remaining_length, header_length) or None if the
+        # fixed header is incomplete.
+        # Algorithm for decoding taken from pseudo code at
+        # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
+        buf = self._buf
+        pos = self._start + 1
+        remaining_length = 0
+        multiplier = 1
+        while True:
+            if pos >= self._end:
+                return None
+            byte = buf[pos]
+            pos += 1
+            remaining_length += (byte & 127) * multiplier
+            if (byte & 128) == 0:
+                return (buf[self._start], remaining_length, pos - self._start)
+            # Max 4 bytes length for remaining length as defined by protocol.
+            # Anything more likely means a broken/malicious client.
+            if pos - self._start > 4:
+                raise ValueError('Invalid remaining length.')
+            multiplier *= 128
+
+    def next_packet(self):
+        """Return the next complete packet as a tuple of (command,
+        remaining_length, packet) where packet holds the variable header and
+        payload, or None if more data is needed. Raises ValueError on a
+        malformed remaining length."""
+        header = self._parse_header()
+        if header is None:
+            return None
+        (command, remaining_length, header_length) = header
+        start = self._start + header_length
+        end = start + remaining_length
+        if end > self._end:
+            return None
+
+        packet = memoryview(self._buf)[start:end].tobytes()
+        if end == self._end:
+            self._start = 0
+            self._end = 0
+            if len(self._buf) > self._bufsize:
+                self._buf = bytearray(self._bufsize)
+        else:
+            self._start = end
+        return (command, remaining_length, packet)
+
+
+class _Scheduler(object):
+    """Deadline heap for the client's timers.
+
+    Each key has at most one live deadline. Scheduling a key that is already
+    due earlier is a no-op, and superseded heap entries are discarded lazily
+    when they reach the top, so both schedule() and pop() are O(log n) and
+    an idle client only ever looks at the earliest deadline.
+    """
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._seq = 0
+        self._mutex = threading.Lock()
+
+    def schedule(self, key, deadline):
+        """Arm key to expire at deadline, unless it already expires earlier."""
+        with self._mutex:
+            current = self._deadlines.get(key)
+            if current is not None and current <= deadline:
+                return
+            self._deadlines[key] = deadline
+            self._seq = self._seq + 1
+            heapq.heappush(self._heap, (deadline, self._seq, key))
+
+    def cancel(self, key):
+        with self._mutex:
+            self._deadlines.pop(key, None)
+
+    def _discard_stale(self):
+        heap = self._heap
+        while len(heap) > 0 and self._deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_deadline(self):
+        """Return the earliest deadline, or None if nothing is scheduled."""
+        with self._mutex:
+            self._discard_stale()
+            if len(self._heap) == 0:
+                return None
+            return self._heap[0][0]
+
+    def pop(self, now):
+        """Remove and return a key whose deadline is <= now, or None."""
+        with self._mutex:
+            self._discard_stale()
+            if len(self._heap) == 0 or self._heap[0][0] > now:
+                return None
+            (deadline, seq, key) = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            return key
+
+
+class _Connector(object):
+    """Non-blocking TCP connection to whichever of a host's addresses
+    answers first.
+
+    Connection attempts are started in turn, alternating between address
+    families, with the next one started attempt_delay seconds after the
+    previous one or as soon as it fails, while the earlier ones continue.
+    The first to connect wins and the rest are closed. If wrap is given, it
+    is called with the connected socket and must return an SSLSocket that
+    has not done its handshake yet; the handshake is then also completed
+    without blocking. Everything is given up after timeout seconds (None
+    for no limit).
+    """
+    _IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, EAGAIN)
+
+    def __init__(self, host, port, bind_address="", timeout=None, attempt_delay=0.25, wrap=None):
+        # Name resolution still blocks; it is normally answered from a
+        # cache or the local resolver.
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        # Interleave the families, keeping the resolver's order within each.
+        families = collections.OrderedDict()
+        for address in addresses:
+            families.setdefault(address[0], collections.deque()).append(address)
+        self._addresses = collections.deque()
+        while families:
+            for family in list(families.keys()):
+                self._addresses.append(families[family].popleft())
+                if not families[family]:
+                    del families[family]
+
+        self._bind_address = bind_address
+        self._attempt_delay = attempt_delay
+        self._attempts = []
+        self._wrap = wrap
+        # SSLSocket whose handshake is in progress, and whether it is
+        # waiting to write rather than to read.
+        self._handshake = None
+        self._handshake_write = False
+        self._error = None
+        now = time_func()
+        self._next_attempt = now
+        if timeout:
+            self._deadline = now + timeout
+        else:
+            self._deadline = None
+
+    def next_deadline(self):
+        """Return the time by which poll() should be called again, or None."""
+        if self._addresses and self._handshake is None:
+            if self._deadline is None:
+                return self._next_attempt
+            return min(self._next_attempt, self._deadline)
+        return self._deadline
+
+    def remaining(self):
+        """Return the seconds left before the timeout, or None."""
+        if self._deadline is None:
+            return None
+        return max(self._deadline - time_func(), 0.0)
+
+    def sockets(self):
+        """Return a list of (socket, write) pairs for the sockets that poll()
+        is waiting on, where write is True if it is waiting for the socket to
+        become writable and False if readable."""
+        if self._handshake is not None:
+            return [(self._handshake, self._handshake_write)]
+        return [(sock, True) for sock in self._attempts]
+
+    def poll(self, timeout=0.0):
+        """Wait up to timeout seconds (None to wait for the next deadline)
+        for an attempt, or the TLS handshake, to finish. Returns the
+        connected socket, or None if the connection is still being made.
+        Raises socket.error if every address has failed or the handshake
+        fails, or socket.timeout once the timeout has passed."""
+        if self._handshake is None:
+            sock = self._start_attempts()
+            if sock is not None:
+                sock = self._connected(sock)
+                if sock is not None:
+                    return sock
+
+        deadline = self.next_deadline()
+        if deadline is not None:
+            wait = max(deadline - time_func(), 0.0)
+            if timeout is None or wait < timeout:
+                timeout = wait
+        if self._handshake is not None:
+            if self._handshake_write:
+                ready = select.select([], [self._handshake], [], timeout)[1]
+            else:
+                ready = select.select([self._handshake], [], [], timeout)[0]
+            if ready:
+                sock = self._handshake_step()
+                if sock is not None:
+                    return sock
+        elif self._attempts:
+            # Windows reports a failed connect as an exceptional condition.
+            (rlist, wlist, xlist) = select.select([], self._attempts, self._attempts, timeout)
+            for sock in wlist + xlist:
+                if sock not in self._attempts:
+                    continue
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    self._attempts.remove(sock)
+                    self.close()
+                    sock = self._connected(sock)
+                    if sock is not None:
+                        return sock
+                    break
+                self._fail(sock, socket.error(err, os.strerror(err)))
+
+        if self._handshake is None:
+            sock = self._start_attempts()
+            if sock is not None:
+                sock = self._connected(sock)
+                if sock is not None:
+                    return sock
+        if self._deadline is not None and time_func() >= self._deadline:
+            self.close()
+            raise socket.timeout('Connection timed out.')
+        return None
+
+    def close(self):
+        """Abandon the attempts, or the handshake, in progress."""
+        for sock in self._attempts:
+            sock.close()
+        self._attempts = []
+        self._addresses.clear()
+        if self._handshake is not None:
+            self._handshake.close()
+            self._handshake = None
+
+    def _connected(self, sock):
+        # The TCP connection has been made: return it, or start the TLS
+        # handshake and return the SSLSocket if it completes straight away.
+        if self._wrap is None:
+            return sock
+        try:
+            self._handshake = self._wrap(sock)
+        except:
+            sock.close()
+            raise
+        self._handshake_write = True
+        return self._handshake_step()
+
+    def _handshake_step(self):
+        try:
+            self._handshake.do_handshake()
+        except ssl.SSLWantReadError:
+            self._handshake_write = False
+            return None
+        except ssl.SSLWantWriteError:
+            self._handshake_write = True
+            return None
+        except:
+            self.close()
+            raise
+        sock = self._handshake
+        self._handshake = None
+        return sock
+
+    def _fail(self, sock, err):
+        self._attempts.remove(sock)
+        sock.close()
+        self._error = err
+        # Try the next address right away.
+        self._next_attempt = time_func()
+
+    def _start_attempts(self):
+        # Start the next attempt if it is due, or if nothing is in progress.
+        # Returns a socket that connected immediately.
+        while self._addresses and (not self._attempts or time_func() >= self._next_attempt):
+            (family, socktype, proto, canonname, sockaddr) = self._addresses.popleft()
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.setblocking(0)
+                if self._bind_address:
+                    sock.bind((self._bind_address, 0))
+                err = sock.connect_ex(sockaddr)
+            except socket.error as e:
+                sock.close()
+                self._error = e
+                continue
+            if err == 0:
+                self.close()
+                return sock
+            elif err in self._IN_PROGRESS:
+                self._attempts.append(sock)
+                self._next_attempt = time_func() + self._attempt_delay
+            else:
+                sock.close()
+                self._error = socket.error(err, os.strerror(err))
+
+        if not self._attempts and not self._addresses:
+            if self._error is None:
+                self._error = socket.error(errno.EHOSTUNREACH, 'No addresses to connect to.')
+            raise self._error
+        return None
+
+
+class _Histogram(object):
+    """Distribution of durations in seconds, counted in buckets whose upper
+    bounds grow roughly exponentially from 1 ms to 10 s."""
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+
+    def add(self, value):
+        self._counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self._count += 1
+        self._sum += value
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def snapshot(self):
+        """Return the distribution as a dict with count, sum, min, max, mean
+        and buckets, a list of (upper bound, count) pairs where the last
+        bound is None."""
+        if self._count:
+            mean = self._sum / self._count
+        else:
+            mean = None
+        return dict(
+            count = self._count,
+            sum = self._sum,
+            min = self._min,
+            max = self._max,
+            mean = mean,
+            buckets = list(zip(self.BOUNDS + (None,), self._counts)))
+
+
 class MQTTMessageInfo:
     """This is a class returned from Client.publish() and can be used to find
     out the mid of the message that was published, and to determine whether the
@@ -348,7 +834,10 @@ class MQTTMessage:
     Members:
 
     topic : String. topic that the message was published on.
-    payload : String/bytes the message payload.
+    payload : the message payload. For received messages this is a memoryview
+        of the packet it arrived in, so no copy is made; use bytes(payload)
+        (payload.tobytes() on Python 2) to get a copy, or call
+        Client.payload_bytes_set() to receive bytes instead.
     qos : Integer. The message Quality of Service 0, 1 or 2.
     retain : Boolean. If true, the message is a retained message and not fresh.
     mid : Integer. The message id.
@@ -364,6 +853,418 @@ class MQTTMessage:
         self.retain = False
         self.info = MQTTMessageInfo(mid)
 
+    def __getstate__(self):
+        # Pickled to be passed to another process: info holds a lock, and a
+        # memoryview payload can't be pickled.
+        state = self.__dict__.copy()
+        del state['info']
+        if isinstance(self.payload, memoryview):
+            state['payload'] = self.payload.tobytes()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.info = MQTTMessageInfo(self.mid)
+
+
+def _append_remaining_length(packet, remaining_length):
+    # Append the variable length encoding of remaining_length to packet.
+    while True:
+        byte = remaining_length % 128
+        remaining_length = remaining_length // 128
+        # If there are more digits to encode, set the top bit of this digit
+        if remaining_length > 0:
+            packet.append(byte | 0x80)
+        else:
+            packet.append(byte)
+            return packet
+
+
+def _payload_bytes(payload):
+    # Return a payload accepted by publish() in the form it is sent. Buffers
+    # are returned as they are rather than copied.
+    if isinstance(payload, (bytearray, bytes, memoryview)):
+        return payload
+    elif isinstance(payload, str):
+        return payload.encode('utf-8')
+    elif isinstance(payload, unicode):
+        return payload.encode('utf-8')
+    else:
+        raise TypeError('payload must be a string, unicode, bytes, bytearray or memoryview.')
+
+
+class PreparedTopic(object):
+    """A topic to publish to repeatedly, with its QoS and retain flag.
+
+    The topic is validated and its part of the PUBLISH packet is encoded
+    once, so publishing only has to add the remaining length, the message
+    id and the payload. Pass it to Client.publish() in place of the topic:
+
+    light = PreparedTopic("/yee/light", qos=1)
+    client.publish(light, payload)
+
+    Members:
+
+    topic : String. The topic.
+    qos : Integer. The Quality of Service used for every publish.
+    retain : Boolean. The retain flag used for every publish.
+    """
+    __slots__ = 'topic', 'qos', 'retain', '_command', '_topic_field', '_fixed_length'
+
+    def __init__(self, topic, qos=0, retain=False):
+        if topic is None or len(topic) == 0:
+            raise ValueError('Invalid topic.')
+        if qos<0 or qos>2:
+            raise ValueError('Invalid QoS level.')
+        if '+' in topic or '#' in topic:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        utopic = topic.encode('utf-8')
+        if len(utopic) > 65535:
+            raise ValueError('Invalid topic.')
+
+        self.topic = topic
+        self.qos = qos
+        self.retain = retain
+        self._command = PUBLISH | (qos<<1) | int(bool(retain))
+        self._topic_field = struct.pack("!H", len(utopic)) + utopic
+        self._fixed_length = len(self._topic_field)
+        if qos > 0:
+            # For message id
+            self._fixed_length = self._fixed_length + 2
+
+    def _encode(self, packet, mid, payload, dup):
+        # Append a PUBLISH packet to the bytearray packet. payload must
+        # already be bytes-like, or None.
+        if dup:
+            packet.append(self._command | 0x08)
+        else:
+            packet.append(self._command)
+        if payload is None:
+            _append_remaining_length(packet, self._fixed_length)
+            packet.extend(self._topic_field)
+            if self.qos > 0:
+                packet.extend(struct.pack("!H", mid))
+        else:
+            _append_remaining_length(packet, self._fixed_length + len(payload))
+            packet.extend(self._topic_field)
+            if self.qos > 0:
+                packet.extend(struct.pack("!H", mid))
+            packet.extend(payload)
+        return packet
+
+
+class _OfflineQueue(object):
+    # Messages published while the client can't send them, oldest first.
+    # Up to max_bytes of them are held in memory. Beyond that, and until
+    # the messages on disk have been read back, new messages are appended to
+    # segment files path.00000001, path.00000002, ... of about segment_size
+    # bytes each, which are deleted once they have been read.
+    #
+    # Entries are lists of [seq, mid, topic, payload, qos, retain, info,
+    # size], topic being a string or a PreparedTopic.
+
+    # seq, mid, qos, retain, topic length, payload length
+    _RECORD = struct.Struct('!QHBBHI')
+    # Rough memory used by a queued message besides its topic and payload.
+    _OVERHEAD = 128
+
+    def __init__(self, max_bytes, path, segment_size, max_disk_bytes, drop):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.segment_size = segment_size
+        self.max_disk_bytes = max_disk_bytes
+        self.drop = drop
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.dropped = 0
+
+        self._memory = collections.deque()
+        self._seq = 0
+        self._disk_count = 0
+        self._segments = collections.deque()
+        self._writer = None
+        self._reader = None
+        # seq -> MQTTMessageInfo of messages on disk, for as long as the
+        # caller of publish() holds on to it.
+        self._infos = weakref.WeakValueDictionary()
+        if path is not None:
+            self._recover()
+
+    def __len__(self):
+        return len(self._memory) + self._disk_count
+
+    def put(self, mid, topic, payload, qos, retain, info):
+        # Queue a message, first dropping messages as the drop policy says
+        # if there is no room for it. Returns the dropped entries, which may
+        # include the new one.
+        if isinstance(topic, PreparedTopic):
+            name = topic.topic
+        else:
+            name = topic
+        size = len(name) + self._OVERHEAD
+        if payload is not None:
+            size = size + len(payload)
+        self._seq = self._seq + 1
+        entry = [self._seq, mid, topic, payload, qos, retain, info, size]
+
+        dropped = []
+        if size > self.max_bytes and (self.path is None or 0 < self.max_disk_bytes < size):
+            # Would never fit.
+            dropped.append(entry)
+            return dropped
+        while not self._room(size):
+            if self.drop == 'newest' or len(self) == 0:
+                dropped.append(entry)
+                return dropped
+            victim = None
+            if self.drop == 'topic' and self._disk_count == 0:
+                victim = self._pop_topic(name)
+            if victim is None:
+                # Free space where it is needed: on disk once messages are
+                # being spilled.
+                if self._disk_count > 0:
+                    victim = self._read()
+                else:
+                    victim = self.popleft()
+            dropped.append(victim)
+
+        if self._disk_count == 0 and self.memory_bytes + size <= self.max_bytes:
+            self._memory.append(entry)
+            self.memory_bytes = self.memory_bytes + size
+        else:
+            self._spill(entry)
+        return dropped
+
+    def appendleft(self, entry):
+        # Put back an entry just taken with popleft(), ahead of the rest.
+        self._memory.appendleft(entry)
+        self.memory_bytes = self.memory_bytes + entry[7]
+
+    def popleft(self):
+        if self._memory:
+            entry = self._memory.popleft()
+            self.memory_bytes = self.memory_bytes - entry[7]
+            return entry
+        return self._read()
+
+    def _room(self, size):
+        if self._disk_count == 0 and self.memory_bytes + size <= self.max_bytes:
+            return True
+        if self.path is None:
+            return False
+        return self.max_disk_bytes == 0 or self.disk_bytes + size <= self.max_disk_bytes
+
+    def _pop_topic(self, name):
+        # Remove the oldest message in memory on the topic name, which a
+        # newer message on the same topic supersedes.
+        for (i, entry) in enumerate(self._memory):
+            topic = entry[2]
+            if isinstance(topic, PreparedTopic):
+                topic = topic.topic
+            if topic == name:
+                del self._memory[i]
+                self.memory_bytes = self.memory_bytes - entry[7]
+                return entry
+        return None
+
+    def _segment_path(self, segment):
+        return "%s.%08d" % (self.path, segment)
+
+    def _spill(self, entry):
+        (seq, mid, topic, payload, qos, retain, info, size) = entry
+        if isinstance(topic, PreparedTopic):
+            topic = topic.topic
+        topic = topic.encode('utf-8')
+        if payload is None:
+            payload = b''
+        else:
+            payload = _payload_bytes(payload)
+
+        if self._writer is None or self._writer.tell() >= self.segment_size:
+            if self._writer is not None:
+                self._writer.close()
+            if self._segments:
+                segment = self._segments[-1] + 1
+            else:
+                segment = 1
+            self._writer = open(self._segment_path(segment), 'wb')
+            self._segments.append(segment)
+
+        self._writer.write(self._RECORD.pack(seq, mid, qos, int(bool(retain)), len(topic), len(payload)))
+        self._writer.write(topic)
+        self._writer.write(payload)
+        self._disk_count = self._disk_count + 1
+        self.disk_bytes = self.disk_bytes + self._RECORD.size + len(topic) + len(payload)
+        if info is not None:
+            self._infos[seq] = info
+
+    def _read(self):
+        # Read back the oldest message on disk.
+        while True:
+            if self._reader is None:
+                self._reader = open(self._segment_path(self._segments[0]), 'rb')
+            if self._writer is not None and len(self._segments) == 1:
+                self._writer.flush()
+
+            header = self._reader.read(self._RECORD.size)
+            if len(header) < self._RECORD.size:
+                # Finished with this segment.
+                self._reader.close()
+                self._reader = None
+                os.remove(self._segment_path(self._segments.popleft()))
+                continue
+
+            (seq, mid, qos, retain, topic_length, payload_length) = self._RECORD.unpack(header)
+            topic = self._reader.read(topic_length)
+            if sys.version_info[0] >= 3:
+                topic = topic.decode('utf-8')
+            payload = self._reader.read(payload_length)
+            if payload_length == 0:
+                payload = None
+
+            self._disk_count = self._disk_count - 1
+            self.disk_bytes = self.disk_bytes - (self._RECORD.size + topic_length + payload_length)
+            if self._disk_count == 0:
+                self._clear_disk()
+            size = len(topic) + payload_length + self._OVERHEAD
+            return [seq, mid, topic, payload, qos, retain, self._infos.pop(seq, None), size]
+
+    def _clear_disk(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        while self._segments:
+            os.remove(self._segment_path(self._segments.popleft()))
+        self.disk_bytes = 0
+
+    def _recover(self):
+        # Pick up segments left by an earlier run, so that their messages
+        # are still sent. A record cut short by a crash is removed. New
+        # messages are numbered after the recovered ones.
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + '.'
+        segments = []
+        for name in os.listdir(directory):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and len(suffix) == 8 and suffix.isdigit():
+                segments.append(int(suffix))
+
+        for segment in sorted(segments):
+            path = self._segment_path(segment)
+            size = os.path.getsize(path)
+            count = 0
+            pos = 0
+            with open(path, 'rb') as f:
+                while pos + self._RECORD.size <= size:
+                    f.seek(pos)
+                    record = self._RECORD.unpack(f.read(self._RECORD.size))
+                    end = pos + self._RECORD.size + record[4] + record[5]
+                    if end > size:
+                        break
+                    count = count + 1
+                    pos = end
+                    self._seq = max(self._seq, record[0])
+            if pos == 0:
+                os.remove(path)
+                continue
+            if pos < size:
+                with open(path, 'r+b') as f:
+                    f.truncate(pos)
+            self._segments.append(segment)
+            self._disk_count = self._disk_count + count
+            self.disk_bytes = self.disk_bytes + pos
+
+
+def _dispatch_run(callbacks, client, userdata, message):
+    for callback in callbacks:
+        callback(client, userdata, message)
+
+
+class _Dispatcher(object):
+    # Runs on_message callbacks on an executor. Messages with the same key
+    # run one at a time, in the order they arrived, by submitting the next
+    # one only once the previous one has finished; messages with different
+    # keys run concurrently.
+
+    def __init__(self, executor, max_queued, key, wake, log):
+        self._executor = executor
+        self._max_queued = max_queued
+        self._key = key
+        self._wake = wake
+        self._log = log
+        self._process = HAVE_FUTURES and isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+        self._mutex = threading.Lock()
+        # key -> deque of the messages waiting behind the one running.
+        self._queues = {}
+        # Messages waiting or running.
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def full(self):
+        return self._max_queued > 0 and self._count >= self._max_queued
+
+    def put(self, client, userdata, callbacks, message):
+        if self._key is None:
+            key = message.topic
+        else:
+            key = self._key(message)
+        if self._process:
+            # The client can't be pickled.
+            client = None
+        item = (callbacks, client, userdata, message)
+
+        self._mutex.acquire()
+        self._count += 1
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(item)
+            self._mutex.release()
+            return
+        self._queues[key] = collections.deque()
+        self._mutex.release()
+        self._submit(key, item)
+
+    def _submit(self, key, item):
+        while item is not None:
+            try:
+                future = self._executor.submit(_dispatch_run, *item)
+            except RuntimeError as err:
+                # The executor has been shut down.
+                self._log(MQTT_LOG_ERR, "Dropped message on %s: %s", item[3].topic, err)
+                item = self._next(key)
+                continue
+            future.add_done_callback(lambda future: self._done(key, future))
+            return
+
+    def _done(self, key, future):
+        if not future.cancelled() and future.exception() is not None:
+            self._log(MQTT_LOG_ERR, "Caught exception in on_message: %s", future.exception())
+        self._submit(key, self._next(key))
+
+    def _next(self, key):
+        # Called when a message with key has finished: returns the next one
+        # to run, if any.
+        self._mutex.acquire()
+        was_full = self.full()
+        self._count -= 1
+        queue = self._queues[key]
+        if queue:
+            item = queue.popleft()
+        else:
+            item = None
+            del self._queues[key]
+        self._mutex.release()
+        if was_full and not self.full():
+            # The network loop stopped reading; let it start again.
+            self._wake()
+        return item
+
 
 class Client(object):
     """MQTT version 3.1/3.1.1 client class.
@@ -449,6 +1350,11 @@ class Client(object):
       request. The mid variable matches the mid variable returned from the
       corresponding unsubscribe() call.
 
+    on_backpressure(client, userdata, active): called when the outgoing packet
+      queue reaches the high watermark set with max_queued_bytes_set()
+      (active=True), and again when it has drained to the low watermark
+      (active=False).
+
     on_log(client, userdata, level, buf): called when the client has log information. Define
       to allow debugging. The level variable gives the severity of the message
       and will be one of MQTT_LOG_INFO, MQTT_LOG_NOTICE, MQTT_LOG_WARNING,
@@ -492,9 +1398,15 @@ class Client(object):
         self._userdata = userdata
         self._sock = None
         self._sockpairR, self._sockpairW = _socketpair_compat()
+        # True from writing a byte to sockpairW until the network loop has
+        # read it, during which further wakeups are not needed.
+        self._wake_pending = False
+        # True while loop() is processing the events returned by select().
+        self._loop_busy = False
         self._keepalive = 60
         self._message_retry = 20
-        self._last_retry_check = 0
+        # Keepalive, PINGRESP timeout and QoS>0 retry deadlines.
+        self._timers = _Scheduler()
         self._clean_session = clean_session
         if client_id == "" or client_id is None:
             self._client_id = "paho/" + "".join(random.choice("0123456789ADCDEF") for x in range(23-5))
@@ -505,22 +1417,34 @@ class Client(object):
         self._password = ""
         self._in_packet = {
             "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
             "remaining_length": 0,
             "packet": b"",
-            "to_process": 0,
             "pos": 0}
-        self._out_packet = []
+        self._in_reader = _PacketReader()
+        self._packets_backlog = False
+        self._max_packets_limit = 1024
+        self._write_coalesce_limit = 65536
+        self._out_packet = collections.deque()
+        self._out_packet_bytes = 0
+        self._out_packet_high_watermark = 0
+        self._out_packet_low_watermark = 0
+        self._out_packet_nonblocking = True
+        self._out_backpressure = False
         self._current_out_packet = None
+        # Packets whose joined write to an SSL or WebSocket transport has not
+        # completed, see _packet_gather().
+        self._current_out_batch = None
         self._last_msg_in = time_func()
         self._last_msg_out = time_func()
         self._ping_t = 0
         self._last_mid = 0
         self._state = mqtt_cs_new
-        self._out_messages = []
-        self._in_messages = []
+        # In-flight QoS>0 messages indexed by mid, in the order they were
+        # published/received. Outgoing messages that are waiting for room in
+        # the inflight window are also kept, in order, in _out_message_queue.
+        self._out_messages = collections.OrderedDict()
+        self._out_message_queue = collections.deque()
+        self._in_messages = collections.OrderedDict()
         self._max_inflight_messages = 20
         self._inflight_messages = 0
         self._max_queued_messages = 0
@@ -529,21 +1453,39 @@ class Client(object):
         self._will_payload = None
         self._will_qos = 0
         self._will_retain = False
-        self.on_message_filtered = []
+        self.on_message_filtered = MQTTMatcher()
         self._host = ""
         self._port = 1883
         self._bind_address = ""
         self._in_callback = False
         self._strict_protocol = False
+        self._payload_bytes = False
+        self._store = None
+        self._offline = None
+        # _Dispatcher set by message_dispatch_set(), or None to call
+        # on_message from the network loop.
+        self._dispatcher = None
+        self._offline_mutex = threading.Lock()
+        self._connector = None
+        self._connect_timeout = 30.0
+        self._reconnect_min_delay = 1.0
+        self._reconnect_max_delay = 120.0
+        # Failed attempts since the last accepted connection.
+        self._reconnect_failures = 0
         self._callback_mutex = threading.RLock()
         self._state_mutex = threading.Lock()
         self._out_packet_mutex = threading.Lock()
+        self._out_packet_cond = threading.Condition(self._out_packet_mutex)
         self._current_out_packet_mutex = threading.Lock()
         self._msgtime_mutex = threading.Lock()
         self._out_message_mutex = threading.Lock()
+        self._mid_generate_mutex = threading.Lock()
         self._in_message_mutex = threading.Lock()
         self._thread = None
         self._thread_terminate = False
+        # Set by loop_external_set().
+        self._loop_external = False
+        self._loop_external_thread = None
         self._ssl = None
         self._tls_certfile = None
         self._tls_keyfile = None
@@ -552,6 +1494,16 @@ class Client(object):
         self._tls_ciphers = None
         self._tls_version = tls_version
         self._tls_insecure = False
+        # SSLContext built by tls_set(), or None to use ssl.wrap_socket().
+        self._tls_context = None
+        # permessage-deflate options for the websockets transport, or None.
+        self._ws_deflate = None
+        self._ws_deflate_stats = dict(
+            negotiated = False,
+            bytes_in = 0,
+            bytes_in_wire = 0,
+            bytes_out = 0,
+            bytes_out_wire = 0)
         # No default callbacks
         self._on_log = None
         self._on_connect = None
@@ -560,6 +1512,22 @@ class Client(object):
         self._on_publish = None
         self._on_unsubscribe = None
         self._on_disconnect = None
+        self._on_backpressure = None
+        self._logger = None
+        # Counters reported by stats(). Packets are counted by command type,
+        # indexed by the command's top four bits.
+        self._stats_bytes_in = 0
+        self._stats_bytes_out = 0
+        self._stats_packets_in = [0] * 16
+        self._stats_packets_out = [0] * 16
+        self._stats_retries = 0
+        # Connections accepted by the broker, and attempts to connect.
+        self._stats_connects = 0
+        self._stats_connect_attempts = 0
+        # mid -> time_func() of the first send, for QoS>0 publishes
+        self._publish_sent = {}
+        self._puback_rtt = _Histogram()
+        self._pubcomp_rtt = _Histogram()
 
     def __del__(self):
         pass
@@ -607,7 +1575,8 @@ class Client(object):
         pydoc for more information on this parameter.
 
         tls_version allows the version of the SSL/TLS protocol used to be
-        specified. By default TLS v1 is used. Previous versions (all versions
+        specified. By default TLS v1 is used. None selects the highest version
+        supported by both client and broker. Previous versions (all versions
         beginning with SSL) are possible but not recommended due to possible
         security problems.
 
@@ -615,6 +1584,12 @@ class Client(object):
         for this connection, or None to use the defaults. See the ssl pydoc for
         more information.
 
+        The certificates are loaded into an SSLContext here, once, and the
+        context is shared with other clients given the same arguments. Where
+        Python supports it (3.6 or later) each connection offers to resume the
+        TLS session of the previous connection to the same broker, which
+        saves most of the handshake on reconnect.
+
         Must be called before connect() or connect_async()."""
         if HAVE_SSL is False:
             raise ValueError('This platform has no SSL/TLS.')
@@ -652,6 +1627,10 @@ class Client(object):
         self._tls_cert_reqs = cert_reqs
         self._tls_version = tls_version
         self._tls_ciphers = ciphers
+        if HAVE_SSL_CONTEXT:
+            self._tls_context = _tls_context(
+                ca_certs, certfile, keyfile, cert_reqs, tls_version, ciphers,
+                self._tls_insecure)
 
     def tls_insecure_set(self, value):
         """Configure verification of the server hostname in the server certificate.
@@ -670,6 +1649,52 @@ class Client(object):
             raise ValueError('This platform has no SSL/TLS.')
 
         self._tls_insecure = value
+        if self._tls_context is not None:
+            self._tls_context = _tls_context(
+                self._tls_ca_certs, self._tls_certfile, self._tls_keyfile,
+                self._tls_cert_reqs, self._tls_version, self._tls_ciphers, value)
+
+    def ws_set_deflate(self, enabled=True, compress_outgoing=True, client_context_takeover=True,
+                       server_context_takeover=True, min_size=64, level=zlib.Z_DEFAULT_COMPRESSION):
+        """Configure permessage-deflate compression (RFC 7692) for the
+        websockets transport. It is offered to the broker in the opening
+        handshake and only used if the broker accepts it.
+
+        enabled: offer the extension at all.
+        compress_outgoing: compress the messages sent by this client. Messages
+        compressed by the broker are always decompressed.
+        client_context_takeover, server_context_takeover: keep the
+        compression context between messages sent by this client and by the
+        broker respectively. This gives the best ratio on small, repetitive
+        payloads at the cost of 32 kB or so of memory for each direction.
+        min_size: messages smaller than this are sent uncompressed.
+        level: zlib compression level.
+
+        Must be called before connect(). See ws_deflate_stats() for the
+        compression achieved."""
+        if self._transport != "websockets":
+            raise ValueError('permessage-deflate requires the websockets transport.')
+        if not enabled:
+            self._ws_deflate = None
+            return
+
+        self._ws_deflate = dict(
+            compress_outgoing = compress_outgoing,
+            client_context_takeover = client_context_takeover,
+            server_context_takeover = server_context_takeover,
+            min_size = min_size,
+            level = level)
+
+    def ws_deflate_stats(self):
+        """Return a dict describing permessage-deflate use since the client
+        was created: whether it was negotiated on the current connection,
+        bytes_in/bytes_out counting MQTT data, bytes_in_wire/bytes_out_wire
+        counting WebSocket payload bytes on the network, and ratio_in and
+        ratio_out, the wire size as a fraction of the MQTT data size."""
+        stats = dict(self._ws_deflate_stats)
+        stats['ratio_in'] = float(stats['bytes_in_wire']) / stats['bytes_in'] if stats['bytes_in'] else 1.0
+        stats['ratio_out'] = float(stats['bytes_out_wire']) / stats['bytes_out'] if stats['bytes_out'] else 1.0
+        return stats
 
     def connect(self, host, port=1883, keepalive=60, bind_address=""):
         """Connect to a remote broker.
@@ -757,28 +1782,121 @@ class Client(object):
 
     def reconnect(self):
         """Reconnect the client after a disconnect. Can only be called after
-        connect()/connect_async()."""
+        connect()/connect_async().
+
+        Blocks until the connection has been made. Raises socket.error if it
+        fails, and socket.timeout if it takes longer than the time set with
+        connect_timeout_set()."""
+        self.reconnect_start()
+        connector = self._connector
+        try:
+            sock = None
+            while sock is None:
+                sock = connector.poll(None)
+        finally:
+            self._connector = None
+        return self._reconnect_finish(sock, connector.remaining())
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        """Set the delay before loop_forever(), and so loop_start(), retries
+        a failed or lost connection. It starts at min_delay seconds and
+        doubles after each failed attempt, up to max_delay, going back to
+        min_delay once the broker accepts a connection. Each delay is picked
+        at random between half and all of that value, so that clients which
+        lost their connection at the same time don't all reconnect at once."""
+        if min_delay <= 0 or max_delay < min_delay:
+            raise ValueError('Invalid reconnect delay.')
+        self._reconnect_min_delay = min_delay
+        self._reconnect_max_delay = max_delay
+
+    def connect_timeout_set(self, timeout):
+        """Set the time in seconds allowed for the network connection to the
+        broker to be made, including any TLS and WebSocket handshakes. 30
+        seconds by default; None or 0 means no limit."""
+        if timeout is not None and timeout < 0:
+            raise ValueError('Invalid timeout.')
+        self._connect_timeout = timeout
+
+    def reconnect_delay(self):
+        """Return the delay in seconds before the next attempt to reconnect,
+        as set with reconnect_delay_set(). Each call counts as a failed
+        attempt, so the next delay is longer. For network loops other than
+        loop_forever() that reconnect by themselves."""
+        delay = self._reconnect_min_delay * (2 ** min(self._reconnect_failures, 30))
+        delay = min(delay, self._reconnect_max_delay)
+        self._reconnect_failures = self._reconnect_failures + 1
+        return random.uniform(delay / 2.0, delay)
+
+    def _loop_reconnect(self):
+        # Start connecting for loop_forever(); loop() completes it.
+        try:
+            self.reconnect_start()
+        except socket.error as err:
+            self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying: %s", err)
+
+    def _loop_connect(self, timeout):
+        # Called by loop() while a connection is being made.
+        connector = self._connector
+        if self._state == mqtt_cs_disconnecting:
+            connector.close()
+            self._connector = None
+            return MQTT_ERR_NO_CONN
+        try:
+            sock = connector.poll(timeout)
+            if sock is None:
+                return MQTT_ERR_SUCCESS
+            self._connector = None
+            return self._reconnect_finish(sock, connector.remaining())
+        except socket.error as err:
+            self._connector = None
+            self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying: %s", err)
+            return MQTT_ERR_NO_CONN
+
+    def _reconnect_wait(self, delay):
+        # Wait delay seconds before reconnecting, or until loop_stop() or
+        # disconnect() is called.
+        self._easy_log(MQTT_LOG_DEBUG, "Reconnecting in %.1f seconds", delay)
+        deadline = time_func() + delay
+        while self._thread_terminate is False and self._state != mqtt_cs_disconnecting:
+            remaining = deadline - time_func()
+            if remaining <= 0:
+                return
+            try:
+                rlist = select.select([self._sockpairR], [], [], remaining)[0]
+            except select.error:
+                return
+            if rlist:
+                self.wake_clear()
+
+    def reconnect_start(self):
+        """Start reconnecting to the broker given to connect() or
+        connect_async() without blocking. The connection is then completed
+        by loop(), reconnect() or calls to reconnect_poll().
+
+        Raises socket.error if the host name can't be resolved."""
         if len(self._host) == 0:
             raise ValueError('Invalid host.')
         if self._port <= 0:
             raise ValueError('Invalid port number.')
 
+        self._stats_connect_attempts += 1
         self._in_packet = {
             "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
             "remaining_length": 0,
             "packet": b"",
-            "to_process": 0,
             "pos": 0}
+        self._in_reader.reset()
 
         self._out_packet_mutex.acquire()
-        self._out_packet = []
+        self._out_packet = collections.deque()
+        backpressure = self._out_packet_bytes_update(-self._out_packet_bytes)
         self._out_packet_mutex.release()
+        if backpressure is not None:
+            self._do_on_backpressure(backpressure)
 
         self._current_out_packet_mutex.acquire()
         self._current_out_packet = None
+        self._current_out_batch = None
         self._current_out_packet_mutex.release()
 
         self._msgtime_mutex.acquire()
@@ -801,16 +1919,43 @@ class Client(object):
         # Put messages in progress in a valid state.
         self._messages_reconnect_reset()
 
+        if self._connector is not None:
+            self._connector.close()
+            self._connector = None
+        if self._tls_context is not None:
+            wrap = self._tls_wrap
+        else:
+            wrap = None
+        self._connector = _Connector(self._host, self._port, self._bind_address, self._connect_timeout, wrap=wrap)
+
+    def _reconnect_finish(self, sock, remaining):
+        # Complete a connection whose socket is connected, and has done its
+        # TLS handshake if the client has an SSLContext: the WebSocket
+        # handshake, or the TLS handshake without an SSLContext, which still
+        # block but only for the remaining seconds of the connect timeout,
+        # then the CONNECT packet.
+        if remaining is not None and remaining <= 0:
+            sock.close()
+            raise socket.timeout('Connection timed out.')
+        sock.settimeout(remaining)
         try:
-            if (sys.version_info[0] == 2 and sys.version_info[1] < 7) or (sys.version_info[0] == 3 and sys.version_info[1] < 2):
-                sock = socket.create_connection((self._host, self._port))
-            else:
-                sock = socket.create_connection((self._host, self._port), source_address=(self._bind_address, 0))
-        except socket.error as err:
-            if err.errno != errno.EINPROGRESS and err.errno != errno.EWOULDBLOCK and err.errno != EAGAIN:
-                raise
+            return self._reconnect_handshake(sock)
+        except:
+            if self._ssl:
+                self._ssl.close()
+            sock.close()
+            self._ssl = None
+            self._sock = None
+            raise
 
-        if self._tls_ca_certs is not None:
+    def _reconnect_handshake(self, sock):
+        if self._tls_context is not None:
+            # The connector has done the handshake, during which the context
+            # checked the hostname.
+            self._ssl = sock
+            if HAVE_SSL_SESSION and sock.session_reused:
+                self._easy_log(MQTT_LOG_DEBUG, "Resumed TLS session")
+        elif self._tls_ca_certs is not None:
             self._ssl = ssl.wrap_socket(
                 sock,
                 certfile=self._tls_certfile,
@@ -828,9 +1973,11 @@ class Client(object):
 
         if self._transport == "websockets":
             if self._tls_ca_certs is not None:
-                self._ssl = WebsocketWrapper(self._ssl, self._host, self._port, True)
+                self._ssl = WebsocketWrapper(self._ssl, self._host, self._port, True,
+                                             self._ws_deflate, self._ws_deflate_stats)
             else:
-                sock = WebsocketWrapper(sock, self._host, self._port, False)
+                sock = WebsocketWrapper(sock, self._host, self._port, False,
+                                        self._ws_deflate, self._ws_deflate_stats)
 
         self._sock = sock
         if self._ssl:
@@ -838,9 +1985,25 @@ class Client(object):
         else:
             self._sock.setblocking(0)
 
+        if self._keepalive > 0:
+            self._timers.schedule('keepalive', time_func() + self._keepalive)
+
         return self._send_connect(self._keepalive, self._clean_session)
 
-    def loop(self, timeout=1.0, max_packets=1):
+    def _tls_wrap(self, sock):
+        # Called by the connector to start the TLS handshake, offering the
+        # session of the previous connection to the broker.
+        session = None
+        if HAVE_SSL_SESSION:
+            session = _tls_session_get(self._tls_context, self._host, self._port)
+        if session is not None:
+            return self._tls_context.wrap_socket(
+                sock, server_hostname=self._host, do_handshake_on_connect=False,
+                session=session)
+        return self._tls_context.wrap_socket(
+            sock, server_hostname=self._host, do_handshake_on_connect=False)
+
+    def loop(self, timeout=1.0, max_packets=None):
         """Process network events.
 
         This function must be called regularly to ensure communication with the
@@ -854,7 +2017,10 @@ class Client(object):
 
         timeout: The time in seconds to wait for incoming/outgoing network
           traffic before timing out and returning.
-        max_packets: Not currently used.
+        max_packets: The maximum number of incoming packets, and separately
+          of outgoing packets, to process in this call. Anything left over is
+          processed by the next call. Values < 1 mean no limit. The default,
+          None, is as for loop_read() and loop_write().
 
         Returns MQTT_ERR_SUCCESS on success.
         Returns >0 on error.
@@ -863,21 +2029,36 @@ class Client(object):
         if timeout < 0.0:
             raise ValueError('Invalid timeout.')
 
-        self._current_out_packet_mutex.acquire()
-        self._out_packet_mutex.acquire()
-        if self._current_out_packet is None and len(self._out_packet) > 0:
-            self._current_out_packet = self._out_packet.pop(0)
+        if self._connector is not None:
+            return self._loop_connect(timeout)
 
-        if self._current_out_packet:
+        self._packets_backlog = False
+
+        # Complete packets may still be buffered from a read that hit the
+        # max_packets limit. select() can't report those, so don't wait.
+        reading = self.want_read()
+        pending_read = reading and self._in_reader.has_packet()
+        if pending_read:
+            timeout = 0.0
+        else:
+            # Wake up in time for the next keepalive/retry deadline.
+            deadline = self._timers.next_deadline()
+            if deadline is not None:
+                timeout = max(0.0, min(timeout, deadline - time_func()))
+
+        self._out_packet_mutex.acquire()
+        if self._current_out_packet is not None or len(self._out_packet) > 0:
             wlist = [self.socket()]
         else:
             wlist = []
         self._out_packet_mutex.release()
-        self._current_out_packet_mutex.release()
 
         # sockpairR is used to break out of select() before the timeout, on a
-        # call to publish() etc.
-        rlist = [self.socket(), self._sockpairR]
+        # call to publish() etc., or once the dispatch queue has room again.
+        if reading:
+            rlist = [self.socket(), self._sockpairR]
+        else:
+            rlist = [self._sockpairR]
         try:
             socklist = select.select(rlist, wlist, [], timeout)
         except TypeError:
@@ -892,29 +2073,29 @@ class Client(object):
             raise
         except:
             return MQTT_ERR_UNKNOWN
+        # Packets queued while the events are processed are written by
+        # loop_write() below or seen by the next call, without a wakeup.
+        self._loop_busy = True
+        try:
+            if pending_read or self.socket() in socklist[0]:
+                rc = self.loop_read(max_packets)
+                if rc or (self._ssl is None and self._sock is None):
+                    return rc
 
-        if self.socket() in socklist[0]:
-            rc = self.loop_read(max_packets)
-            if rc or (self._ssl is None and self._sock is None):
-                return rc
-
-        if self._sockpairR in socklist[0]:
-            # Stimulate output write even though we didn't ask for it, because
-            # at that point the publish or other command wasn't present.
-            socklist[1].insert(0, self.socket())
-            # Clear sockpairR - only ever a single byte written.
-            try:
-                self._sockpairR.recv(1)
-            except socket.error as err:
-                if err.errno != EAGAIN:
-                    raise
+            if self._sockpairR in socklist[0]:
+                # Stimulate output write even though we didn't ask for it, because
+                # at that point the publish or other command wasn't present.
+                socklist[1].insert(0, self.socket())
+                self.wake_clear()
 
-        if self.socket() in socklist[1]:
-            rc = self.loop_write(max_packets)
-            if rc or (self._ssl is None and self._sock is None):
-                return rc
+            if self.socket() in socklist[1] or self.want_write():
+                rc = self.loop_write(max_packets)
+                if rc or (self._ssl is None and self._sock is None):
+                    return rc
 
-        return self.loop_misc()
+            return self.loop_misc()
+        finally:
+            self._loop_busy = False
 
     def publish(self, topic, payload=None, qos=0, retain=False):
         """Publish a message on a topic.
@@ -927,7 +2108,9 @@ class Client(object):
         zero length message will be used. Passing an int or float will result
         in the payload being converted to a string representing that number. If
         you wish to send a true int/float, use struct.pack() to create the
-        payload you require.
+        payload you require. bytes, bytearray and memoryview payloads are
+        not copied, so must not be modified until the message has been
+        published.
         qos: The quality of service level to use.
         retain: If set to true, the message will be set as the "last known
         good"/retained message for the topic.
@@ -942,46 +2125,53 @@ class Client(object):
         the old construct of (rc, mid) = client.publish(...) is still valid.
 
         rc is MQTT_ERR_SUCCESS to indicate success or MQTT_ERR_NO_CONN if the
-        client is not currently connected.  mid is the message ID for the
+        client is not currently connected. If byte watermarks have been set
+        with max_queued_bytes_set() and the outgoing queue is above its high
+        watermark, rc is MQTT_ERR_BACKPRESSURE, the message has not been
+        queued and mid is 0.  mid is the message ID for the
         publish request. The mid value can be used to track the publish request
         by checking against the mid argument in the on_publish() callback if it
         is defined.
 
+        topic may also be a PreparedTopic for topics that are published to
+        repeatedly, in which case qos and retain are taken from it.
+
         A ValueError will be raised if topic is None, has zero length or is
         invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
         the length of the payload is greater than 268435455 bytes."""
-        if topic is None or len(topic) == 0:
-            raise ValueError('Invalid topic.')
-        if qos<0 or qos>2:
-            raise ValueError('Invalid QoS level.')
-        if isinstance(payload, str) or isinstance(payload, bytearray):
-            local_payload = payload
-        elif sys.version_info[0] == 3 and isinstance(payload, bytes):
-            local_payload = bytearray(payload)
-        elif sys.version_info[0] < 3 and isinstance(payload, unicode):
-            local_payload = payload
-        elif isinstance(payload, int) or isinstance(payload, float):
-            local_payload = str(payload)
-        elif payload is None:
-            local_payload = None
-        else:
-            raise TypeError('payload must be a string, bytearray, int, float or None.')
+        (topic, local_payload, qos, retain) = self._publish_check(topic, payload, qos, retain)
 
-        if local_payload is not None and len(local_payload) > 268435455:
-            raise ValueError('Payload too large.')
+        if self._offline is not None:
+            info = self._offline_publish(topic, local_payload, qos, retain)
+            if info is not None:
+                return info
 
-        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
-            raise ValueError('Publish topic cannot contain wildcards.')
+        # A message refused here never gets a mid.
+        rc = self._wait_for_backpressure()
+        if rc != MQTT_ERR_SUCCESS:
+            info = MQTTMessageInfo(0)
+            info.rc = rc
+            return info
 
         local_mid = self._mid_generate()
+        return self._publish_message(local_mid, topic, local_payload, qos, retain)
 
+    def _publish_message(self, local_mid, topic, local_payload, qos, retain, info=None):
+        # Send or queue a checked message. info is the MQTTMessageInfo to
+        # use if the caller already has one.
         if qos == 0:
-            info = MQTTMessageInfo(local_mid)
+            if info is None:
+                info = MQTTMessageInfo(local_mid)
             rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False, info)
             info.rc = rc
             return info
         else:
-            message = MQTTMessage(local_mid, topic)
+            if isinstance(topic, PreparedTopic):
+                message = MQTTMessage(local_mid, topic.topic)
+            else:
+                message = MQTTMessage(local_mid, topic)
+            if info is not None:
+                message.info = info
             message.timestamp = time_func()
 
             if local_payload is None or len(local_payload) == 0:
@@ -997,9 +2187,16 @@ class Client(object):
 
             if self._max_queued_messages > 0 and len(self._out_messages) >= self._max_queued_messages:
                 self._out_message_mutex.release()
+                if info is not None:
+                    # Nothing else will complete it.
+                    info.rc = MQTT_ERR_QUEUE_SIZE
+                    info._set_as_published()
+                    return info
                 return (MQTT_ERR_QUEUE_SIZE, local_mid)
 
-            self._out_messages.append(message)
+            self._out_messages[message.mid] = message
+            if self._store is not None:
+                self._store.put('out', message)
             if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                 self._inflight_messages = self._inflight_messages+1
                 if qos == 1:
@@ -1008,7 +2205,7 @@ class Client(object):
                     message.state = mqtt_ms_wait_for_pubrec
                 self._out_message_mutex.release()
 
-                rc = self._send_publish(message.mid, message.topic, message.payload, message.qos, message.retain, message.dup)
+                rc = self._send_publish(message.mid, topic, message.payload, message.qos, message.retain, message.dup)
 
                 # remove from inflight messages so it will be send after a connection is made
                 if rc is MQTT_ERR_NO_CONN:
@@ -1019,11 +2216,139 @@ class Client(object):
                 message.info.rc = rc
                 return message.info
             else:
-                message.state = mqtt_ms_queued;
+                message.state = mqtt_ms_queued
+                self._out_message_queue.append(message)
                 self._out_message_mutex.release()
                 message.info.rc = MQTT_ERR_SUCCESS
                 return message.info
 
+    def publish_many(self, messages):
+        """Publish a batch of messages in one go.
+
+        messages is an iterable of messages, each a dict or a tuple in the
+        form taken by paho.mqtt.publish.multiple(). As for publish(), the
+        topic may be a PreparedTopic:
+
+        msg = {'topic':"<topic>", 'payload':"<payload>", 'qos':<qos>,
+        'retain':<retain>}
+        msg = ("<topic>", "<payload>", qos, retain)
+
+        Only the topic is required. All messages are validated before any is
+        queued. The PUBLISH packets of the messages that can be sent now are
+        encoded into a single buffer and queued together, so a burst costs
+        one lock acquisition and one wakeup of the network loop rather than
+        one per message.
+
+        Returns a list with a MQTTMessageInfo for each message, in order, as
+        publish() would have returned. Raises ValueError or TypeError as
+        publish() does, in which case nothing has been published."""
+        batch = []
+        for m in messages:
+            if isinstance(m, dict):
+                topic = m['topic']
+                payload = m.get('payload')
+                qos = m.get('qos', 0)
+                retain = m.get('retain', False)
+            elif isinstance(m, tuple):
+                (topic, payload, qos, retain) = m + (None, None, 0, False)[len(m):]
+            else:
+                raise ValueError('message must be a dict or a tuple')
+
+            batch.append(self._publish_check(topic, payload, qos, retain))
+
+        if (self._sock is None and self._ssl is None) or (
+                self._offline is not None and (len(self._offline) > 0 or not self._offline_connected())):
+            # Nothing can be written yet, or the messages have to go behind
+            # those in the offline queue. QoS>0 messages are kept for when the
+            # connection is made, exactly as publish() does.
+            return [self.publish(topic, payload, qos, retain) for (topic, payload, qos, retain) in batch]
+
+        infos = []
+        rc = self._wait_for_backpressure()
+        if rc != MQTT_ERR_SUCCESS:
+            for m in batch:
+                info = MQTTMessageInfo(0)
+                info.rc = rc
+                infos.append(info)
+            return infos
+
+        # (mid, topic, payload, qos, retain, info, message) of the messages
+        # to send now.
+        outgoing = []
+        now = time_func()
+        self._out_message_mutex.acquire()
+        for (topic, payload, qos, retain) in batch:
+            mid = self._mid_generate()
+            if qos == 0:
+                info = MQTTMessageInfo(mid)
+                outgoing.append((mid, topic, payload, qos, retain, info, None))
+                infos.append(info)
+                continue
+
+            if isinstance(topic, PreparedTopic):
+                message = MQTTMessage(mid, topic.topic)
+            else:
+                message = MQTTMessage(mid, topic)
+            message.timestamp = now
+            if payload is not None and len(payload) > 0:
+                message.payload = payload
+            message.qos = qos
+            message.retain = retain
+
+            if self._max_queued_messages > 0 and len(self._out_messages) >= self._max_queued_messages:
+                message.info.rc = MQTT_ERR_QUEUE_SIZE
+                infos.append(message.info)
+                continue
+
+            self._out_messages[mid] = message
+            if self._store is not None:
+                self._store.put('out', message)
+            if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
+                self._inflight_messages = self._inflight_messages+1
+                if qos == 1:
+                    message.state = mqtt_ms_wait_for_puback
+                else:
+                    message.state = mqtt_ms_wait_for_pubrec
+                outgoing.append((mid, topic, message.payload, qos, retain, None, message))
+            else:
+                message.state = mqtt_ms_queued
+                self._out_message_queue.append(message)
+                message.info.rc = MQTT_ERR_SUCCESS
+            infos.append(message.info)
+        self._out_message_mutex.release()
+
+        if not outgoing:
+            return infos
+
+        buf = bytearray()
+        bounds = []
+        for (mid, topic, payload, qos, retain, info, message) in outgoing:
+            start = len(buf)
+            self._encode_publish(buf, mid, topic, payload, qos, retain, False)
+            bounds.append((start, len(buf)))
+
+        # Every packet is a slice of the one buffer.
+        view = memoryview(buf)
+        packets = []
+        for ((mid, topic, payload, qos, retain, info, message), (start, end)) in zip(outgoing, bounds):
+            if qos > 0:
+                self._publish_sent[mid] = now
+                self._message_retry_schedule('out', mid)
+            packets.append((PUBLISH, view[start:end], mid, qos, info))
+        rc = self._packet_queue_many(packets)
+
+        for (mid, topic, payload, qos, retain, info, message) in outgoing:
+            if message is None:
+                info.rc = rc
+                continue
+            if rc is MQTT_ERR_NO_CONN:
+                # remove from inflight messages so it will be send after a connection is made
+                with self._out_message_mutex:
+                    self._inflight_messages -= 1
+                    message.state = mqtt_ms_publish
+            message.info.rc = rc
+        return infos
+
     def username_pw_set(self, username, password=None):
         """Set a username and optionally a password for broker authentication.
 
@@ -1158,10 +2483,15 @@ class Client(object):
 
         return self._send_unsubscribe(False, topic_list)
 
-    def loop_read(self, max_packets=1):
+    def loop_read(self, max_packets=None):
         """Process read network events. Use in place of calling loop() if you
         wish to handle your client reads as part of your own application.
 
+        max_packets is the maximum number of incoming packets to handle in
+        this call. Values < 1 mean handle everything that can be read without
+        blocking. The default, None, handles up to one packet per QoS>0
+        message in flight, and at least one.
+
         Use socket() to obtain the client socket to call select() or equivalent
         on.
 
@@ -1169,22 +2499,24 @@ class Client(object):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        max_packets = len(self._out_messages) + len(self._in_messages)
-        if max_packets < 1:
-            max_packets = 1
-
-        for i in range(0, max_packets):
-            rc = self._packet_read()
-            if rc > 0:
-                return self._loop_rc_handle(rc)
-            elif rc == MQTT_ERR_AGAIN:
-                return MQTT_ERR_SUCCESS
+        if max_packets is None:
+            max_packets = max(len(self._out_messages) + len(self._in_messages), 1)
+        rc = self._packet_read(max_packets)
+        if rc > 0:
+            return self._loop_rc_handle(rc)
+        if self._offline is not None:
+            # Acknowledgements may have opened the inflight window.
+            self._offline_drain()
         return MQTT_ERR_SUCCESS
 
-    def loop_write(self, max_packets=1):
+    def loop_write(self, max_packets=None):
         """Process read network events. Use in place of calling loop() if you
         wish to handle your client reads as part of your own application.
 
+        max_packets is the maximum number of outgoing packets to write in
+        this call. Values < 1, and the default of None, mean write until the
+        socket would block.
+
         Use socket() to obtain the client socket to call select() or equivalent
         on.
 
@@ -1194,16 +2526,13 @@ class Client(object):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        max_packets = len(self._out_packet) + 1
-        if max_packets < 1:
-            max_packets = 1
-
-        for i in range(0, max_packets):
-            rc = self._packet_write()
-            if rc > 0:
-                return self._loop_rc_handle(rc)
-            elif rc == MQTT_ERR_AGAIN:
-                return MQTT_ERR_SUCCESS
+        if max_packets is None:
+            max_packets = 0
+        rc = self._packet_write(max_packets)
+        if rc > 0:
+            return self._loop_rc_handle(rc)
+        if self._offline is not None:
+            self._offline_drain()
         return MQTT_ERR_SUCCESS
 
     def want_write(self):
@@ -1215,43 +2544,147 @@ class Client(object):
         else:
             return False
 
+    def want_read(self):
+        """Call to determine if loop_read() will read from the network. This
+        is False while the queue of message_dispatch_set() is full. Useful if
+        you are calling select() yourself rather than using loop()."""
+        dispatcher = self._dispatcher
+        return dispatcher is None or not dispatcher.full()
+
+    def wake_socket(self):
+        """Return the socket that becomes readable when the network loop
+        should run because packets have been queued, or loop_stop() or
+        disconnect() called, from another thread. Call wake_clear() when it
+        is readable. Useful if you are calling select() yourself rather than
+        using loop()."""
+        return self._sockpairR
+
+    def wake_clear(self):
+        """Consume the wakeup that made wake_socket() readable."""
+        # The bytes are read before the flag is cleared, so that a wakeup
+        # racing with this leaves a byte behind rather than being lost.
+        try:
+            self._sockpairR.recv(4096)
+        except socket.error as err:
+            if err.errno != EAGAIN:
+                raise
+        self._wake_pending = False
+
+    def read_pending(self):
+        """Return True if complete packets are buffered that loop_read()
+        will handle without reading from the socket, because an earlier call
+        stopped at max_packets. select() can't report these."""
+        return self._in_reader.has_packet()
+
+    def misc_deadline(self):
+        """Return the time, as given by time_func(), by which loop_misc()
+        must next be called for keepalive and message retries, or None if
+        nothing is due."""
+        return self._timers.next_deadline()
+
+    def is_disconnecting(self):
+        """Return True if disconnect() has been called, in which case a lost
+        connection should not be re-established."""
+        return self._state == mqtt_cs_disconnecting
+
+    def is_reconnecting(self):
+        """Return True while a connection started by reconnect_start() is
+        being made. The client starts one itself, from loop_read(), when the
+        broker refuses MQTT v3.1.1 and it falls back to v3.1; it is then
+        completed with reconnect_poll() like any other."""
+        return self._connector is not None
+
+    def reconnect_poll(self, timeout=0.0):
+        """Make progress with the connection started by reconnect_start(),
+        once one of reconnect_sockets() is ready or reconnect_deadline() has
+        passed, waiting up to timeout seconds. Returns True once the
+        connection has been made and CONNECT sent, and False while it is
+        still being made. Raises socket.error if it fails, or socket.timeout
+        once the connect timeout has passed."""
+        connector = self._connector
+        if connector is None:
+            return self.socket() is not None
+        try:
+            sock = connector.poll(timeout)
+        except socket.error:
+            self._connector = None
+            raise
+        if sock is None:
+            return False
+        self._connector = None
+        self._reconnect_finish(sock, connector.remaining())
+        return True
+
+    def reconnect_sockets(self):
+        """Return (socket, write) pairs for the sockets that the connection
+        started by reconnect_start() is waiting on, write being True if it
+        waits for the socket to become writable and False if readable."""
+        if self._connector is None:
+            return []
+        return self._connector.sockets()
+
+    def reconnect_deadline(self):
+        """Return the time by which reconnect_poll() should be called even
+        if none of reconnect_sockets() is ready, or None."""
+        if self._connector is None:
+            return None
+        return self._connector.next_deadline()
+
+    def reconnect_cancel(self):
+        """Give up the connection started by reconnect_start()."""
+        if self._connector is not None:
+            self._connector.close()
+            self._connector = None
+
+    def loop_external_set(self, external=True, thread=None):
+        """Tell the client that its network loop is run by something other
+        than loop_start(), such as a MultiClientLoop, in a thread of its own.
+        thread is that thread, if it is known yet.
+
+        While set, publish() and the other calls that queue packets don't
+        write to the socket themselves, which would race with the loop, but
+        wake it through wake_socket(). If max_queued_bytes_set() is asked to
+        block, publish() waits for the loop to drain the queue as it does
+        with loop_start(), unless it is called from the loop's thread."""
+        self._loop_external_thread = thread
+        self._loop_external = external
+
+    def is_connected(self):
+        """Return True if the broker has accepted the connection and it has
+        not been lost or closed since."""
+        return self._state == mqtt_cs_connected and not (self._sock is None and self._ssl is None)
+
     def loop_misc(self):
         """Process miscellaneous network events. Use in place of calling loop() if you
         wish to call select() or equivalent on.
 
         Do not use if you are using the threaded interface loop_start()."""
+        if self._store is not None:
+            self._store.flush()
+
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
+        # Only the timers that have expired are looked at, so an idle loop
+        # does no work however many messages are in flight.
         now = time_func()
-        self._check_keepalive()
-        if self._last_retry_check+1 < now:
-            # Only check once a second at most
-            self._message_retry_check()
-            self._last_retry_check = now
-
-        if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
-            # client->ping_t != 0 means we are waiting for a pingresp.
-            # This hasn't happened in the keepalive time so we should disconnect.
-            if self._ssl:
-                self._ssl.close()
-                self._ssl = None
-            elif self._sock:
-                self._sock.close()
-                self._sock = None
-
-            self._callback_mutex.acquire()
-            if self._state == mqtt_cs_disconnecting:
-                rc = MQTT_ERR_SUCCESS
+        while True:
+            key = self._timers.pop(now)
+            if key is None:
+                break
+            elif key == 'keepalive':
+                self._check_keepalive()
+            elif key == 'pingresp':
+                rc = self._check_pingresp(now)
+                if rc != MQTT_ERR_SUCCESS:
+                    return rc
+            elif key[0] == 'out':
+                self._message_retry_check(key, self._out_messages, self._out_message_mutex, now)
             else:
-                rc = 1
-            if self.on_disconnect:
-                self._in_callback = True
-                self.on_disconnect(self, self._userdata, rc)
-                self._in_callback = False
-            self._callback_mutex.release()
-            return MQTT_ERR_CONN_LOST
+                self._message_retry_check(key, self._in_messages, self._in_message_mutex, now)
 
+        if self._offline is not None:
+            self._offline_drain()
         return MQTT_ERR_SUCCESS
 
     def max_inflight_messages_set(self, inflight):
@@ -1271,6 +2704,112 @@ class Client(object):
         self._max_queued_messages = queue_size
         return self
 
+    def max_queued_bytes_set(self, high_watermark, low_watermark=None, block=False):
+        """Set byte watermarks for the queue of packets waiting to be written
+        to the network. A high_watermark of 0, the default, means no limit.
+
+        Once the queued bytes reach high_watermark, on_backpressure is called
+        with active=True. From then on publish() returns MQTT_ERR_BACKPRESSURE
+        without queueing the message, until the queue has drained down to
+        low_watermark (half of high_watermark if not given) and
+        on_backpressure is called with active=False.
+
+        If block is True, publish() called from outside the network thread,
+        started by loop_start() or announced with loop_external_set(), waits
+        for the queue to drain instead of returning MQTT_ERR_BACKPRESSURE."""
+        if high_watermark < 0:
+            raise ValueError('Invalid high watermark.')
+        if low_watermark is None:
+            low_watermark = high_watermark // 2
+        if low_watermark < 0 or (high_watermark > 0 and low_watermark >= high_watermark):
+            raise ValueError('Invalid low watermark.')
+
+        self._out_packet_mutex.acquire()
+        self._out_packet_high_watermark = high_watermark
+        self._out_packet_low_watermark = low_watermark
+        self._out_packet_nonblocking = not block
+        backpressure = self._out_packet_bytes_update(0)
+        self._out_packet_mutex.release()
+        if backpressure is not None:
+            self._do_on_backpressure(backpressure)
+        return self
+
+    def offline_queue_set(self, max_bytes, path=None, segment_size=4194304, max_disk_bytes=0, drop='oldest'):
+        """Queue messages published while the client is not connected, of
+        any QoS, in a queue bounded by size rather than keeping QoS>0
+        messages in memory without limit and discarding QoS 0 messages.
+        Messages are sent in the order they were published once the broker
+        has accepted the connection; until the queue has emptied, newer
+        messages are queued behind them.
+
+        max_bytes: the size of the topics and payloads, plus a small
+          allowance per message, held in memory.
+        path: if given, messages that don't fit in memory are written to
+          files named path.00000001, path.00000002, ... of about
+          segment_size bytes, which are removed once sent. Files left by an
+          earlier run of the program are picked up, so their messages are
+          sent too.
+        max_disk_bytes: the limit for the files. 0 means no limit.
+        drop: what to do when a message is published and there is no room:
+          'oldest' - drop queued messages, oldest first, until there is.
+          'newest' - drop the new message.
+          'topic' - drop the oldest queued message on the same topic, which
+            the new message supersedes, falling back to 'oldest'.
+
+        A dropped message is logged with MQTT_LOG_WARNING and its
+        MQTTMessageInfo gets rc MQTT_ERR_QUEUE_SIZE and counts as published,
+        so wait_for_publish() returns. The mid of a queued message can
+        change if it is still in use when the message is sent.
+
+        Call with max_bytes=0 and no path to stop using the queue, which
+        must then be empty."""
+        if max_bytes < 0 or max_disk_bytes < 0 or segment_size <= 0:
+            raise ValueError('Invalid offline queue size.')
+        if drop not in ('oldest', 'newest', 'topic'):
+            raise ValueError('Invalid drop policy.')
+
+        self._offline_mutex.acquire()
+        try:
+            if self._offline is not None and len(self._offline) > 0:
+                raise ValueError('Offline queue is not empty.')
+            if max_bytes == 0 and path is None:
+                self._offline = None
+            else:
+                self._offline = _OfflineQueue(max_bytes, path, segment_size, max_disk_bytes, drop)
+        finally:
+            self._offline_mutex.release()
+        return self
+
+    def message_dispatch_set(self, executor, max_queued=1000, key=None):
+        """Call the on_message and message_callback_add() callbacks from
+        executor, a concurrent.futures.Executor or anything else with a
+        compatible submit(), rather than from the network loop, so that a
+        slow callback doesn't hold up keepalives and other network traffic.
+        Pass None to go back to calling them from the network loop.
+
+        Messages with the same key are passed to the callbacks one at a time,
+        in the order they arrived, while messages with different keys may be
+        handled concurrently. key is a function taking an MQTTMessage and
+        returning a hashable value; by default it is the topic.
+
+        At most max_queued messages are waiting or being handled at any one
+        time (no limit if < 1). While that many are, the client stops
+        reading from the socket, so that the broker and TCP hold back
+        further messages, but keepalives and outgoing traffic continue. If
+        you call loop_read() yourself, want_read() tells you whether it
+        would read.
+
+        The callbacks are not called with the client's callback lock held
+        and so can run alongside other callbacks. Exceptions they raise are
+        logged with MQTT_LOG_ERR. With a ProcessPoolExecutor, the callbacks
+        and userdata must be picklable, the callbacks are passed None as the
+        client and the message payload is bytes."""
+        if executor is None:
+            self._dispatcher = None
+        else:
+            self._dispatcher = _Dispatcher(executor, max_queued, key, self._wake, self._easy_log)
+        self._wake()
+
     def message_retry_set(self, retry):
         """Set the timeout in seconds before a message with QoS>0 is retried.
         20 seconds by default."""
@@ -1279,6 +2818,36 @@ class Client(object):
 
         self._message_retry = retry
 
+    def payload_bytes_set(self, value):
+        """Set to True to have the payload of received messages passed to
+        on_message as bytes, as in earlier versions, rather than as a
+        memoryview of the received packet. This costs a copy of every
+        payload. False by default."""
+        self._payload_bytes = bool(value)
+
+    def message_store_set(self, store):
+        """Keep the state of QoS>0 messages that are part way through their
+        network flow in store, for example a
+        paho.mqtt.persistence.FileMessageStore, so that it survives a restart
+        of the process. Set to None to stop using a store.
+
+        Messages left in the store by a previous run are loaded: those
+        published by this client are resent, and QoS 2 messages received from
+        the broker are delivered to on_message once released, when the client
+        next connects. Call before connect(), and use clean_session=False so
+        that the broker keeps its side of the session."""
+        self._out_message_mutex.acquire()
+        self._in_message_mutex.acquire()
+        self._store = store
+        if store is not None:
+            (out_messages, in_messages) = store.load()
+            for m in out_messages:
+                self._out_messages[m.mid] = m
+            for m in in_messages:
+                self._in_messages[m.mid] = m
+        self._in_message_mutex.release()
+        self._out_message_mutex.release()
+
     def user_data_set(self, userdata):
         """Set the user data variable passed to callbacks. May be any data type."""
         self._userdata = userdata
@@ -1349,7 +2918,11 @@ class Client(object):
 
         timeout: The time in seconds to wait for incoming/outgoing network
           traffic before timing out and returning.
-        max_packets: Not currently used.
+        max_packets: The number of packets processed per loop() call when
+          there is no backlog. While packets keep arriving or queueing faster
+          than that, the batch size is doubled on each call (up to 1024) and
+          it falls back again once the backlog has cleared. Values < 1 mean
+          no limit.
         retry_first_connection: Should the first connection attempt be retried on failure.
 
         Raises socket.error on first connection failures unless retry_first_connection=True
@@ -1357,25 +2930,22 @@ class Client(object):
 
         run = True
 
-        while run:
-            if self._thread_terminate is True:
-                break
-
-            if self._state == mqtt_cs_connect_async:
-                try:
-                    self.reconnect()
-                except socket.error:
-                    if not retry_first_connection:
-                        raise
-                    self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying")
-                    time.sleep(1)
+        if self._state == mqtt_cs_connect_async and self._thread_terminate is False:
+            if retry_first_connection:
+                self._loop_reconnect()
             else:
-                break
+                self.reconnect()
 
+        batch = max_packets
         while run:
             rc = MQTT_ERR_SUCCESS
             while rc == MQTT_ERR_SUCCESS:
-                rc = self.loop(timeout, max_packets)
+                rc = self.loop(timeout, batch)
+                if max_packets >= 1:
+                    if self._packets_backlog:
+                        batch = min(batch*2, max(self._max_packets_limit, max_packets))
+                    elif batch > max_packets:
+                        batch = max(batch//2, max_packets)
                 # We don't need to worry about locking here, because we've
                 # either called loop_forever() when in single threaded mode, or
                 # in multi threaded mode when loop_stop() has been called and
@@ -1395,7 +2965,7 @@ class Client(object):
                 self._state_mutex.release()
             else:
                 self._state_mutex.release()
-                time.sleep(1)
+                self._reconnect_wait(self.reconnect_delay())
 
                 self._state_mutex.acquire()
                 if self._state == mqtt_cs_disconnecting or run is False or self._thread_terminate is True:
@@ -1403,10 +2973,7 @@ class Client(object):
                     self._state_mutex.release()
                 else:
                     self._state_mutex.release()
-                    try:
-                        self.reconnect()
-                    except socket.error as err:
-                        pass
+                    self._loop_reconnect()
 
         return rc
 
@@ -1434,6 +3001,8 @@ class Client(object):
             return MQTT_ERR_INVAL
 
         self._thread_terminate = True
+        # Cut short a select() or reconnect delay.
+        self._wake()
         if threading.current_thread() != self._thread:
             self._thread.join()
             self._thread = None
@@ -1460,9 +3029,86 @@ class Client(object):
         """
         self._on_log = func
 
-    @property
-    def on_connect(self):
-        """If implemented, called when the broker responds to our connection
+    def enable_logger(self, logger=None):
+        """Send log messages to a standard library logger as well as to
+        on_log. If logger is not given, the logger for this module is used.
+        Messages are only formatted for levels the logger has enabled."""
+        if logger is None:
+            if self._logger is not None:
+                # Do not replace a logger that has already been set.
+                return
+            logger = logging.getLogger(__name__)
+        self._logger = logger
+
+    def disable_logger(self):
+        self._logger = None
+
+    def stats(self):
+        """Return a snapshot of the traffic counters for this client as a
+        dict. While a network thread is running the values are read without
+        stopping it, so they may be slightly out of step with each other.
+
+        bytes_in, bytes_out: MQTT bytes received and sent since the client
+          was created.
+        packets_in, packets_out: dicts of packets received and sent, keyed
+          by packet type name, e.g. "PUBLISH".
+        out_packets, out_packet_bytes: packets, and their bytes, waiting to
+          be written to the network.
+        queued_messages: publishes waiting for an inflight slot.
+        inflight_out, inflight_in: QoS>0 messages whose flow is not complete.
+        retries: QoS>0 packets resent because no reply arrived in time.
+        reconnects: connections accepted by the broker after the first one.
+        connect_attempts: connections started, including ones that failed
+          or were refused.
+        offline_messages: messages in the queue set with offline_queue_set().
+        offline_bytes, offline_disk_bytes: the size of those held in memory
+          and written to disk.
+        offline_dropped: messages dropped because the offline queue was full.
+        puback_rtt, pubcomp_rtt: the time from first sending a QoS 1/2
+          PUBLISH to its PUBACK/PUBCOMP, as returned by
+          _Histogram.snapshot().
+        """
+        self._out_packet_mutex.acquire()
+        out_packets = len(self._out_packet)
+        out_packet_bytes = self._out_packet_bytes
+        self._out_packet_mutex.release()
+        if self._current_out_packet is not None:
+            out_packets += 1
+
+        self._out_message_mutex.acquire()
+        queued_messages = len(self._out_message_queue)
+        inflight_out = self._inflight_messages
+        self._out_message_mutex.release()
+
+        offline = self._offline
+        if offline is None:
+            offline_stats = (0, 0, 0, 0)
+        else:
+            offline_stats = (len(offline), offline.memory_bytes, offline.disk_bytes, offline.dropped)
+
+        return dict(
+            bytes_in = self._stats_bytes_in,
+            bytes_out = self._stats_bytes_out,
+            packets_in = _packet_counts(self._stats_packets_in),
+            packets_out = _packet_counts(self._stats_packets_out),
+            out_packets = out_packets,
+            out_packet_bytes = out_packet_bytes,
+            queued_messages = queued_messages,
+            inflight_out = inflight_out,
+            inflight_in = len(self._in_messages),
+            retries = self._stats_retries,
+            reconnects = max(self._stats_connects - 1, 0),
+            connect_attempts = self._stats_connect_attempts,
+            puback_rtt = self._puback_rtt.snapshot(),
+            pubcomp_rtt = self._pubcomp_rtt.snapshot(),
+            offline_messages = offline_stats[0],
+            offline_bytes = offline_stats[1],
+            offline_disk_bytes = offline_stats[2],
+            offline_dropped = offline_stats[3])
+
+    @property
+    def on_connect(self):
+        """If implemented, called when the broker responds to our connection
         request."""
         return self._on_connect
 
@@ -1611,6 +3257,27 @@ class Client(object):
         """
         self._on_disconnect = func
 
+    @property
+    def on_backpressure(self):
+        """If implemented, called when the outgoing packet queue crosses the
+        watermarks set with max_queued_bytes_set()."""
+        return self._on_backpressure
+
+    @on_backpressure.setter
+    def on_backpressure(self, func):
+        """ Define the backpressure callback implementation.
+
+        Expected signature is:
+            backpressure_callback(client, userdata, active)
+
+        client:     the client instance for this callback
+        userdata:   the private user data as set in Client() or userdata_set()
+        active:     True when the queued bytes have reached the high watermark
+                    and publishing should pause, False once they have drained
+                    to the low watermark.
+        """
+        self._on_backpressure = func
+
     def message_callback_add(self, sub, callback):
         """Register a message callback for a specific topic.
         Messages that match 'sub' will be passed to 'callback'. Any
@@ -1626,14 +3293,7 @@ class Client(object):
             raise ValueError("sub and callback must both be defined.")
 
         self._callback_mutex.acquire()
-
-        for i in range(0, len(self.on_message_filtered)):
-            if self.on_message_filtered[i][0] == sub:
-                self.on_message_filtered[i] = (sub, callback)
-                self._callback_mutex.release()
-                return
-
-        self.on_message_filtered.append((sub, callback))
+        self.on_message_filtered[sub] = callback
         self._callback_mutex.release()
 
     def message_callback_remove(self, sub):
@@ -1643,11 +3303,11 @@ class Client(object):
             raise ValueError("sub must defined.")
 
         self._callback_mutex.acquire()
-        for i in range(0, len(self.on_message_filtered)):
-            if self.on_message_filtered[i][0] == sub:
-                self.on_message_filtered.pop(i)
-                self._callback_mutex.release()
-                return
+        try:
+            del self.on_message_filtered[sub]
+        except KeyError:
+            # no such subscription
+            pass
         self._callback_mutex.release()
 
     # ============================================================
@@ -1676,26 +3336,19 @@ class Client(object):
             self._callback_mutex.release()
         return rc
 
-    def _packet_read(self):
-        # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        if self._in_packet['command'] == 0:
+    def _packet_fill(self):
+        # Read as much as the socket will give us into the packet reader in a
+        # single call, rather than reading the command, remaining length and
+        # payload of each packet separately.
+        if self._sock is None and self._ssl is None:
+            return MQTT_ERR_NO_CONN
+
+        while True:
             try:
                 if self._ssl:
-                    command = self._ssl.read(1)
+                    length = self._in_reader.read_from(self._ssl)
                 else:
-                    command = self._sock.recv(1)
+                    length = self._in_reader.read_from(self._sock)
             except socket.error as err:
                 if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
                     return MQTT_ERR_AGAIN
@@ -1703,95 +3356,139 @@ class Client(object):
                     return MQTT_ERR_AGAIN
                 print(err)
                 return 1
-            else:
-                if len(command) == 0:
-                    return 1
-                command = struct.unpack("!B", command)
-                self._in_packet['command'] = command[0]
-
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
-            # Algorithm for decoding taken from pseudo code at
-            # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
-            while True:
-                try:
-                    if self._ssl:
-                        byte = self._ssl.read(1)
-                    else:
-                        byte = self._sock.recv(1)
-                except socket.error as err:
-                    if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                        return MQTT_ERR_AGAIN
-                    if err.errno == EAGAIN:
-                        return MQTT_ERR_AGAIN
-                    print(err)
-                    return 1
-                else:
-                    byte = struct.unpack("!B", byte)
-                    byte = byte[0]
-                    self._in_packet['remaining_count'].append(byte)
-                    # Max 4 bytes length for remaining length as defined by protocol.
-                     # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
-                        return MQTT_ERR_PROTOCOL
-
-                    self._in_packet['remaining_length'] = self._in_packet['remaining_length'] + (byte & 127)*self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
-
-                if (byte & 128) == 0:
-                    break
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
+            if length == 0:
+                return 1
 
-        while self._in_packet['to_process'] > 0:
+            # Data already decrypted by the SSL layer, or buffered by the
+            # WebSocket wrapper, will not wake select() again, so drain it now.
+            sock = self.socket()
+            if not hasattr(sock, 'pending') or sock.pending() == 0:
+                return MQTT_ERR_SUCCESS
+
+    def _packet_read(self, max_packets=1):
+        # This gets called if select() indicates that there is network data
+        # available, or if complete packets are still buffered from an earlier
+        # call. Packets already in the reader are handled first; the socket is
+        # only read once they run out, and any trailing partial packet stays
+        # buffered until the next read. At most max_packets packets are
+        # handled (no limit if < 1), the rest wait for the next call.
+        reader = self._in_reader
+        rc = MQTT_ERR_SUCCESS
+        count = 0
+        while max_packets < 1 or count < max_packets:
+            if self._dispatcher is not None and self._dispatcher.full():
+                # Leave the rest in the reader, and on the socket, until the
+                # callbacks catch up.
+                break
             try:
-                if self._ssl:
-                    data = self._ssl.read(self._in_packet['to_process'])
-                else:
-                    data = self._sock.recv(self._in_packet['to_process'])
-            except socket.error as err:
-                if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                    return MQTT_ERR_AGAIN
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
-            else:
-                self._in_packet['to_process'] = self._in_packet['to_process'] - len(data)
-                self._in_packet['packet'] = self._in_packet['packet'] + data
-
-        # All data for this packet is read.
-        self._in_packet['pos'] = 0
-        rc = self._packet_handle()
-
-        # Free data and reset values
-        self._in_packet = dict(
-            command=0,
-            have_remaining=0,
-            remaining_count=[],
-            remaining_mult=1,
-            remaining_length=0,
-            packet=b"",
-            to_process=0,
-            pos=0)
+                packet = reader.next_packet()
+            except ValueError:
+                return MQTT_ERR_PROTOCOL
 
-        self._msgtime_mutex.acquire()
-        self._last_msg_in = time_func()
-        self._msgtime_mutex.release()
+            if packet is None:
+                rc = self._packet_fill()
+                if rc == MQTT_ERR_SUCCESS:
+                    continue
+                if rc == MQTT_ERR_AGAIN and count > 0:
+                    rc = MQTT_ERR_SUCCESS
+                break
+
+            (command, remaining_length, data) = packet
+            self._stats_packets_in[command >> 4] += 1
+            # Command byte, remaining length field and the rest of the packet.
+            self._stats_bytes_in += (2 + remaining_length + (remaining_length > 127)
+                                     + (remaining_length > 16383) + (remaining_length > 2097151))
+            self._in_packet = dict(
+                command=command,
+                remaining_length=remaining_length,
+                packet=data,
+                pos=0)
+            rc = self._packet_handle()
+            count += 1
+            if rc != MQTT_ERR_SUCCESS or self._connector is not None:
+                # A CONNACK may have started a new connection.
+                break
+        else:
+            # Only a backlog if the limit left complete packets behind.
+            if reader.has_packet():
+                self._packets_backlog = True
+
+        if count > 0:
+            self._msgtime_mutex.acquire()
+            self._last_msg_in = time_func()
+            self._msgtime_mutex.release()
         return rc
 
-    def _packet_write(self):
+    def _packet_gather(self, max_packets):
+        # Collect the current packet and those queued behind it, up to
+        # max_packets and _write_coalesce_limit bytes, so that they can go
+        # out in a single write. Returns the packets and memoryviews of their
+        # unsent bytes. A DISCONNECT is always the last packet gathered.
+        #
+        # SSL and WebSocket transports must be given the same data again
+        # after a write that did not complete, so the packets of such a
+        # write are kept in _current_out_batch and gathered again as they
+        # are until they have been written.
+        if self._current_out_batch is not None:
+            packets = self._current_out_batch
+            buffers = [memoryview(packet['packet'])[packet['pos']:] for packet in packets]
+            return (packets, buffers)
+
+        packets = [self._current_out_packet]
+        size = self._current_out_packet['to_process']
+        self._out_packet_mutex.acquire()
+        for packet in self._out_packet:
+            if (packets[-1]['command'] & 0xF0) == DISCONNECT:
+                break
+            if max_packets >= 1 and len(packets) >= max_packets:
+                break
+            # Stay well below IOV_MAX for sendmsg().
+            if len(packets) >= 512 or size + packet['to_process'] > self._write_coalesce_limit:
+                break
+            packets.append(packet)
+            size += packet['to_process']
+        self._out_packet_mutex.release()
+
+        buffers = [memoryview(packet['packet'])[packet['pos']:] for packet in packets]
+        return (packets, buffers)
+
+    def _send_buffers(self, buffers):
+        # Write a list of buffers with as few system calls as possible:
+        # sendmsg() for plain sockets where available, otherwise a single
+        # write of the joined buffers.
+        if len(buffers) == 1:
+            data = buffers[0]
+        elif self._ssl is None and hasattr(self._sock, 'sendmsg'):
+            return self._sock.sendmsg(buffers)
+        else:
+            data = b"".join(buffers)
+
+        if self._ssl:
+            return self._ssl.write(data)
+        else:
+            return self._sock.send(data)
+
+    def _packet_write(self, max_packets=0):
         self._current_out_packet_mutex.acquire()
 
+        if self._current_out_packet is None:
+            self._out_packet_mutex.acquire()
+            if len(self._out_packet) > 0:
+                self._current_out_packet = self._out_packet.popleft()
+            self._out_packet_mutex.release()
+
+        count = 0
         while self._current_out_packet:
-            packet = self._current_out_packet
+            if max_packets >= 1 and count >= max_packets:
+                self._packets_backlog = True
+                break
 
+            (packets, buffers) = self._packet_gather(max_packets - count)
+            if self._ssl is not None or not hasattr(self._sock, 'sendmsg'):
+                self._current_out_batch = packets
             try:
-                if self._ssl:
-                    write_length = self._ssl.write(packet['packet'][packet['pos']:])
-                else:
-                    write_length = self._sock.send(packet['packet'][packet['pos']:])
+                write_length = self._send_buffers(buffers)
             except (AttributeError, ValueError):
                 self._current_out_packet_mutex.release()
                 return MQTT_ERR_SUCCESS
@@ -1803,51 +3500,105 @@ class Client(object):
                     return MQTT_ERR_AGAIN
                 print(err)
                 return 1
+            finally:
+                del buffers
 
-            if write_length > 0:
-                packet['to_process'] = packet['to_process'] - write_length
-                packet['pos'] = packet['pos'] + write_length
-
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        self._callback_mutex.acquire()
-                        if self.on_publish:
-                            self._in_callback = True
-                            self.on_publish(self, self._userdata, packet['mid'])
-                            self._in_callback = False
-                        self._callback_mutex.release()
+            if write_length <= 0:
+                break
 
-                        packet['info']._set_as_published()
+            gathered = sum([packet['to_process'] for packet in packets])
+            if write_length > gathered:
+                # The transport reports more than it was given, so the
+                # stream no longer matches the queue.
+                self._current_out_packet_mutex.release()
+                self._easy_log(MQTT_LOG_ERR,
+                    "Write of %d bytes reported as %d bytes.", gathered, write_length)
+                return MQTT_ERR_PROTOCOL
 
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        self._current_out_packet_mutex.release()
+            # The bytes written complete the gathered packets in order, the
+            # last one possibly only partially.
+            completed = 0
+            completed_bytes = 0
+            for packet in packets:
+                if write_length == 0:
+                    break
+                written = min(write_length, packet['to_process'])
+                write_length -= written
+                packet['to_process'] = packet['to_process'] - written
+                packet['pos'] = packet['pos'] + written
 
-                        self._msgtime_mutex.acquire()
-                        self._last_msg_out = time_func()
-                        self._msgtime_mutex.release()
+                if packet['to_process'] > 0:
+                    break
 
+                count += 1
+                completed += 1
+                completed_bytes += len(packet['packet'])
+                self._stats_packets_out[packet['command'] >> 4] += 1
+                self._stats_bytes_out += len(packet['packet'])
+                if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
+                    if self.on_publish:
                         self._callback_mutex.acquire()
-                        if self.on_disconnect:
+                        if self.on_publish:
                             self._in_callback = True
-                            self.on_disconnect(self, self._userdata, 0)
+                            self.on_publish(self, self._userdata, packet['mid'])
                             self._in_callback = False
                         self._callback_mutex.release()
 
-                        if self._ssl:
-                            self._ssl.close()
-                            self._ssl = None
-                        if self._sock:
-                            self._sock.close()
-                            self._sock = None
-                        return MQTT_ERR_SUCCESS
+                    packet['info']._set_as_published()
 
+                if (packet['command'] & 0xF0) == DISCONNECT:
+                    # Leave the DISCONNECT as the current packet, with those
+                    # written before it off the queue.
+                    self._current_out_batch = None
                     self._out_packet_mutex.acquire()
+                    for i in range(completed - 1):
+                        self._current_out_packet = self._out_packet.popleft()
+                    backpressure = self._out_packet_bytes_update(len(packet['packet']) - completed_bytes)
+                    self._out_packet_mutex.release()
+                    self._current_out_packet_mutex.release()
+                    if backpressure is not None:
+                        self._do_on_backpressure(backpressure)
+
+                    self._msgtime_mutex.acquire()
+                    self._last_msg_out = time_func()
+                    self._msgtime_mutex.release()
+
+                    self._callback_mutex.acquire()
+                    if self.on_disconnect:
+                        self._in_callback = True
+                        self.on_disconnect(self, self._userdata, 0)
+                        self._in_callback = False
+                    self._callback_mutex.release()
+
+                    if self._ssl:
+                        self._ssl.close()
+                        self._ssl = None
+                    if self._sock:
+                        self._sock.close()
+                        self._sock = None
+                    return MQTT_ERR_SUCCESS
+
+            if completed:
+                # The gathered packets after the current one are still at
+                # the front of the queue; take the completed ones off it,
+                # and the next one to write, in one go.
+                self._out_packet_mutex.acquire()
+                for i in range(completed):
                     if len(self._out_packet) > 0:
-                        self._current_out_packet = self._out_packet.pop(0)
+                        self._current_out_packet = self._out_packet.popleft()
                     else:
                         self._current_out_packet = None
-                    self._out_packet_mutex.release()
-            else:
+                backpressure = self._out_packet_bytes_update(-completed_bytes)
+                self._out_packet_mutex.release()
+                if backpressure is not None:
+                    self._do_on_backpressure(backpressure)
+
+            if self._current_out_batch is not None:
+                # Only the packets not yet written are gathered again.
+                self._current_out_batch = packets[completed:] or None
+
+            if packets[-1]['to_process'] > 0:
+                # Short write, the socket buffer is full.
                 break
 
         self._current_out_packet_mutex.release()
@@ -1858,11 +3609,23 @@ class Client(object):
 
         return MQTT_ERR_SUCCESS
 
-    def _easy_log(self, level, buf):
+    def _easy_log(self, level, fmt, *args):
+        # The message is only formatted if someone is going to see it.
+        if self.on_log is None and (
+                self._logger is None or not self._logger.isEnabledFor(LOGGING_LEVEL[level])):
+            return
+        if args:
+            buf = fmt % args
+        else:
+            buf = fmt
         if self.on_log:
             self.on_log(self, self._userdata, level, buf)
+        if self._logger is not None:
+            self._logger.log(LOGGING_LEVEL[level], buf)
 
     def _check_keepalive(self):
+        # Called when the keepalive timer expires. Traffic since it was armed
+        # only pushes the deadline back, so just re-arm it if nothing is due.
         if self._keepalive == 0:
             return MQTT_ERR_SUCCESS
 
@@ -1871,13 +3634,18 @@ class Client(object):
         last_msg_out = self._last_msg_out
         last_msg_in = self._last_msg_in
         self._msgtime_mutex.release()
-        if (self._sock is not None or self._ssl is not None) and (now - last_msg_out >= self._keepalive or now - last_msg_in >= self._keepalive):
+        if self._sock is None and self._ssl is None:
+            return MQTT_ERR_SUCCESS
+        if now - last_msg_out < self._keepalive and now - last_msg_in < self._keepalive:
+            self._timers.schedule('keepalive', min(last_msg_out, last_msg_in) + self._keepalive)
+        else:
             if self._state == mqtt_cs_connected and self._ping_t == 0:
                 self._send_pingreq()
                 self._msgtime_mutex.acquire()
                 self._last_msg_out = now
                 self._last_msg_in = now
                 self._msgtime_mutex.release()
+                self._timers.schedule('keepalive', now + self._keepalive)
             else:
                 if self._ssl:
                     self._ssl.close()
@@ -1897,11 +3665,90 @@ class Client(object):
                     self._in_callback = False
                 self._callback_mutex.release()
 
+    def _check_pingresp(self, now):
+        # Called when the PINGRESP timer expires.
+        if self._ping_t == 0:
+            # PINGRESP has arrived.
+            return MQTT_ERR_SUCCESS
+        if now - self._ping_t < self._keepalive:
+            self._timers.schedule('pingresp', self._ping_t + self._keepalive)
+            return MQTT_ERR_SUCCESS
+
+        # client->ping_t != 0 means we are waiting for a pingresp.
+        # This hasn't happened in the keepalive time so we should disconnect.
+        if self._ssl:
+            self._ssl.close()
+            self._ssl = None
+        elif self._sock:
+            self._sock.close()
+            self._sock = None
+
+        self._callback_mutex.acquire()
+        if self._state == mqtt_cs_disconnecting:
+            rc = MQTT_ERR_SUCCESS
+        else:
+            rc = 1
+        if self.on_disconnect:
+            self._in_callback = True
+            self.on_disconnect(self, self._userdata, rc)
+            self._in_callback = False
+        self._callback_mutex.release()
+        return MQTT_ERR_CONN_LOST
+
+    def _publish_check(self, topic, payload, qos, retain):
+        # Validate the arguments of a publish. Returns (topic, payload, qos,
+        # retain) with the payload in the form _send_publish() takes, and
+        # qos and retain taken from topic if it is a PreparedTopic.
+        if isinstance(topic, PreparedTopic):
+            qos = topic.qos
+            retain = topic.retain
+        else:
+            if topic is None or len(topic) == 0:
+                raise ValueError('Invalid topic.')
+            if qos<0 or qos>2:
+                raise ValueError('Invalid QoS level.')
+            if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+                raise ValueError('Publish topic cannot contain wildcards.')
+
+        if isinstance(payload, (str, bytes, bytearray)):
+            # Kept by reference, not copied.
+            local_payload = payload
+        elif isinstance(payload, memoryview):
+            if sys.version_info[0] >= 3 and (payload.ndim != 1 or payload.itemsize != 1):
+                # len() must be the length in bytes. Raises TypeError if the
+                # buffer is not contiguous.
+                payload = payload.cast('B')
+            local_payload = payload
+        elif sys.version_info[0] < 3 and isinstance(payload, unicode):
+            local_payload = payload
+        elif isinstance(payload, int) or isinstance(payload, float):
+            local_payload = str(payload)
+        elif payload is None:
+            local_payload = None
+        else:
+            raise TypeError('payload must be a string, bytes, bytearray, memoryview, int, float or None.')
+
+        if local_payload is not None and len(local_payload) > 268435455:
+            raise ValueError('Payload too large.')
+
+        return (topic, local_payload, qos, retain)
+
     def _mid_generate(self):
+        # Called from publish(), publish_many(), subscribe() and the offline
+        # queue, with or without _out_message_mutex held, so it has a lock of
+        # its own that is never held while taking another.
+        self._mid_generate_mutex.acquire()
         self._last_mid = self._last_mid + 1
         if self._last_mid == 65536:
             self._last_mid = 1
-        return self._last_mid
+        # Don't hand out a mid that is still in flight after wrapping around.
+        while self._last_mid in self._out_messages and len(self._out_messages) < 65535:
+            self._last_mid = self._last_mid + 1
+            if self._last_mid == 65536:
+                self._last_mid = 1
+        mid = self._last_mid
+        self._mid_generate_mutex.release()
+        return mid
 
     def _topic_wildcard_len_check(self, topic):
         # Search for + or # in a topic. Return MQTT_ERR_INVAL if found.
@@ -1917,6 +3764,7 @@ class Client(object):
         rc = self._send_simple_command(PINGREQ)
         if rc == MQTT_ERR_SUCCESS:
             self._ping_t = time_func()
+            self._timers.schedule('pingresp', self._ping_t + self._keepalive)
         return rc
 
     def _send_pingresp(self):
@@ -1924,41 +3772,26 @@ class Client(object):
         return self._send_simple_command(PINGRESP)
 
     def _send_puback(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBACK (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBACK (Mid: %d)", mid)
         return self._send_command_with_mid(PUBACK, mid, False)
 
     def _send_pubcomp(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBCOMP (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBCOMP (Mid: %d)", mid)
         return self._send_command_with_mid(PUBCOMP, mid, False)
 
     def _pack_remaining_length(self, packet, remaining_length):
-        remaining_bytes = []
-        while True:
-            byte = remaining_length % 128
-            remaining_length = remaining_length // 128
-            # If there are more digits to encode, set the top bit of this digit
-            if remaining_length > 0:
-                byte = byte | 0x80
-
-            remaining_bytes.append(byte)
-            packet.extend(struct.pack("!B", byte))
-            if remaining_length == 0:
-                # FIXME - this doesn't deal with incorrectly large payloads
-                return packet
+        # FIXME - this doesn't deal with incorrectly large payloads
+        return _append_remaining_length(packet, remaining_length)
 
     def _pack_str16(self, packet, data):
         if sys.version_info[0] < 3:
             if isinstance(data, bytearray):
                 packet.extend(struct.pack("!H", len(data)))
                 packet.extend(data)
-            elif isinstance(data, str):
-                udata = data.encode('utf-8')
-                pack_format = "!H" + str(len(udata)) + "s"
-                packet.extend(struct.pack(pack_format, len(udata), udata))
-            elif isinstance(data, unicode):
+            elif isinstance(data, str) or isinstance(data, unicode):
                 udata = data.encode('utf-8')
-                pack_format = "!H" + str(len(udata)) + "s"
-                packet.extend(struct.pack(pack_format, len(udata), udata))
+                packet.extend(struct.pack("!H", len(udata)))
+                packet.extend(udata)
             else:
                 raise TypeError
         else:
@@ -1967,8 +3800,8 @@ class Client(object):
                 packet.extend(data)
             elif isinstance(data, str):
                 udata = data.encode('utf-8')
-                pack_format = "!H" + str(len(udata)) + "s"
-                packet.extend(struct.pack(pack_format, len(udata), udata))
+                packet.extend(struct.pack("!H", len(udata)))
+                packet.extend(udata)
             else:
                 raise TypeError
 
@@ -1976,25 +3809,38 @@ class Client(object):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
+        packet = bytearray()
+        self._encode_publish(packet, mid, topic, payload, qos, retain, dup)
+
+        if qos > 0:
+            if not dup:
+                self._publish_sent[mid] = time_func()
+            self._message_retry_schedule('out', mid)
+        return self._packet_queue(PUBLISH, packet, mid, qos, info)
+
+    def _encode_publish(self, packet, mid, topic, payload, qos, retain, dup):
+        # Append a PUBLISH packet to the bytearray packet. topic may be a
+        # PreparedTopic, in which case qos and retain must match it.
+        if isinstance(topic, PreparedTopic):
+            if payload is None:
+                self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d%d, q%d, r%d, m%d, '%s' (NULL payload)", dup, qos, retain, mid, topic.topic)
+            else:
+                payload = _payload_bytes(payload)
+                self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d%d, q%d, r%d, m%d, '%s', ... (%d bytes)", dup, qos, retain, mid, topic.topic, len(payload))
+            topic._encode(packet, mid, payload, dup)
+            return
+
         utopic = topic.encode('utf-8')
         command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
-        packet = bytearray()
         packet.extend(struct.pack("!B", command))
         if payload is None:
             remaining_length = 2+len(utopic)
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d%d, q%d, r%d, m%d, '%s' (NULL payload)", dup, qos, retain, mid, topic)
         else:
-            if isinstance(payload, str):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-            elif isinstance(payload, bytearray):
-                payloadlen = len(payload)
-            elif isinstance(payload, unicode):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-
+            payload = _payload_bytes(payload)
+            payloadlen = len(payload)
             remaining_length = 2+len(utopic) + payloadlen
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d%d, q%d, r%d, m%d, '%s', ... (%d bytes)", dup, qos, retain, mid, topic, payloadlen)
 
         if qos > 0:
             # For message id
@@ -2008,25 +3854,16 @@ class Client(object):
             packet.extend(struct.pack("!H", mid))
 
         if payload is not None:
-            if isinstance(payload, str):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            elif isinstance(payload, bytearray):
-                packet.extend(payload)
-            elif isinstance(payload, unicode):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            else:
-                raise TypeError('payload must be a string, unicode or a bytearray.')
-
-        return self._packet_queue(PUBLISH, packet, mid, qos, info)
+            packet.extend(payload)
 
     def _send_pubrec(self, mid):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: %d)", mid)
+        self._message_retry_schedule('in', mid)
         return self._send_command_with_mid(PUBREC, mid, False)
 
     def _send_pubrel(self, mid, dup=False):
-        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREL (Mid: %d)", mid)
+        self._message_retry_schedule('out', mid)
         return self._send_command_with_mid(PUBREL|2, mid, dup)
 
     def _send_command_with_mid(self, command, mid, dup):
@@ -2130,33 +3967,49 @@ class Client(object):
             self._pack_str16(packet, t)
         return (self._packet_queue(command, packet, local_mid, 1), local_mid)
 
-    def _message_retry_check_actual(self, messages, mutex):
+    def _message_retry_schedule(self, direction, mid):
+        # Arm the retry timer for a message that is now waiting for a reply
+        # from the broker. A timer that is already armed is left alone; when it
+        # expires _message_retry_check() works out the real deadline.
+        self._timers.schedule((direction, mid), time_func() + max(self._message_retry, 1))
+
+    def _message_retry_check(self, key, messages, mutex, now):
+        # Called when the retry timer of a single message expires.
         mutex.acquire()
-        now = time_func()
-        for m in messages:
-            if m.timestamp + self._message_retry < now:
-                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                elif m.state == mqtt_ms_wait_for_pubrel:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrec(m.mid)
-                elif m.state == mqtt_ms_wait_for_pubcomp:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrel(m.mid, True)
+        m = messages.get(key[1])
+        if m is None:
+            mutex.release()
+            return
+
+        if (m.state != mqtt_ms_wait_for_puback and m.state != mqtt_ms_wait_for_pubrec
+                and m.state != mqtt_ms_wait_for_pubrel and m.state != mqtt_ms_wait_for_pubcomp):
+            # Not waiting on the broker; the timer is armed again when the
+            # message is (re)sent.
+            mutex.release()
+            return
+
+        deadline = m.timestamp + max(self._message_retry, 1)
+        if deadline > now:
+            self._timers.schedule(key, deadline)
+            mutex.release()
+            return
+
+        m.timestamp = now
+        m.dup = True
+        self._stats_retries += 1
+        if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+            self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+        elif m.state == mqtt_ms_wait_for_pubrel:
+            self._send_pubrec(m.mid)
+        elif m.state == mqtt_ms_wait_for_pubcomp:
+            self._send_pubrel(m.mid, True)
         mutex.release()
 
-    def _message_retry_check(self):
-        self._message_retry_check_actual(self._out_messages, self._out_message_mutex)
-        self._message_retry_check_actual(self._in_messages, self._in_message_mutex)
-
     def _messages_reconnect_reset_out(self):
         self._out_message_mutex.acquire()
         self._inflight_messages = 0
-        for m in self._out_messages:
+        self._out_message_queue.clear()
+        for m in self._out_messages.values():
             m.timestamp = 0
             if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                 if m.qos == 0:
@@ -2177,14 +4030,15 @@ class Client(object):
                         m.state = mqtt_ms_publish
             else:
                 m.state = mqtt_ms_queued
+                self._out_message_queue.append(m)
         self._out_message_mutex.release()
 
     def _messages_reconnect_reset_in(self):
         self._in_message_mutex.acquire()
-        for m in self._in_messages:
+        for m in list(self._in_messages.values()):
             m.timestamp = 0
             if m.qos != 2:
-                self._in_messages.pop(self._in_messages.index(m))
+                self._in_messages.pop(m.mid)
             else:
                 # Preserve current state
                 pass
@@ -2194,34 +4048,188 @@ class Client(object):
         self._messages_reconnect_reset_out()
         self._messages_reconnect_reset_in()
 
-    def _packet_queue(self, command, packet, mid, qos, info=None):
-        mpkt = dict(
-            command = command,
-            mid = mid,
-            qos = qos,
-            pos = 0,
-            to_process = len(packet),
-            packet = packet,
-            info = info)
+    def _out_packet_bytes_update(self, delta):
+        # Account for delta bytes entering (>0) or leaving (<0) the outgoing
+        # packet queue. Must be called with _out_packet_mutex held. Returns
+        # the new backpressure state if a watermark was crossed, else None.
+        self._out_packet_bytes = self._out_packet_bytes + delta
+        if self._out_backpressure:
+            if self._out_packet_bytes <= self._out_packet_low_watermark or self._out_packet_high_watermark == 0:
+                self._out_backpressure = False
+                self._out_packet_cond.notify_all()
+                return False
+        elif self._out_packet_high_watermark > 0 and self._out_packet_bytes >= self._out_packet_high_watermark:
+            self._out_backpressure = True
+            return True
+        return None
 
-        self._out_packet_mutex.acquire()
-        self._out_packet.append(mpkt)
-        if self._current_out_packet_mutex.acquire(False):
-            if self._current_out_packet is None and len(self._out_packet) > 0:
-                self._current_out_packet = self._out_packet.pop(0)
-            self._current_out_packet_mutex.release()
-        self._out_packet_mutex.release()
+    def _do_on_backpressure(self, active):
+        # May be reached from publish() inside another callback, so restore
+        # rather than clear _in_callback afterwards.
+        self._callback_mutex.acquire()
+        if self.on_backpressure:
+            in_callback = self._in_callback
+            self._in_callback = True
+            self.on_backpressure(self, self._userdata, active)
+            self._in_callback = in_callback
+        self._callback_mutex.release()
 
-        # Write a single byte to sockpairW (connected to sockpairR) to break
-        # out of select() if in threaded mode.
+    def _wake(self):
+        # Break out of select() in the network loop, unless a wakeup is
+        # already on its way.
+        if self._wake_pending:
+            return
+        self._wake_pending = True
+        self._wake_send()
+
+    def _wake_send(self):
+        # Write a single byte to sockpairW (connected to sockpairR).
         try:
             self._sockpairW.send(sockpair_data)
         except socket.error as err:
             if err.errno != EAGAIN:
                 raise
 
-        if not self._in_callback and self._thread is None:
-            return self.loop_write()
+    def _offline_connected(self):
+        return self.is_connected()
+
+    def _offline_publish(self, topic, payload, qos, retain):
+        # Put a message in the offline queue if it can't be sent now, or has
+        # to wait for messages queued before it. Returns its MQTTMessageInfo,
+        # or None if it should be sent straight away.
+        self._offline_mutex.acquire()
+        if len(self._offline) == 0 and self._offline_connected():
+            self._offline_mutex.release()
+            return None
+        mid = self._mid_generate()
+        info = MQTTMessageInfo(mid)
+        dropped = self._offline.put(mid, topic, payload, qos, retain, info)
+        self._offline.dropped = self._offline.dropped + len(dropped)
+        self._offline_mutex.release()
+
+        for entry in dropped:
+            self._easy_log(MQTT_LOG_WARNING, "Offline queue full, dropping message (m%d)", entry[1])
+            if entry[6] is not None:
+                entry[6].rc = MQTT_ERR_QUEUE_SIZE
+                entry[6]._set_as_published()
+
+        if self._offline_connected():
+            if not self._loop_threaded():
+                self._offline_drain()
+                if not self._in_callback:
+                    self.loop_write(0)
+            elif self._in_loop_thread():
+                self._offline_drain()
+            else:
+                # Let the network thread send it.
+                self._wake()
+        return info
+
+    def _offline_drain(self):
+        # Send messages from the offline queue, oldest first, while the
+        # inflight window and the outgoing packet queue have room. Only
+        # called from the thread running the network loop.
+        offline = self._offline
+        if offline is None or len(offline) == 0:
+            return
+
+        in_callback = self._in_callback
+        # Don't call loop_write() after each message.
+        self._in_callback = True
+        self._offline_mutex.acquire()
+        try:
+            while len(offline) > 0 and self._offline_connected():
+                if self._out_packet_bytes >= self._write_coalesce_limit or self._out_backpressure:
+                    break
+                if self._max_inflight_messages > 0 and self._inflight_messages >= self._max_inflight_messages:
+                    break
+
+                entry = offline.popleft()
+                (seq, mid, topic, payload, qos, retain, info, size) = entry
+                if qos > 0 and self._max_queued_messages > 0 and len(self._out_messages) >= self._max_queued_messages:
+                    # Keep it first in line until acknowledgements make room.
+                    offline.appendleft(entry)
+                    break
+                if mid in self._out_messages:
+                    mid = self._mid_generate()
+                    if info is not None:
+                        info.mid = mid
+                # Not held while publishing, as an on_backpressure callback
+                # may publish from this thread.
+                self._offline_mutex.release()
+                try:
+                    self._publish_message(mid, topic, payload, qos, retain, info)
+                finally:
+                    self._offline_mutex.acquire()
+        finally:
+            self._offline_mutex.release()
+            self._in_callback = in_callback
+
+    def _wait_for_backpressure(self):
+        # Returns MQTT_ERR_SUCCESS once the outgoing queue has room for
+        # another publish, or MQTT_ERR_BACKPRESSURE if the caller should not
+        # (or cannot) wait for it to drain.
+        if not self._out_backpressure:
+            return MQTT_ERR_SUCCESS
+        # Only wait if another thread is draining the queue.
+        if (self._out_packet_nonblocking or not self._loop_threaded() or self._in_loop_thread()
+                or (self._loop_external and self._loop_external_thread is None)):
+            return MQTT_ERR_BACKPRESSURE
+
+        # Stop waiting if the loop goes away, since nothing would drain the
+        # queue then.
+        self._out_packet_mutex.acquire()
+        while self._out_backpressure and self._loop_threaded() and not self._thread_terminate:
+            self._out_packet_cond.wait(1.0)
+        backpressure = self._out_backpressure
+        self._out_packet_mutex.release()
+        if backpressure:
+            return MQTT_ERR_BACKPRESSURE
+        return MQTT_ERR_SUCCESS
+
+    def _loop_threaded(self):
+        # The network loop runs in a thread of its own, started by
+        # loop_start() or announced with loop_external_set().
+        return self._thread is not None or self._loop_external
+
+    def _in_loop_thread(self):
+        current = threading.current_thread()
+        return current == self._thread or current == self._loop_external_thread
+
+    def _packet_queue(self, command, packet, mid, qos, info=None):
+        return self._packet_queue_many(((command, packet, mid, qos, info),))
+
+    def _packet_queue_many(self, packets):
+        # Queue (command, packet, mid, qos, info) tuples for sending, taking
+        # the queue lock and waking the network loop once for all of them.
+        size = 0
+        self._out_packet_mutex.acquire()
+        for (command, packet, mid, qos, info) in packets:
+            self._out_packet.append(dict(
+                command = command,
+                mid = mid,
+                qos = qos,
+                pos = 0,
+                to_process = len(packet),
+                packet = packet,
+                info = info))
+            size += len(packet)
+        backpressure = self._out_packet_bytes_update(size)
+        # The packets are taken from the queue by _packet_write(). loop()
+        # only needs waking if it is waiting in select() and hasn't been
+        # woken already.
+        wake = not self._loop_busy and not self._wake_pending
+        if wake:
+            self._wake_pending = True
+        self._out_packet_mutex.release()
+        if backpressure is not None:
+            self._do_on_backpressure(backpressure)
+
+        if wake:
+            self._wake_send()
+
+        if not self._in_callback and not self._loop_threaded():
+            return self.loop_write(0)
         else:
             return MQTT_ERR_SUCCESS
 
@@ -2249,7 +4257,7 @@ class Client(object):
             return self._handle_unsuback()
         else:
             # If we don't recognise the command, return an error straight away.
-            self._easy_log(MQTT_LOG_ERR, "Error: Unrecognised command "+str(cmd))
+            self._easy_log(MQTT_LOG_ERR, "Error: Unrecognised command %s", cmd)
             return MQTT_ERR_PROTOCOL
 
     def _handle_pingreq(self):
@@ -2280,15 +4288,25 @@ class Client(object):
 
         (flags, result) = struct.unpack("!BB", self._in_packet['packet'])
         if result == CONNACK_REFUSED_PROTOCOL_VERSION and self._protocol == MQTTv311:
-            self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK ("+str(flags)+", "+str(result)+"), attempting downgrade to MQTT v3.1.")
-            # Downgrade to MQTT v3.1
+            self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK (%s, %s), attempting downgrade to MQTT v3.1.", flags, result)
+            # Downgrade to MQTT v3.1. The new connection is completed by
+            # loop(), or whatever else drives the network loop, rather than
+            # blocking it here.
             self._protocol = MQTTv31
-            return self.reconnect()
+            try:
+                self.reconnect_start()
+            except socket.error as err:
+                self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying: %s", err)
+                return MQTT_ERR_NO_CONN
+            return MQTT_ERR_SUCCESS
 
         if result == 0:
             self._state = mqtt_cs_connected
+            self._reconnect_failures = 0
+            self._stats_connects += 1
+            self._tls_session_save()
 
-        self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK ("+str(flags)+", "+str(result)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK (%s, %s)", flags, result)
         self._callback_mutex.acquire()
         if self.on_connect:
             self._in_callback = True
@@ -2309,10 +4327,10 @@ class Client(object):
         if result == 0:
             rc = 0
             self._out_message_mutex.acquire()
-            for m in self._out_messages:
+            for m in self._out_messages.values():
                 m.timestamp = time_func()
                 if m.state == mqtt_ms_queued:
-                    self.loop_write() # Process outgoing messages that have just been queued up
+                    self.loop_write(0) # Process outgoing messages that have just been queued up
                     self._out_message_mutex.release()
                     return MQTT_ERR_SUCCESS
 
@@ -2352,7 +4370,7 @@ class Client(object):
                         if rc != 0:
                             self._out_message_mutex.release()
                             return rc
-                self.loop_write() # Process outgoing messages that have just been queued up
+                self.loop_write(0) # Process outgoing messages that have just been queued up
             self._out_message_mutex.release()
             return rc
         elif result > 0 and result < 6:
@@ -2385,29 +4403,35 @@ class Client(object):
         message.qos = (header & 0x06)>>1
         message.retain = (header & 0x01)
 
-        pack_format = "!H" + str(len(self._in_packet['packet'])-2) + 's'
-        (slen, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = '!' + str(slen) + 's' + str(len(packet)-slen) + 's'
-        (message.topic, packet) = struct.unpack(pack_format, packet)
-
-        if len(message.topic) == 0:
+        packet = self._in_packet['packet']
+        if len(packet) < 2:
+            return MQTT_ERR_PROTOCOL
+        (slen,) = struct.unpack_from("!H", packet)
+        pos = 2 + slen
+        if slen == 0 or len(packet) < pos:
             return MQTT_ERR_PROTOCOL
 
+        message.topic = packet[2:pos]
         if sys.version_info[0] >= 3:
             message.topic = message.topic.decode('utf-8')
 
         if message.qos > 0:
-            pack_format = "!H" + str(len(packet)-2) + 's'
-            (message.mid, packet) = struct.unpack(pack_format, packet)
+            if len(packet) < pos + 2:
+                return MQTT_ERR_PROTOCOL
+            (message.mid,) = struct.unpack_from("!H", packet, pos)
+            pos = pos + 2
 
-        message.payload = packet
+        # The payload refers to the packet rather than copying it out.
+        if self._payload_bytes:
+            message.payload = packet[pos:]
+        else:
+            message.payload = memoryview(packet)[pos:]
 
         self._easy_log(
             MQTT_LOG_DEBUG,
-            "Received PUBLISH (d"+str(message.dup)+
-            ", q"+str(message.qos)+", r"+str(message.retain)+
-            ", m"+str(message.mid)+", '"+message.topic+
-            "', ...  ("+str(len(message.payload))+" bytes)")
+            "Received PUBLISH (d%d, q%d, r%d, m%d, '%s', ...  (%d bytes)",
+            message.dup, message.qos, message.retain, message.mid,
+            message.topic, len(message.payload))
 
         message.timestamp = time_func()
         if message.qos == 0:
@@ -2418,12 +4442,15 @@ class Client(object):
             self._handle_on_message(message)
             return rc
         elif message.qos == 2:
-            rc = self._send_pubrec(message.mid)
             message.state = mqtt_ms_wait_for_pubrel
             self._in_message_mutex.acquire()
-            self._in_messages.append(message)
+            self._in_messages[message.mid] = message
+            if self._store is not None:
+                # Stored before the PUBREC, so that a restart can't lead to
+                # the message being delivered twice or not at all.
+                self._store.put('in', message)
             self._in_message_mutex.release()
-            return rc
+            return self._send_pubrec(message.mid)
         else:
             return MQTT_ERR_PROTOCOL
 
@@ -2437,46 +4464,48 @@ class Client(object):
 
         mid = struct.unpack("!H", self._in_packet['packet'])
         mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: %d)", mid)
 
         self._in_message_mutex.acquire()
-        for i in range(len(self._in_messages)):
-            if self._in_messages[i].mid == mid:
-
-                # Only pass the message on if we have removed it from the queue - this
-                # prevents multiple callbacks for the same message.
-                self._handle_on_message(self._in_messages[i])
-                self._in_messages.pop(i)
-                self._inflight_messages = self._inflight_messages - 1
-                if self._max_inflight_messages > 0:
-                    self._out_message_mutex.acquire()
-                    rc = self._update_inflight()
-                    self._out_message_mutex.release()
-                    if rc != MQTT_ERR_SUCCESS:
-                        self._in_message_mutex.release()
-                        return rc
+        message = self._in_messages.get(mid)
+        if message is not None:
+            # Only pass the message on if we have removed it from the queue - this
+            # prevents multiple callbacks for the same message.
+            self._handle_on_message(message)
+            del self._in_messages[mid]
+            if self._store is not None:
+                self._store.delete('in', mid)
+            self._inflight_messages = self._inflight_messages - 1
+            if self._max_inflight_messages > 0:
+                self._out_message_mutex.acquire()
+                rc = self._update_inflight()
+                self._out_message_mutex.release()
+                if rc != MQTT_ERR_SUCCESS:
+                    self._in_message_mutex.release()
+                    return rc
 
-                self._in_message_mutex.release()
-                return self._send_pubcomp(mid)
+            self._in_message_mutex.release()
+            return self._send_pubcomp(mid)
 
         self._in_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
     def _update_inflight(self):
         # Dont lock message_mutex here
-        for m in self._out_messages:
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages = self._inflight_messages + 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                    if rc != 0:
-                        return rc
-            else:
-                return MQTT_ERR_SUCCESS
+        while len(self._out_message_queue) > 0 and self._inflight_messages < self._max_inflight_messages:
+            m = self._out_message_queue.popleft()
+            if m.state != mqtt_ms_queued or self._out_messages.get(m.mid) is not m:
+                # Already sent or acknowledged since it was queued.
+                continue
+
+            self._inflight_messages = self._inflight_messages + 1
+            if m.qos == 1:
+                m.state = mqtt_ms_wait_for_puback
+            elif m.qos == 2:
+                m.state = mqtt_ms_wait_for_pubrec
+            rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+            if rc != 0:
+                return rc
         return MQTT_ERR_SUCCESS
 
     def _handle_pubrec(self):
@@ -2486,15 +4515,17 @@ class Client(object):
 
         mid = struct.unpack("!H", self._in_packet['packet'])
         mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: %d)", mid)
 
         self._out_message_mutex.acquire()
-        for m in self._out_messages:
-            if m.mid == mid:
-                m.state = mqtt_ms_wait_for_pubcomp
-                m.timestamp = time_func()
-                self._out_message_mutex.release()
-                return self._send_pubrel(mid, False)
+        m = self._out_messages.get(mid)
+        if m is not None:
+            m.state = mqtt_ms_wait_for_pubcomp
+            m.timestamp = time_func()
+            if self._store is not None:
+                self._store.set_state('out', mid, m.state)
+            self._out_message_mutex.release()
+            return self._send_pubrel(mid, False)
 
         self._out_message_mutex.release()
         return MQTT_ERR_SUCCESS
@@ -2506,7 +4537,7 @@ class Client(object):
 
         mid = struct.unpack("!H", self._in_packet['packet'])
         mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received UNSUBACK (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Received UNSUBACK (Mid: %d)", mid)
         self._callback_mutex.acquire()
         if self.on_unsubscribe:
             self._in_callback = True
@@ -2515,7 +4546,7 @@ class Client(object):
         self._callback_mutex.release()
         return MQTT_ERR_SUCCESS
 
-    def _do_on_publish(self, idx, mid):
+    def _do_on_publish(self, mid):
         with self._callback_mutex:
             if self.on_publish:
                 self._out_message_mutex.release()
@@ -2524,8 +4555,13 @@ class Client(object):
                 self._in_callback = False
                 self._out_message_mutex.acquire()
 
-        msg = self._out_messages.pop(idx)
+        msg = self._out_messages.pop(mid, None)
+        if msg is None:
+            # Acknowledged again while on_publish was running.
+            return MQTT_ERR_SUCCESS
         if msg.qos > 0:
+            if self._store is not None:
+                self._store.delete('out', mid)
             self._inflight_messages = self._inflight_messages - 1
             if self._max_inflight_messages > 0:
                 rc = self._update_inflight()
@@ -2541,33 +4577,42 @@ class Client(object):
 
         mid = struct.unpack("!H", self._in_packet['packet'])
         mid = mid[0]
-        self._easy_log(MQTT_LOG_DEBUG, "Received "+cmd+" (Mid: "+str(mid)+")")
+        self._easy_log(MQTT_LOG_DEBUG, "Received %s (Mid: %d)", cmd, mid)
 
         self._out_message_mutex.acquire()
-        for i in range(len(self._out_messages)):
-            try:
-                if self._out_messages[i].mid == mid:
-                    # Only inform the client the message has been sent once.
-                    rc = self._do_on_publish(i, mid)
-                    self._out_message_mutex.release()
-                    return rc
-            except IndexError:
-                # Have removed item so i>count.
-                # Not really an error.
-                pass
+        if mid in self._out_messages:
+            sent = self._publish_sent.pop(mid, None)
+            if sent is not None:
+                if cmd == "PUBACK":
+                    self._puback_rtt.add(time_func() - sent)
+                else:
+                    self._pubcomp_rtt.add(time_func() - sent)
+            # Only inform the client the message has been sent once.
+            rc = self._do_on_publish(mid)
+            self._out_message_mutex.release()
+            return rc
 
         self._out_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
     def _handle_on_message(self, message):
         self._callback_mutex.acquire()
+        dispatcher = self._dispatcher
+        if dispatcher is not None:
+            callbacks = self.on_message_filtered.match(message.topic)
+            if not callbacks and self.on_message:
+                callbacks = (self.on_message,)
+            self._callback_mutex.release()
+            if callbacks:
+                dispatcher.put(self, self._userdata, callbacks, message)
+            return
+
         matched = False
-        for t in self.on_message_filtered:
-            if topic_matches_sub(t[0], message.topic):
-                self._in_callback = True
-                t[1](self, self._userdata, message)
-                self._in_callback = False
-                matched = True
+        for callback in self.on_message_filtered.match(message.topic):
+            self._in_callback = True
+            callback(self, self._userdata, message)
+            self._in_callback = False
+            matched = True
 
         if matched == False and self.on_message:
             self._in_callback = True
@@ -2579,6 +4624,18 @@ class Client(object):
     def _thread_main(self):
         self.loop_forever(retry_first_connection=True)
 
+    def _tls_session_save(self):
+        # Called once the broker has accepted the connection, by when any
+        # TLS 1.3 session ticket sent after the handshake has been read.
+        if self._tls_context is None or not HAVE_SSL_SESSION:
+            return
+        sock = self._ssl
+        if isinstance(sock, WebsocketWrapper):
+            sock = sock._socket
+        if sock is None or sock.session is None:
+            return
+        _tls_session_put(self._tls_context, self._host, self._port, sock.session)
+
     def _host_matches_cert(self, host, cert_host):
         if cert_host[0:2] == "*.":
             if cert_host.count("*") != 1:
@@ -2635,6 +4692,44 @@ class Mosquitto(Client):
     def __init__(self, client_id="", clean_session=True, userdata=None):
         super(Mosquitto, self).__init__(client_id, clean_session, userdata)
 
+# numpy, False if it isn't available, or None until a payload large enough
+# to use it has been masked. It is imported on demand so that it doesn't add
+# to the start-up time of short-lived processes such as AWS Lambda functions.
+_numpy = None
+
+
+def _websocket_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+
+def _websocket_mask(mask_key, data):
+    """Return data XORed with the repeating 4 byte mask_key (RFC 6455 5.3).
+
+    The payload is treated as one big integer so the XOR runs in C a machine
+    word at a time instead of once per byte in Python."""
+    length = len(data)
+    if length == 0:
+        return b""
+    numpy = length >= 4096 and _websocket_numpy()
+    if numpy:
+        key = numpy.resize(numpy.frombuffer(mask_key, dtype=numpy.uint8), length)
+        return numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint8), key).tobytes()
+
+    key = mask_key * (length // 4) + mask_key[:length % 4]
+    if sys.version_info[0] < 3:
+        value = int(binascii.hexlify(bytearray(data)), 16) ^ int(binascii.hexlify(key), 16)
+        return binascii.unhexlify('%0*x' % (2*length, value))
+    value = int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')
+    return value.to_bytes(length, 'big')
+
+
 class WebsocketWrapper:
 
     OPCODE_CONTINUATION = 0x0
@@ -2644,7 +4739,10 @@ class WebsocketWrapper:
     OPCODE_PING = 0x9
     OPCODE_PONG = 0xa
 
-    def __init__(self, socket, host, port, is_ssl):
+    # Most bytes decompressed from a permessage-deflate message at a time.
+    INFLATE_CHUNK = 65536
+
+    def __init__(self, socket, host, port, is_ssl, deflate=None, deflate_stats=None):
 
         self.connected = False
 
@@ -2653,12 +4751,47 @@ class WebsocketWrapper:
         self._port = port
         self._socket = socket
 
-        self._sendbuffer = bytearray()
-        self._readbuffer = bytearray()
-
+        # memoryviews of unsent frame data; control frames may be queued
+        # after the data frame currently being sent
+        self._sendbuffer = []
         self._requested_size = 0
-        self._payload_head = 0
-        self._readbuffer_head = 0
+
+        # raw bytes read from the socket, consumed from _read_start
+        self._readbuffer = bytearray(65536)
+        self._read_start = 0
+        self._read_end = 0
+
+        # payload bytes left in the current data frame, 0 between frames
+        self._frame_remaining = 0
+        self._frame_mask = None
+        self._frame_offset = 0
+        # a fragmented binary message is being received
+        self._fragmented = False
+        # a close frame has arrived or the stream is invalid
+        self._closed = False
+
+        # permessage-deflate: options offered, and the zlib objects once it
+        # has been negotiated
+        self._deflate = deflate
+        if deflate_stats is None:
+            deflate_stats = dict(negotiated=False, bytes_in=0, bytes_in_wire=0, bytes_out=0, bytes_out_wire=0)
+        self._deflate_stats = deflate_stats
+        self._deflate_stats['negotiated'] = False
+        self._compressor = None
+        self._decompressor = None
+        self._compress_wbits = 15
+        self._client_context_takeover = True
+        self._server_context_takeover = True
+        # the message being received is compressed
+        self._frame_deflated = False
+        self._frame_fin = True
+        # decompressed data not yet returned
+        self._inflated = bytearray()
+        self._inflated_pos = 0
+        # compressed data not yet decompressed, and whether the decompressor
+        # is to be reset once it has been
+        self._inflate_pending = b""
+        self._inflate_reset = False
 
         self._do_handshake()
 
@@ -2679,80 +4812,166 @@ class WebsocketWrapper:
                  b"Origin: http://" + str(self._host).encode('utf-8') + b":" + str(self._port).encode('utf-8') + b"\r\n" +\
                  b"Sec-WebSocket-Key: " + sec_websocket_key + b"\r\n" +\
                  b"Sec-WebSocket-Version: 13\r\n" +\
-                 b"Sec-WebSocket-Protocol: mqtt\r\n\r\n"
+                 b"Sec-WebSocket-Protocol: mqtt\r\n"
+
+        if self._deflate is not None:
+            extension = b"permessage-deflate; client_max_window_bits"
+            if not self._deflate['client_context_takeover']:
+                extension += b"; client_no_context_takeover"
+            if not self._deflate['server_context_takeover']:
+                extension += b"; server_no_context_takeover"
+            header += b"Sec-WebSocket-Extensions: " + extension + b"\r\n"
+        header += b"\r\n"
 
         if self._ssl:
             self._socket.write(header)
         else:
             self._socket.send(header)
 
-        has_secret = False
-        has_upgrade = False
-
+        # read the HTTP response header in blocks; anything after it is
+        # already WebSocket data
+        response = bytearray()
         while True:
-            # read HTTP response header as lines
             if self._ssl:
-                byte = self._socket.read(1)
+                data = self._socket.read(4096)
             else:
-                byte = self._socket.recv(1)
-
-            self._readbuffer.extend(byte)
-            # line end
-            if byte == b"\n":
-                if len(self._readbuffer) > 2:
-                    # check upgrade
-                    if b"connection" in str(self._readbuffer).lower().encode('utf-8'):
-                        if b"upgrade" not in str(self._readbuffer).lower().encode('utf-8'):
-                            raise ValueError("WebSocket handshake error, connection not upgraded")
-                        else:
-                            has_upgrade = True
-
-                    # check key hash
-                    if b"sec-websocket-accept" in str(self._readbuffer).lower().encode('utf-8'):
-                        GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-
-                        server_hash = self._readbuffer.decode('utf-8').split(": ", 1)[1]
-                        server_hash = server_hash.strip().encode('utf-8')
-
-                        client_hash = sec_websocket_key.decode('utf-8') + GUID
-                        client_hash = hashlib.sha1(client_hash.encode('utf-8'))
-                        client_hash = base64.b64encode(client_hash.digest())
-
-                        if server_hash != client_hash:
-                            raise ValueError("WebSocket handshake error, invalid secret key")
-                        else:
-                            has_secret = True
-                else:
-                    # ending linebreak
-                    break
-
-                # reset linebuffer
-                self._readbuffer = bytearray()
+                data = self._socket.recv(4096)
 
             # connection reset
-            elif not byte:
+            if not data:
                 raise ValueError("WebSocket handshake error")
 
+            response.extend(data)
+            end = response.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            if len(response) > 65536:
+                raise ValueError("WebSocket handshake error, response too long")
+
+        rest = response[end+4:]
+        self._readbuffer[0:len(rest)] = rest
+        self._read_end = len(rest)
+
+        has_secret = False
+        has_upgrade = False
+
+        for line in bytes(response[:end]).split(b"\r\n")[1:]:
+            (name, _, value) = line.partition(b":")
+            name = name.strip().lower()
+            value = value.strip()
+
+            # check upgrade
+            if name == b"connection":
+                if b"upgrade" not in value.lower():
+                    raise ValueError("WebSocket handshake error, connection not upgraded")
+                else:
+                    has_upgrade = True
+
+            # check key hash
+            elif name == b"sec-websocket-accept":
+                GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+                client_hash = hashlib.sha1(sec_websocket_key + GUID)
+                client_hash = base64.b64encode(client_hash.digest())
+
+                if value != client_hash:
+                    raise ValueError("WebSocket handshake error, invalid secret key")
+                else:
+                    has_secret = True
+
+            elif name == b"sec-websocket-extensions":
+                self._accept_extensions(value)
+
         if not has_upgrade or not has_secret:
             raise ValueError("WebSocket handshake error")
 
-        self._readbuffer = bytearray()
         self.connected = True
 
-    def _create_frame(self, opcode, data, do_masking=1):
+    def _accept_extensions(self, value):
+        # Apply the permessage-deflate parameters chosen by the server.
+        for extension in value.split(b","):
+            params = [param.strip() for param in extension.split(b";")]
+            if params[0].lower() != b"permessage-deflate":
+                raise ValueError("WebSocket handshake error, unexpected extension")
+            if self._deflate is None or self._deflate_stats['negotiated']:
+                raise ValueError("WebSocket handshake error, permessage-deflate not offered")
+
+            for param in params[1:]:
+                (name, _, arg) = param.partition(b"=")
+                name = name.strip().lower()
+                arg = arg.strip().strip(b'"')
+                if name == b"client_no_context_takeover":
+                    self._client_context_takeover = False
+                elif name == b"server_no_context_takeover":
+                    self._server_context_takeover = False
+                elif name == b"client_max_window_bits":
+                    # the value is optional in a response too
+                    if arg:
+                        self._compress_wbits = int(arg)
+                    if not 8 <= self._compress_wbits <= 15:
+                        raise ValueError("WebSocket handshake error, invalid client_max_window_bits")
+                elif name != b"server_max_window_bits":
+                    raise ValueError("WebSocket handshake error, invalid permessage-deflate parameter")
+
+            self._compressor = self._new_compressor()
+            self._decompressor = zlib.decompressobj(-15)
+            self._deflate_stats['negotiated'] = True
+
+    def _new_compressor(self):
+        # zlib does not support raw deflate with an 8 bit window
+        return zlib.compressobj(self._deflate['level'], zlib.DEFLATED, -max(self._compress_wbits, 9))
+
+    def _compress(self, data):
+        # Compress one message; the trailing empty block is left out as
+        # RFC 7692 7.2.1 requires.
+        data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if not self._client_context_takeover:
+            self._compressor = self._new_compressor()
+        return data[:-4]
+
+    def _inflate(self, data):
+        # Decompress at most INFLATE_CHUNK bytes, so that a small message
+        # can't expand all at once; what is left of the input is
+        # decompressed as the output is consumed.
+        if self._inflated_pos == len(self._inflated):
+            del self._inflated[:]
+            self._inflated_pos = 0
+        if self._inflate_pending:
+            data = self._inflate_pending + data
+        try:
+            self._inflated.extend(self._decompressor.decompress(data, self.INFLATE_CHUNK))
+        except zlib.error:
+            # corrupt compressed data is a protocol error like an invalid
+            # frame: the stream can't be read any further
+            self._inflate_pending = b""
+            self._inflate_reset = False
+            self._closed = True
+            return
+        self._inflate_pending = self._decompressor.unconsumed_tail
+        if self._inflate_reset and not self._inflate_pending:
+            self._decompressor = zlib.decompressobj(-15)
+            self._inflate_reset = False
+
+    def _create_frame(self, opcode, data, do_masking=1, compressed=False):
+        """Return the frame for data as (header, payload), where header
+        includes the masking key. The payload is not copied unless it has to
+        be masked. compressed sets RSV1 to mark a permessage-deflate
+        message."""
 
         header = bytearray()
         length = len(data)
-        mask_key = bytearray([random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)])
         mask_flag = do_masking
 
         # 1 << 7 is the final flag, we don't send continuated data
-        header.append(1 << 7 | opcode)
+        if compressed:
+            header.append(1 << 7 | 1 << 6 | opcode)
+        else:
+            header.append(1 << 7 | opcode)
 
         if length < 126:
             header.append(mask_flag << 7 | length)
 
-        elif length < 32768:
+        elif length < 65536:
             header.append(mask_flag << 7 | 126)
             header += struct.pack("!H", length)
 
@@ -2764,149 +4983,294 @@ class WebsocketWrapper:
             raise ValueError("Maximum payload size is 2^63")
 
         if mask_flag == 1:
-            for index in range(length):
-                data[index] ^= mask_key[index % 4]
-            data = mask_key + data
-
-        return header + data
-
-    def _buffered_read(self, length):
-
-        # try to recv and strore needed bytes
-        if self._readbuffer_head + length > len(self._readbuffer):
-
-            if self._ssl:
-                data = self._socket.read(self._readbuffer_head + length - len(self._readbuffer))
-            else:
-                data = self._socket.recv(self._readbuffer_head + length - len(self._readbuffer))
-
-            if not data:
-                raise socket.error(errno.ECONNABORTED, 0)
-            else:
-                self._readbuffer.extend(data)
-
-        self._readbuffer_head += length
-        return self._readbuffer[self._readbuffer_head-length:self._readbuffer_head]
-
-    def _recv_impl(self, length):
-
-        # try to decode websocket payload part from data
-        try:
-
-            self._readbuffer_head = 0
-
-            result = None
-
-            chunk_startindex = self._payload_head
-            chunk_endindex = self._payload_head + length
-
-            header1 = self._buffered_read(1)
-            header2 = self._buffered_read(1)
-
-            opcode = (header1[0] & 0x0f)
-            maskbit = (header2[0] & 0x80) == 0x80
-            lengthbits = (header2[0] & 0x7f)
-            payload_length = lengthbits
-            mask_key = None
+            mask_key = os.urandom(4)
+            header += mask_key
+            data = _websocket_mask(mask_key, data)
+
+        return (header, data)
+
+    def _fill(self):
+        # Read from the socket into the free end of the read buffer. Only
+        # called when no payload can be decoded from the buffered bytes, so
+        # at most an incomplete frame header or control frame is kept.
+        pending = self._read_end - self._read_start
+        if self._read_start > 0 and len(self._readbuffer) - self._read_end < 4096:
+            self._readbuffer[0:pending] = self._readbuffer[self._read_start:self._read_end]
+            self._read_start = 0
+            self._read_end = pending
+        elif pending == 0:
+            self._read_start = 0
+            self._read_end = 0
+
+        view = memoryview(self._readbuffer)[self._read_end:]
+        length = self._socket.recv_into(view)
+        del view
+        self._read_end += length
+        return length
+
+    def _read_frame_header(self):
+        # Decode the frame header at the start of the read buffer. Control
+        # frames are handled here as a whole. Returns False if more data is
+        # needed.
+        buf = self._readbuffer
+        start = self._read_start
+        available = self._read_end - start
+        if available < 2:
+            return False
 
-            # read length
-            if lengthbits == 0x7e:
+        fin = buf[start] & 0x80
+        rsv1 = buf[start] & 0x40
+        opcode = buf[start] & 0x0f
+        maskbit = buf[start+1] & 0x80
+        payload_length = buf[start+1] & 0x7f
+        header_length = 2
 
-                value = self._buffered_read(2)
-                payload_length = struct.unpack("!H", value)[0]
+        # read length
+        if payload_length == 0x7e:
+            if available < 4:
+                return False
+            payload_length = struct.unpack_from("!H", buf, start+2)[0]
+            header_length = 4
+        elif payload_length == 0x7f:
+            if available < 10:
+                return False
+            payload_length = struct.unpack_from("!Q", buf, start+2)[0]
+            header_length = 10
 
-            elif lengthbits == 0x7f:
+        # read mask
+        mask_key = None
+        if maskbit:
+            if available < header_length + 4:
+                return False
+            mask_key = bytes(buf[start+header_length:start+header_length+4])
+            header_length += 4
 
-                value = self._buffered_read(8)
-                payload_length = struct.unpack("!Q", value)[0]
+        if opcode & 0x08:
+            # control frames are at most 125 bytes and can't be fragmented
+            if available < header_length + payload_length:
+                return False
+            payload = bytes(buf[start+header_length:start+header_length+payload_length])
+            if mask_key:
+                payload = _websocket_mask(mask_key, payload)
+            self._read_start = start + header_length + payload_length
+
+            # respond to non-binary opcodes, their arrival is not guaranteed beacause of non-blocking sockets
+            if opcode == WebsocketWrapper.OPCODE_CONNCLOSE:
+                self._send_control(WebsocketWrapper.OPCODE_CONNCLOSE, payload[:2])
+                self._closed = True
+            elif opcode == WebsocketWrapper.OPCODE_PING:
+                self._send_control(WebsocketWrapper.OPCODE_PONG, payload)
+            return True
 
-            # read mask
-            if maskbit:
+        # MQTT data is only carried in binary messages, which may be split
+        # across continuation frames
+        if opcode == WebsocketWrapper.OPCODE_BINARY and not self._fragmented:
+            if rsv1 and self._decompressor is None:
+                self._closed = True
+                return False
+            self._frame_deflated = bool(rsv1)
+            self._fragmented = not fin
+        elif opcode == WebsocketWrapper.OPCODE_CONTINUATION and self._fragmented and not rsv1:
+            self._fragmented = not fin
+        else:
+            self._closed = True
+            return False
 
-                mask_key = self._buffered_read(4)
+        self._read_start = start + header_length
+        self._frame_remaining = payload_length
+        self._frame_mask = mask_key
+        self._frame_offset = 0
+        self._frame_fin = bool(fin)
+        if payload_length == 0:
+            self._end_frame()
+        return True
+
+    def _end_frame(self):
+        # The payload of the current data frame has been consumed.
+        if self._frame_deflated and self._frame_fin:
+            self._inflate_reset = not self._server_context_takeover
+            if self._inflate_pending:
+                # decompressed with the rest, once the output is consumed
+                self._inflate_pending += b"\x00\x00\xff\xff"
+            else:
+                self._inflate(b"\x00\x00\xff\xff")
+
+    def _decode_into(self, view):
+        # Copy as much buffered payload into view as possible, handling any
+        # number of frames. Returns the number of bytes copied.
+        count = 0
+        space = len(view)
+        while count < space and not self._closed:
+            inflated = len(self._inflated) - self._inflated_pos
+            if inflated > 0:
+                length = min(inflated, space - count)
+                pos = self._inflated_pos
+                source = memoryview(self._inflated)[pos:pos+length]
+                view[count:count+length] = source
+                del source
+                self._inflated_pos += length
+                self._deflate_stats['bytes_in'] += length
+                count += length
+                continue
+
+            if self._inflate_pending:
+                self._inflate(b"")
+                continue
+
+            if self._frame_remaining == 0:
+                if not self._read_frame_header():
+                    break
+                continue
 
-            # if frame payload is shorter than the requested data, read only the possible part
-            readindex = chunk_endindex
-            if payload_length < readindex:
-                readindex = payload_length
+            available = self._read_end - self._read_start
+            if available == 0:
+                break
 
-            if readindex > 0:
+            start = self._read_start
+            if self._frame_deflated:
+                # decompress everything available; the output is returned
+                # from _inflated
+                length = min(self._frame_remaining, available)
+                data = bytes(self._readbuffer[start:start+length])
+                if self._frame_mask is not None:
+                    offset = self._frame_offset % 4
+                    data = _websocket_mask(self._frame_mask[offset:] + self._frame_mask[:offset], data)
+                    self._frame_offset += length
+                self._read_start += length
+                self._frame_remaining -= length
+                self._deflate_stats['bytes_in_wire'] += length
+                self._inflate(data)
+                if self._frame_remaining == 0:
+                    self._end_frame()
+                continue
+
+            length = min(self._frame_remaining, available, space - count)
+            self._deflate_stats['bytes_in'] += length
+            self._deflate_stats['bytes_in_wire'] += length
+            if self._frame_mask is None:
+                source = memoryview(self._readbuffer)[start:start+length]
+                view[count:count+length] = source
+                del source
+            else:
+                # servers shouldn't mask, but unmask anyway
+                offset = self._frame_offset % 4
+                mask_key = self._frame_mask[offset:] + self._frame_mask[:offset]
+                view[count:count+length] = _websocket_mask(mask_key, bytes(self._readbuffer[start:start+length]))
+                self._frame_offset += length
 
-                # get payload chunk
-                payload = self._buffered_read(readindex)
+            self._read_start += length
+            self._frame_remaining -= length
+            count += length
 
-                # unmask only the needed part
-                if maskbit:
-                    for index in range(chunk_startindex, readindex):
-                        payload[index] ^= mask_key[index % 4]
+        return count
 
-                result = payload[chunk_startindex:readindex]
-                self._payload_head = readindex
+    def _recv_impl(self, view):
 
-            # check if full frame arrived and reset readbuffer and payloadhead if needed
-            if readindex == payload_length:
-                self._readbuffer = bytearray()
-                self._payload_head = 0
+        # try to decode websocket payload part from buffered data first, and
+        # only read the socket if there is none
+        count = self._decode_into(view)
+        if count > 0 or self._closed:
+            return count
 
-                # respond to non-binary opcodes, their arrival is not guaranteed beacause of non-blocking sockets
-                if opcode == WebsocketWrapper.OPCODE_CONNCLOSE:
-                    frame = self._create_frame(WebsocketWrapper.OPCODE_CONNCLOSE, payload, 0)
-                    if self._ssl:
-                        self._socket.write(frame)
-                    else:
-                        self._socket.send(frame)
+        length = self._fill()
+        if length == 0:
+            self.connected = False
+            return 0
 
-                if opcode == WebsocketWrapper.OPCODE_PING:
-                    frame = self._create_frame(WebsocketWrapper.OPCODE_PONG, payload, 0)
-                    if self._ssl:
-                        self._socket.write(frame)
-                    else:
-                        self._socket.send(frame)
+        count = self._decode_into(view)
+        if count > 0 or self._closed:
+            return count
 
-            if opcode == WebsocketWrapper.OPCODE_BINARY:
-                return result
-            else:
-                raise socket.error(errno.EAGAIN, 0)
+        # only control frames or part of a header: no more data
+        raise socket.error(EAGAIN, 0)
 
+    def _socket_send(self, buffers):
+        if self._ssl:
+            # SSL objects have no gather write; frames are joined when queued.
+            return self._socket.write(buffers[0])
+        elif hasattr(self._socket, "sendmsg"):
+            return self._socket.sendmsg(buffers)
+        else:
+            return self._socket.send(buffers[0])
+
+    def _send_control(self, opcode, payload):
+        (header, payload) = self._create_frame(opcode, payload)
+        self._sendbuffer.append(memoryview(bytes(header) + payload))
+        if len(self._sendbuffer) > 1:
+            # sent after the frame in progress, on the next write
+            return
+        try:
+            self._send_pending()
         except socket.error as err:
+            if err.errno == EAGAIN:
+                return
+            if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
 
-            if err.errno == errno.ECONNABORTED:
-                self.connected = False
-                return b''
+    def _send_pending(self):
+        # try to write out as much as possible, dropping what has been sent
+        # without copying the rest
+        length = self._socket_send(self._sendbuffer)
+
+        buffers = self._sendbuffer
+        while length > 0:
+            if length >= len(buffers[0]):
+                length -= len(buffers[0])
+                del buffers[0]
             else:
-                # no more data
-                raise
+                buffers[0] = buffers[0][length:]
+                length = 0
 
     def _send_impl(self, data):
 
         # if previous frame was sent successfully
-        if len(self._sendbuffer) == 0:
+        if self._requested_size == 0:
 
             # create websocket frame
-            frame = self._create_frame(WebsocketWrapper.OPCODE_BINARY, bytearray(data))
-            self._sendbuffer.extend(frame)
+            compressed = (self._compressor is not None and self._deflate['compress_outgoing']
+                          and len(data) >= self._deflate['min_size'])
+            if compressed:
+                payload = self._compress(data)
+            else:
+                payload = data
+            self._deflate_stats['bytes_out'] += len(data)
+            self._deflate_stats['bytes_out_wire'] += len(payload)
+            (header, payload) = self._create_frame(WebsocketWrapper.OPCODE_BINARY, payload, 1, compressed)
+            if self._ssl:
+                self._sendbuffer.append(memoryview(bytes(header) + payload))
+            else:
+                self._sendbuffer.extend((memoryview(header), memoryview(payload)))
             self._requested_size = len(data)
 
-        # try to write out as much as possible
-        if self._ssl:
-            length = self._socket.write(self._sendbuffer)
-        else:
-            length = self._socket.send(self._sendbuffer)
-
-        self._sendbuffer = self._sendbuffer[length:]
+        while len(self._sendbuffer) > 0:
+            remaining = len(self._sendbuffer)
+            self._send_pending()
+            if len(self._sendbuffer) == remaining and len(self._sendbuffer[0]) > 0:
+                break
 
         if len(self._sendbuffer) == 0:
             # buffer sent out completely, return with payload's size
-            return self._requested_size
+            length = self._requested_size
+            self._requested_size = 0
+            return length
         else:
             # couldn't send whole data, request the same data again with 0 as sent length
             return 0
 
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer)
+        if nbytes > 0:
+            view = view[:nbytes]
+        return self._recv_impl(view)
+
     def recv(self, length):
-        return self._recv_impl(length)
+        buffer = bytearray(length)
+        length = self._recv_impl(memoryview(buffer))
+        return bytes(buffer[:length])
 
     def read(self, length):
-        return self._recv_impl(length)
+        return self.recv(length)
 
     def send(self, data):
         return self._send_impl(data)
@@ -2914,6 +5278,15 @@ class WebsocketWrapper:
     def write(self, data):
         return self._send_impl(data)
 
+    def pending(self):
+        """Return the number of bytes buffered by this wrapper or the SSL
+        layer below it, which select() will not report."""
+        length = self._read_end - self._read_start + len(self._inflated) - self._inflated_pos
+        length += len(self._inflate_pending)
+        if self._ssl and hasattr(self._socket, 'pending'):
+            length += self._socket.pending()
+        return length
+
     def close(self):
         self._socket.close()
 
@@ -0,0 +1,153 @@
+"""
+This module provides MQTTMatcher, a store of values keyed by MQTT topic
+filters that can efficiently find every value whose filter matches a topic
+name.
+"""
+
+import collections
+
+
+class MQTTMatcher(object):
+    """Intended to manage topic filters including wildcards.
+
+    Internally, MQTTMatcher uses a prefix tree (trie) with one level per
+    topic level, so finding the filters that match a topic costs time
+    proportional to the topic depth rather than to the number of filters.
+    The results of match() for the most recently used topics are cached.
+
+    matcher = MQTTMatcher()
+    matcher["foo/+/baz"] = value1
+    matcher["foo/#"] = value2
+    matcher.match("foo/bar/baz")  # (value1, value2)
+    """
+
+    class Node(object):
+        __slots__ = '_children', '_content'
+
+        def __init__(self):
+            self._children = {}
+            # (insertion order, value) or None.
+            self._content = None
+
+    def __init__(self, cache_size=256):
+        self._root = self.Node()
+        self._count = 0
+        self._seq = 0
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    def __len__(self):
+        return self._count
+
+    def __setitem__(self, key, value):
+        """Add a topic filter key to the prefix tree and associate it with
+        value. Replacing the value of an existing filter keeps its place in
+        the match order."""
+        node = self._root
+        for sym in key.split('/'):
+            node = node._children.setdefault(sym, self.Node())
+        if node._content is None:
+            self._count = self._count + 1
+            self._seq = self._seq + 1
+            node._content = (self._seq, value)
+        else:
+            node._content = (node._content[0], value)
+        self._cache.clear()
+
+    def __getitem__(self, key):
+        """Retrieve the value associated with the topic filter key."""
+        node = self._root
+        for sym in key.split('/'):
+            node = node._children.get(sym)
+            if node is None:
+                raise KeyError(key)
+        if node._content is None:
+            raise KeyError(key)
+        return node._content[1]
+
+    def __delitem__(self, key):
+        """Delete the value associated with the topic filter key."""
+        path = []
+        node = self._root
+        for sym in key.split('/'):
+            child = node._children.get(sym)
+            if child is None:
+                raise KeyError(key)
+            path.append((node, sym, child))
+            node = child
+        if node._content is None:
+            raise KeyError(key)
+
+        node._content = None
+        self._count = self._count - 1
+        self._cache.clear()
+
+        # Prune the branch back to the last node that is still in use.
+        for (parent, sym, child) in reversed(path):
+            if child._children or child._content is not None:
+                break
+            del parent._children[sym]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def iter_match(self, topic):
+        """Return an iterator over the values of all filters that match
+        topic, in no particular order."""
+        for content in self._iter_content(topic):
+            yield content[1]
+
+    def _iter_content(self, topic):
+        levels = topic.split('/')
+        # Wildcards at the first level don't match topics beginning with $.
+        normal = not topic.startswith('$')
+        nodes = [self._root]
+        for i in range(len(levels)):
+            wildcards = normal or i > 0
+            matched = []
+            for node in nodes:
+                children = node._children
+                if wildcards:
+                    multi = children.get('#')
+                    if multi is not None and multi._content is not None:
+                        yield multi._content
+                    single = children.get('+')
+                    if single is not None:
+                        matched.append(single)
+                    child = children.get(levels[i])
+                    if child is not None and child is not single:
+                        matched.append(child)
+                else:
+                    child = children.get(levels[i])
+                    if child is not None:
+                        matched.append(child)
+            if not matched:
+                return
+            nodes = matched
+
+        for node in nodes:
+            if node._content is not None:
+                yield node._content
+            # "foo/#" also matches "foo".
+            multi = node._children.get('#')
+            if multi is not None and multi._content is not None:
+                yield multi._content
+
+    def match(self, topic):
+        """Return a tuple of the values of all filters that match topic, in
+        the order the filters were first added."""
+        cache = self._cache
+        try:
+            result = cache.pop(topic)
+        except KeyError:
+            contents = sorted(self._iter_content(topic), key=lambda c: c[0])
+            result = tuple(content[1] for content in contents)
+            if len(cache) >= self._cache_size > 0:
+                cache.popitem(last=False)
+        if self._cache_size > 0:
+            cache[topic] = result
+        return result
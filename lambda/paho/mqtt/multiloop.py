@@ -0,0 +1,431 @@
+"""
+This module provides MultiClientLoop, which processes the network traffic of
+many Client instances from a single thread. Sockets are registered once with
+an epoll/kqueue based selector rather than passed to select() on every call,
+so the cost of a loop iteration depends on the number of ready connections
+and not on the total number of clients.
+"""
+
+import collections
+import errno
+import heapq
+import logging
+import socket
+import threading
+
+try:
+    import selectors
+except ImportError:
+    # Python 2 with the selectors34 backport.
+    import selectors34 as selectors
+
+from .client import sockpair_data, time_func, EAGAIN
+
+_logger = logging.getLogger(__name__)
+
+
+def _socketpair():
+    # A connected pair of non-blocking sockets for waking the loop. Python 2
+    # on Windows has no socket.socketpair(), so connect them over loopback.
+    if hasattr(socket, 'socketpair'):
+        (sock1, sock2) = socket.socketpair()
+    else:
+        listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listensock.bind(("127.0.0.1", 0))
+        listensock.listen(1)
+        sock1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock1.setblocking(0)
+        try:
+            sock1.connect(listensock.getsockname())
+        except socket.error as err:
+            if err.errno != errno.EINPROGRESS and err.errno != errno.EWOULDBLOCK and err.errno != EAGAIN:
+                raise
+        sock2 = listensock.accept()[0]
+        listensock.close()
+    sock1.setblocking(0)
+    sock2.setblocking(0)
+    return (sock1, sock2)
+
+
+class _Session(object):
+    __slots__ = 'client', 'fd', 'wake_fd', 'connecting', 'connect_fds', 'events', 'deadline'
+
+    def __init__(self, client):
+        self.client = client
+        # Socket file descriptor as registered, or None while disconnected.
+        self.fd = None
+        self.wake_fd = None
+        # A connection started with reconnect_start() is being made.
+        self.connecting = False
+        # Sockets of the connection attempts in progress.
+        self.connect_fds = []
+        self.events = 0
+        # Earliest deadline this session has in the timer heap.
+        self.deadline = None
+
+
+class MultiClientLoop(object):
+    """Network loop shared by many clients.
+
+    Clients are configured and connected (or given to connect_async()) as
+    usual and then handed to add(). Their callbacks are called from the
+    thread running the loop, exactly as with Client.loop_start(). Lost
+    connections are re-established, without blocking the loop, after the
+    client's reconnect_delay_set() backoff; a client that disconnects
+    cleanly is removed from the loop. Failed connection attempts are logged
+    at DEBUG level to the "paho.mqtt.multiloop" logger.
+
+    mloop = MultiClientLoop()
+    for client in clients:
+        client.connect_async("localhost")
+        mloop.add(client)
+    mloop.loop_forever()
+    """
+    def __init__(self, max_packets=64, reconnect_delay=None):
+        """max_packets is the number of incoming, and separately outgoing,
+        packets handled for a client each time its socket is ready. Values
+        < 1 mean no limit. reconnect_delay, if given, is a fixed delay in
+        seconds to use instead of the clients' backoff."""
+        self._selector = selectors.DefaultSelector()
+        self._sessions = {}
+        self._max_packets = max_packets
+        self._reconnect_delay = reconnect_delay
+
+        # (deadline, seq, kind, session) with kind 'misc', 'reconnect' or
+        # 'connect'.
+        self._timers = []
+        self._timer_seq = 0
+        # Clients with complete packets left in their read buffer.
+        self._backlog = set()
+
+        # add()/remove()/loop_stop() may be called from other threads, so
+        # they are applied by the loop thread.
+        self._requests = collections.deque()
+        self._requests_mutex = threading.Lock()
+        self._wakeR, self._wakeW = _socketpair()
+        self._selector.register(self._wakeR, selectors.EVENT_READ, None)
+
+        self._thread = None
+        self._thread_terminate = False
+        # The thread that last ran loop(), which the clients are told about.
+        self._loop_thread = None
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def close(self):
+        """Release the selector and the wakeup sockets. Clients are left
+        connected."""
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        if self._wakeR:
+            self._wakeR.close()
+            self._wakeR = None
+        if self._wakeW:
+            self._wakeW.close()
+            self._wakeW = None
+
+    def add(self, client):
+        """Add a client to the loop. The client must already have been given
+        its broker with connect() or connect_async(); a client that is not
+        connected yet is connected by the loop.
+
+        The client is marked with loop_external_set(), so that publish() and
+        the like from other threads leave the writing to the loop."""
+        client.loop_external_set(True, self._loop_thread)
+        self._request('add', client)
+
+    def remove(self, client):
+        """Remove a client from the loop. Its connection is left open."""
+        self._request('remove', client)
+
+    def loop(self, timeout=1.0):
+        """Wait up to timeout seconds for network events and process them
+        for every client that is ready.
+
+        A ValueError will be raised if timeout < 0"""
+        if timeout < 0.0:
+            raise ValueError('Invalid timeout.')
+
+        thread = threading.current_thread()
+        if thread != self._loop_thread:
+            self._loop_thread = thread
+            for client in self._sessions:
+                client.loop_external_set(True, thread)
+
+        self._process_requests()
+
+        if self._backlog:
+            timeout = 0.0
+        elif self._timers:
+            timeout = max(0.0, min(timeout, self._timers[0][0] - time_func()))
+
+        ready = self._selector.select(timeout)
+
+        backlog = self._backlog
+        self._backlog = set()
+        for session in backlog:
+            if session.fd is not None:
+                self._do_read(session)
+
+        for (key, mask) in ready:
+            session = key.data
+            if session is None:
+                self._drain(self._wakeR)
+                self._process_requests()
+            elif key.fd == session.wake_fd:
+                # publish() etc. from another thread or from a callback.
+                session.client.wake_clear()
+                self._update(session)
+            elif key.fd == session.fd:
+                if mask & selectors.EVENT_READ and session not in backlog:
+                    self._do_read(session)
+                if mask & selectors.EVENT_WRITE and session.fd is not None:
+                    self._do_write(session)
+            elif key.fd in session.connect_fds:
+                self._do_connect(session)
+
+        self._run_timers()
+
+    def loop_forever(self, timeout=1.0):
+        """Call loop() until loop_stop() is called."""
+        while not self._thread_terminate:
+            self.loop(timeout)
+
+    def loop_start(self):
+        """Start a new thread that calls loop_forever()."""
+        if self._thread is not None:
+            return
+
+        self._thread_terminate = False
+        self._thread = threading.Thread(target=self.loop_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def loop_stop(self):
+        """Stop the loop, waiting for the thread started by loop_start() to
+        finish."""
+        self._thread_terminate = True
+        self._wakeup()
+        if self._thread is not None and threading.current_thread() != self._thread:
+            self._thread.join()
+            self._thread = None
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _request(self, op, client):
+        self._requests_mutex.acquire()
+        self._requests.append((op, client))
+        self._requests_mutex.release()
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeW.send(sockpair_data)
+        except socket.error as err:
+            if err.errno != EAGAIN:
+                raise
+
+    def _drain(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except socket.error as err:
+            if err.errno != EAGAIN:
+                raise
+
+    def _process_requests(self):
+        while self._requests:
+            self._requests_mutex.acquire()
+            (op, client) = self._requests.popleft()
+            self._requests_mutex.release()
+
+            if op == 'add':
+                if client in self._sessions:
+                    continue
+                session = _Session(client)
+                self._sessions[client] = session
+                client.loop_external_set(True, self._loop_thread)
+                session.wake_fd = client.wake_socket().fileno()
+                self._selector.register(session.wake_fd, selectors.EVENT_READ, session)
+                if client.socket() is None:
+                    self._schedule(session, time_func(), 'reconnect')
+                else:
+                    self._register(session)
+            else:
+                session = self._sessions.pop(client, None)
+                if session is None:
+                    continue
+                self._unregister(session)
+                self._unregister_connect(session)
+                if session.connecting:
+                    client.reconnect_cancel()
+                    session.connecting = False
+                client.loop_external_set(False)
+                self._selector.unregister(session.wake_fd)
+                session.wake_fd = None
+                self._backlog.discard(session)
+
+    def _register(self, session):
+        session.fd = session.client.socket().fileno()
+        session.events = selectors.EVENT_READ
+        self._selector.register(session.fd, session.events, session)
+        self._update(session)
+
+    def _unregister(self, session):
+        if session.fd is None:
+            return
+        if session.events:
+            self._selector.unregister(session.fd)
+        session.fd = None
+        session.events = 0
+
+    def _update(self, session):
+        # Called after every operation on a client: notices lost connections,
+        # only asks for EVENT_WRITE while there is data queued and makes sure
+        # the client's next keepalive/retry deadline is in the timer heap.
+        client = session.client
+        if session.fd is None:
+            return
+        sock = client.socket()
+        if sock is None and client.is_reconnecting():
+            # The client is connecting again by itself, to fall back to
+            # MQTT v3.1.
+            self._unregister(session)
+            self._backlog.discard(session)
+            session.connecting = True
+            self._do_connect(session)
+            return
+        if sock is None or sock.fileno() != session.fd:
+            self._connection_lost(session)
+            return
+
+        # A client whose message dispatch queue is full isn't read from; it
+        # wakes the loop once there is room again.
+        events = 0
+        if client.want_read():
+            events = selectors.EVENT_READ
+            if client.read_pending():
+                self._backlog.add(session)
+        if client.want_write():
+            events = events | selectors.EVENT_WRITE
+        if events != session.events:
+            if not events:
+                self._selector.unregister(session.fd)
+            elif not session.events:
+                self._selector.register(session.fd, events, session)
+            else:
+                self._selector.modify(session.fd, events, session)
+            session.events = events
+
+        deadline = client.misc_deadline()
+        if deadline is not None and (session.deadline is None or deadline < session.deadline):
+            self._schedule(session, deadline, 'misc')
+
+    def _connection_lost(self, session):
+        self._unregister(session)
+        self._backlog.discard(session)
+        if session.client.is_disconnecting():
+            self.remove(session.client)
+        else:
+            self._schedule_reconnect(session)
+
+    def _schedule_reconnect(self, session):
+        if self._reconnect_delay is None:
+            delay = session.client.reconnect_delay()
+        else:
+            delay = self._reconnect_delay
+        self._schedule(session, time_func() + delay, 'reconnect')
+
+    def _schedule(self, session, deadline, kind):
+        if kind == 'misc':
+            session.deadline = deadline
+        self._timer_seq = self._timer_seq + 1
+        heapq.heappush(self._timers, (deadline, self._timer_seq, kind, session))
+
+    def _run_timers(self):
+        now = time_func()
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            (deadline, seq, kind, session) = heapq.heappop(timers)
+            if session.client not in self._sessions:
+                continue
+            if kind == 'reconnect':
+                self._do_reconnect(session)
+            elif kind == 'connect':
+                self._do_connect(session)
+            elif session.fd is not None and deadline == session.deadline:
+                # Entries that have been superseded by an earlier deadline
+                # are skipped.
+                session.deadline = None
+                session.client.loop_misc()
+                self._update(session)
+
+    def _do_reconnect(self, session):
+        client = session.client
+        if session.fd is not None or session.connecting:
+            return
+        try:
+            client.reconnect_start()
+        except socket.error as err:
+            _logger.debug("Connection failed, retrying: %s", err)
+            self._schedule_reconnect(session)
+            return
+        session.connecting = True
+        self._do_connect(session)
+
+    def _do_connect(self, session):
+        # Make progress with the client's connection attempts, which are
+        # watched for writability until one of them connects, and then with
+        # its TLS handshake.
+        client = session.client
+        if not session.connecting:
+            return
+        # Failed attempts are closed by reconnect_poll(), so stop watching
+        # them first.
+        self._unregister_connect(session)
+        try:
+            connected = client.reconnect_poll()
+        except socket.error as err:
+            session.connecting = False
+            _logger.debug("Connection failed, retrying: %s", err)
+            self._schedule_reconnect(session)
+            return
+
+        if not connected:
+            for (attempt, write) in client.reconnect_sockets():
+                fd = attempt.fileno()
+                if write:
+                    self._selector.register(fd, selectors.EVENT_WRITE, session)
+                else:
+                    self._selector.register(fd, selectors.EVENT_READ, session)
+                session.connect_fds.append(fd)
+            deadline = client.reconnect_deadline()
+            if deadline is not None:
+                self._schedule(session, deadline, 'connect')
+            return
+
+        session.connecting = False
+        session.deadline = None
+        self._register(session)
+
+    def _unregister_connect(self, session):
+        for fd in session.connect_fds:
+            self._selector.unregister(fd)
+        session.connect_fds = []
+
+    def _do_read(self, session):
+        client = session.client
+        client.loop_read(self._max_packets)
+        self._update(session)
+
+    def _do_write(self, session):
+        session.client.loop_write(self._max_packets)
+        self._update(session)
+
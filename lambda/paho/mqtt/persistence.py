@@ -0,0 +1,366 @@
+"""
+This module provides message stores for Client.message_store_set(). A store
+records QoS 1 and 2 messages as they move through their network flow, so
+that messages which have not been acknowledged when the process stops are
+resent when it is started again.
+"""
+
+import collections
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from .client import (
+    MQTTMessage, mqtt_ms_wait_for_puback, mqtt_ms_wait_for_pubrec,
+    mqtt_ms_wait_for_pubcomp, mqtt_ms_wait_for_pubrel, time_func)
+
+
+class MessageStore(object):
+    """Interface of the stores accepted by Client.message_store_set(). This
+    class stores nothing and can be subclassed to keep messages elsewhere,
+    for example in a database.
+
+    direction is 'out' for messages published by the client and 'in' for
+    QoS 2 messages received from the broker that have not been released yet.
+    The methods can be called from any thread that uses the client.
+    """
+    def load(self):
+        """Return a tuple (out_messages, in_messages) of lists of the
+        MQTTMessage instances in the store, in the order they were put."""
+        return ([], [])
+
+    def put(self, direction, message):
+        """Add message, replacing any message with the same direction and
+        mid."""
+        pass
+
+    def set_state(self, direction, mid, state):
+        """Record a change of a message's mqtt_ms_* state."""
+        pass
+
+    def delete(self, direction, mid):
+        """Remove a message whose flow has completed."""
+        pass
+
+    def flush(self):
+        """Called by Client.loop_misc(), so regularly from the network loop,
+        to write out changes that have not been made durable yet."""
+        pass
+
+    def close(self):
+        """Write out all changes and release the store."""
+        pass
+
+
+_MAGIC = b'PMQS0001'
+_INITIAL_SIZE = 65536
+
+# Each record is its body length and CRC-32, followed by the body.
+_RECORD_HEADER = struct.Struct('!II')
+# Bodies start with a kind and the mid. A put then has the QoS, retain flag,
+# state and topic length, followed by the topic and payload.
+_DELETE = struct.Struct('!BH')
+_STATE = struct.Struct('!BHB')
+_PUT = struct.Struct('!BHBBBH')
+
+_KIND_PUT = 1
+_KIND_STATE = 2
+_KIND_DELETE = 3
+# Set in the kind of records for incoming messages.
+_KIND_IN = 0x80
+
+_SYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class FileMessageStore(MessageStore):
+    """Store messages in an append-only log file.
+
+    Every change is appended to the log through a shared memory mapping, so
+    a change costs a memory copy and survives the process crashing as soon
+    as the call returns. When it is written to disk, and so also survives a
+    crash of the machine, depends on sync:
+
+    'always' - before put(), set_state() or delete() returns, and so before
+        the client sends the packet that the change belongs to. Slowest.
+    'interval' - by flush(), at most sync_interval seconds after the change.
+    'never' - whenever the operating system writes the pages back.
+
+    Once the log has grown to compact_size bytes and less than half of it
+    describes messages that are still in flight, it is rewritten with only
+    those messages.
+
+    store = FileMessageStore("/var/lib/yee/mqtt.log")
+    client = Client("yee-controller", clean_session=False)
+    client.message_store_set(store)
+    client.connect("localhost")
+    """
+    def __init__(self, path, sync='interval', sync_interval=1.0, compact_size=1048576):
+        if sync not in _SYNC_POLICIES:
+            raise ValueError('Invalid sync policy.')
+        if sync_interval < 0:
+            raise ValueError('Invalid sync interval.')
+
+        self._path = path
+        self._sync = sync
+        self._sync_interval = sync_interval
+        self._compact_size = compact_size
+        self._lock = threading.Lock()
+
+        # (kind & _KIND_IN, mid) -> body of the put record describing the
+        # message's current state.
+        self._live = collections.OrderedDict()
+        # Size of the log if it were compacted now.
+        self._live_bytes = len(_MAGIC)
+        self._dirty = False
+        self._last_sync = time_func()
+
+        self._fd = None
+        self._map = None
+        self._size = 0
+        self._end = 0
+        self._open()
+        self._recover()
+
+    def load(self):
+        out_messages = []
+        in_messages = []
+        with self._lock:
+            for ((direction, mid), body) in self._live.items():
+                (kind, mid, qos, retain, state, topic_length) = _PUT.unpack_from(body)
+                start = _PUT.size
+                topic = body[start:start+topic_length]
+                if sys.version_info[0] >= 3:
+                    topic = topic.decode('utf-8')
+                message = MQTTMessage(mid, topic)
+                payload = body[start+topic_length:]
+                if len(payload) > 0:
+                    message.payload = payload
+                message.qos = qos
+                message.retain = bool(retain)
+
+                if direction == _KIND_IN:
+                    message.state = mqtt_ms_wait_for_pubrel
+                    in_messages.append(message)
+                else:
+                    # Whether or not it was sent before, reconnect() resends
+                    # the message, or the PUBREL if the PUBREC had arrived.
+                    if state == mqtt_ms_wait_for_pubcomp:
+                        message.state = mqtt_ms_wait_for_pubcomp
+                    elif qos == 1:
+                        message.state = mqtt_ms_wait_for_puback
+                    else:
+                        message.state = mqtt_ms_wait_for_pubrec
+                    out_messages.append(message)
+        return (out_messages, in_messages)
+
+    def put(self, direction, message):
+        topic = message.topic
+        if not isinstance(topic, bytes):
+            topic = topic.encode('utf-8')
+        payload = message.payload
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        elif isinstance(payload, bytearray):
+            payload = bytes(payload)
+        elif not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+
+        kind = _KIND_PUT | self._direction(direction)
+        body = b''.join((
+            _PUT.pack(kind, message.mid, message.qos, int(bool(message.retain)), message.state, len(topic)),
+            topic, payload))
+
+        with self._lock:
+            self._set_live((kind & _KIND_IN, message.mid), body)
+            self._append(body)
+
+    def set_state(self, direction, mid, state):
+        kind = _KIND_STATE | self._direction(direction)
+        with self._lock:
+            key = (kind & _KIND_IN, mid)
+            if key not in self._live:
+                return
+            self._apply_state(key, state)
+            self._append(_STATE.pack(kind, mid, state))
+
+    def delete(self, direction, mid):
+        kind = _KIND_DELETE | self._direction(direction)
+        with self._lock:
+            key = (kind & _KIND_IN, mid)
+            if key not in self._live:
+                return
+            self._set_live(key, None)
+            self._append(_DELETE.pack(kind, mid))
+            if self._end >= self._compact_size and self._end > 2*self._live_bytes:
+                self._compact()
+
+    def flush(self):
+        if not self._dirty or self._sync != 'interval':
+            return
+        now = time_func()
+        if now - self._last_sync < self._sync_interval:
+            return
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+            self._dirty = False
+            self._last_sync = now
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                if self._sync != 'never':
+                    self._map.flush()
+                self._map.close()
+                self._map = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    # ============================================================
+    # Private functions
+    # ============================================================
+
+    def _direction(self, direction):
+        if direction == 'in':
+            return _KIND_IN
+        elif direction == 'out':
+            return 0
+        else:
+            raise ValueError('Invalid direction.')
+
+    def _open(self):
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o600)
+        size = os.fstat(self._fd).st_size
+        new = size == 0
+        if size < _INITIAL_SIZE:
+            size = _INITIAL_SIZE
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._size = size
+        if new:
+            self._map[0:len(_MAGIC)] = _MAGIC
+        elif self._map[0:len(_MAGIC)] != _MAGIC:
+            self._map.close()
+            os.close(self._fd)
+            self._map = None
+            self._fd = None
+            raise ValueError('%s is not a message store.' % self._path)
+
+    def _recover(self):
+        # Replay the log up to the first empty or damaged record. A damaged
+        # record can only be the result of a crash part way through writing
+        # it, so it and anything after it are cleared.
+        m = self._map
+        pos = len(_MAGIC)
+        while pos + _RECORD_HEADER.size <= self._size:
+            (length, crc) = _RECORD_HEADER.unpack_from(m, pos)
+            if length == 0:
+                break
+            start = pos + _RECORD_HEADER.size
+            end = start + length
+            if end > self._size or zlib.crc32(m[start:end]) & 0xffffffff != crc:
+                m[pos:self._size] = b'\x00' * (self._size - pos)
+                break
+            self._apply(m[start:end])
+            pos = end
+        self._end = pos
+
+    def _apply(self, body):
+        (kind, mid) = _DELETE.unpack_from(body)
+        key = (kind & _KIND_IN, mid)
+        op = kind & ~_KIND_IN
+        if op == _KIND_PUT:
+            self._set_live(key, body)
+        elif key not in self._live:
+            pass
+        elif op == _KIND_STATE:
+            self._apply_state(key, _STATE.unpack_from(body)[2])
+        elif op == _KIND_DELETE:
+            self._set_live(key, None)
+
+    def _set_live(self, key, body):
+        old = self._live.get(key)
+        if old is not None:
+            self._live_bytes -= _RECORD_HEADER.size + len(old)
+        if body is None:
+            self._live.pop(key, None)
+        else:
+            self._live[key] = body
+            self._live_bytes += _RECORD_HEADER.size + len(body)
+
+    def _apply_state(self, key, state):
+        # The state is the fifth byte of a put record.
+        body = self._live[key]
+        self._live[key] = body[:5] + struct.pack('!B', state) + body[6:]
+
+    def _record(self, body):
+        return _RECORD_HEADER.pack(len(body), zlib.crc32(body) & 0xffffffff) + body
+
+    def _append(self, body):
+        record = self._record(body)
+        start = self._end
+        end = start + len(record)
+        if end > self._size:
+            self._grow(end)
+        self._map[start:end] = record
+        self._end = end
+
+        if self._sync == 'always':
+            # flush() needs an offset that is a multiple of the allocation
+            # granularity.
+            offset = start - start % mmap.ALLOCATIONGRANULARITY
+            self._map.flush(offset, end - offset)
+        else:
+            self._dirty = True
+
+    def _grow(self, end):
+        size = self._size
+        while size < end:
+            size = size*2
+        self._map.close()
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._size = size
+        if self._sync == 'always':
+            os.fsync(self._fd)
+
+    def _compact(self):
+        # Write the messages still in flight to a new log and move it into
+        # place, so that a crash leaves either the old or the new log.
+        tmp_path = self._path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            f.write(_MAGIC)
+            for body in self._live.values():
+                f.write(self._record(body))
+            f.flush()
+            os.fsync(f.fileno())
+            end = f.tell()
+        finally:
+            f.close()
+
+        self._map.close()
+        os.close(self._fd)
+        self._map = None
+        self._fd = None
+        _replace(tmp_path, self._path)
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        self._open()
+        self._end = end
+        self._dirty = False
+        self._last_sync = time_func()
+
+
+_replace = getattr(os, 'replace', os.rename)
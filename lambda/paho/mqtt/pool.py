@@ -0,0 +1,185 @@
+"""
+This module provides ClientPool, which publishes through several client
+connections to the same broker. Each connection has its own 65535 message
+ids, inflight window and TCP stream, so a pool is not limited by the
+throughput of a single connection.
+"""
+
+import sys
+import zlib
+
+from .client import Client, MQTTv311, PreparedTopic
+
+
+class ClientPool(object):
+    """A fixed number of clients connected to the same broker, with
+    publishes spread across them by a hash of the topic. All messages for a
+    topic go through the same client, so they keep their order.
+
+    The clients are created with the client ids "<client_id>-0",
+    "<client_id>-1" and so on, or random ids if client_id is empty. They can
+    be configured individually by iterating over the pool, and are driven
+    either by loop_start(), which starts a thread per client, or by adding
+    them to a MultiClientLoop. Callbacks receive the client that the message
+    went through, and mids are only unique per client.
+
+    pool = ClientPool("yee-loadgen", 8)
+    for client in pool:
+        client.tls_set("cert/rootCA.pem")
+        client.max_inflight_messages_set(100)
+    pool.connect("localhost")
+    pool.loop_start()
+    pool.publish("/yee/light/42", payload, qos=1)
+    """
+    def __init__(self, client_id="", size=4, clean_session=True, userdata=None,
+                 protocol=MQTTv311, transport="tcp"):
+        """size is the number of clients. The other arguments are as for
+        Client, and are used for every client."""
+        if size < 1:
+            raise ValueError('Invalid pool size.')
+
+        self._clients = []
+        for i in range(size):
+            if client_id:
+                cid = "%s-%d" % (client_id, i)
+            else:
+                cid = ""
+            self._clients.append(Client(cid, clean_session, userdata, protocol, transport))
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self):
+        return iter(self._clients)
+
+    def __getitem__(self, index):
+        return self._clients[index]
+
+    def client(self, topic):
+        """Return the client that messages on topic, a string or
+        PreparedTopic, are published through."""
+        if isinstance(topic, PreparedTopic):
+            topic = topic.topic
+        if sys.version_info[0] >= 3 or isinstance(topic, unicode):
+            topic = topic.encode('utf-8')
+        return self._clients[(zlib.crc32(topic) & 0xffffffff) % len(self._clients)]
+
+    def connect(self, host, port=1883, keepalive=60, bind_address=""):
+        """Connect every client to the broker, as Client.connect() does."""
+        for client in self._clients:
+            client.connect(host, port, keepalive, bind_address)
+
+    def connect_async(self, host, port=1883, keepalive=60, bind_address=""):
+        """Give every client the broker to connect to once its network loop
+        is started, as Client.connect_async() does."""
+        for client in self._clients:
+            client.connect_async(host, port, keepalive, bind_address)
+
+    def disconnect(self):
+        """Disconnect every client."""
+        for client in self._clients:
+            client.disconnect()
+
+    def loop_start(self):
+        """Start a network thread for each client."""
+        for client in self._clients:
+            client.loop_start()
+
+    def loop_stop(self, force=False):
+        """Stop the clients' network threads."""
+        for client in self._clients:
+            client.loop_stop(force)
+
+    def is_connected(self):
+        """Return True if every client is connected."""
+        for client in self._clients:
+            if not client.is_connected():
+                return False
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Publish a message through the client chosen for its topic. Takes
+        the same arguments and returns the same MQTTMessageInfo as
+        Client.publish()."""
+        return self.client(topic).publish(topic, payload, qos, retain)
+
+    def publish_many(self, messages):
+        """Publish a batch of messages, given as for Client.publish_many().
+        The messages for each client are passed to its publish_many()
+        together, in order.
+
+        Returns a list with a MQTTMessageInfo for each message, in the order
+        of messages. All messages are validated before any is published, and
+        ValueError or TypeError raised as by Client.publish_many()."""
+        batches = {}
+        order = []
+        for m in messages:
+            if isinstance(m, dict):
+                topic = m['topic']
+                payload = m.get('payload')
+                qos = m.get('qos', 0)
+                retain = m.get('retain', False)
+            elif isinstance(m, tuple):
+                (topic, payload, qos, retain) = m + (None, None, 0, False)[len(m):]
+            else:
+                raise ValueError('message must be a dict or a tuple')
+
+            client = self.client(topic)
+            batch = batches.get(client)
+            if batch is None:
+                batch = batches[client] = []
+            # Fail before anything has been queued on any client.
+            batch.append(client._publish_check(topic, payload, qos, retain))
+            order.append((client, len(batch) - 1))
+
+        infos = {}
+        for (client, batch) in batches.items():
+            infos[client] = client.publish_many(batch)
+        return [infos[client][i] for (client, i) in order]
+
+    def stats(self):
+        """Return the sum of the clients' Client.stats(), with the RTT
+        histograms merged, and these additional values:
+
+        clients: the number of clients in the pool.
+        connected: the number of them that are connected.
+        """
+        total = None
+        connected = 0
+        for client in self._clients:
+            stats = client.stats()
+            if client.is_connected():
+                connected = connected + 1
+            if total is None:
+                total = stats
+                continue
+            for (key, value) in stats.items():
+                if key in ('packets_in', 'packets_out'):
+                    counts = total[key]
+                    for (name, n) in value.items():
+                        counts[name] = counts.get(name, 0) + n
+                elif key in ('puback_rtt', 'pubcomp_rtt'):
+                    total[key] = _merge_histograms(total[key], value)
+                else:
+                    total[key] = total[key] + value
+
+        total['clients'] = len(self._clients)
+        total['connected'] = connected
+        return total
+
+
+def _merge_histograms(a, b):
+    # Combine two _Histogram.snapshot() dicts.
+    count = a['count'] + b['count']
+    total = a['sum'] + b['sum']
+    if count:
+        mean = total / count
+    else:
+        mean = None
+    return dict(
+        count = count,
+        sum = total,
+        min = min([x for x in (a['min'], b['min']) if x is not None] or [None]),
+        max = max([x for x in (a['max'], b['max']) if x is not None] or [None]),
+        mean = mean,
+        buckets = [(bound, n + m) for ((bound, n), (_, m)) in zip(a['buckets'], b['buckets'])])
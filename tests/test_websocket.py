@@ -0,0 +1,148 @@
+# Tests of the websockets transport against WebSocketStandIn.
+#
+# Run with: python -m pytest tests
+
+import os
+import sys
+import time
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import paho.mqtt.client as mqtt
+from ws_standin import WebSocketStandIn, publish_packet, OPCODE_PING, OPCODE_PONG
+
+CONNACK = b"\x20\x02\x00\x00"
+
+
+class WebsocketTest(unittest.TestCase):
+    def connect(self, extensions=None, **deflate):
+        self.server = WebSocketStandIn(extensions)
+        self.addCleanup(self.server.close)
+        self.messages = []
+        self.disconnects = []
+
+        client = mqtt.Client("ws-test", transport="websockets")
+        if extensions is not None:
+            client.ws_set_deflate(**deflate)
+        client.on_message = lambda c, u, m: self.messages.append((m.topic, bytes(m.payload)))
+        client.on_disconnect = lambda c, u, rc: self.disconnects.append(rc)
+        client.connect("127.0.0.1", self.server.port)
+        self.addCleanup(self.close, client)
+        self.server.wait_connected()
+
+        self.assertEqual(self.server.read_packet()[:1], b"\x10")
+        self.server.send_message(CONNACK)
+        self.run_until(client, client.is_connected)
+        return client
+
+    def close(self, client):
+        sock = client.socket()
+        if sock is not None:
+            sock.close()
+
+    def run_until(self, client, condition, timeout=5.0):
+        start = time.time()
+        while not condition():
+            if time.time() - start > timeout:
+                self.fail("timed out")
+            rc = client.loop(0.05)
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                return rc
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def test_fragmented_message_with_control_frames(self):
+        client = self.connect()
+        packet = publish_packet("yee/light", b"on" * 500)
+        third = len(packet) // 3
+        self.server.send_frame(packet[:third], fin=False)
+        self.server.send_frame(b"ping", OPCODE_PING)
+        self.server.send_frame(packet[third:2*third], 0x0, fin=False)
+        self.server.send_frame(packet[2*third:], 0x0)
+
+        self.run_until(client, lambda: self.messages)
+        self.assertEqual(self.messages, [("yee/light", b"on" * 500)])
+        self.assertEqual(self.server.read_frame(), (OPCODE_PONG, True, False, b"ping"))
+
+    def test_several_packets_in_one_frame(self):
+        client = self.connect()
+        packets = [publish_packet("yee/%d" % i, b"x" * i) for i in range(5)]
+        self.server.send_message(b"".join(packets))
+
+        self.run_until(client, lambda: len(self.messages) == 5)
+        self.assertEqual(self.messages, [("yee/%d" % i, b"x" * i) for i in range(5)])
+
+    def check_deflate(self, client):
+        self.assertTrue(client.ws_deflate_stats()['negotiated'])
+
+        # The second message repeats the first, so with context takeover it
+        # is compressed to a back reference into the previous message.
+        payload = b'{"power": "on", "bright": 80, "ct": 4000, "name": "living room"}'
+        for i in range(3):
+            self.server.send_message(publish_packet("yee/light", payload), compress=True, fragments=i + 1)
+        self.run_until(client, lambda: len(self.messages) == 3)
+        self.assertEqual(self.messages, [("yee/light", payload)] * 3)
+
+        for i in range(3):
+            client.publish("yee/light", payload)
+            client.loop_write()
+            (compressed, data) = self.server.read_message()
+            self.assertTrue(compressed)
+            self.assertEqual(data, publish_packet("yee/light", payload))
+
+    def test_deflate_context_takeover(self):
+        client = self.connect("permessage-deflate", min_size=16)
+        self.assertIn(b"permessage-deflate; client_max_window_bits\r\n", self.server.request)
+        self.check_deflate(client)
+
+    def test_deflate_no_context_takeover(self):
+        client = self.connect("permessage-deflate; server_no_context_takeover; client_no_context_takeover",
+                              min_size=16, client_context_takeover=False, server_context_takeover=False)
+        self.assertIn(b"client_no_context_takeover; server_no_context_takeover", self.server.request)
+        self.check_deflate(client)
+
+    def test_deflate_small_window(self):
+        client = self.connect("permessage-deflate; client_max_window_bits=9", min_size=16)
+        self.check_deflate(client)
+
+    def test_deflate_output_bounded(self):
+        client = self.connect("permessage-deflate")
+        wrapper = client._sock
+        inflate = wrapper._inflate
+        sizes = []
+
+        def record(data):
+            inflate(data)
+            sizes.append(len(wrapper._inflated) - wrapper._inflated_pos)
+        wrapper._inflate = record
+
+        # 8 MB that compresses to a few kB
+        payload = b"\x00" * (8 << 20)
+        self.server.send_message(publish_packet("yee/bomb", payload), compress=True, fragments=2)
+        self.run_until(client, lambda: self.messages, timeout=30)
+        self.assertEqual(self.messages, [("yee/bomb", payload)])
+        self.assertLessEqual(max(sizes), mqtt.WebsocketWrapper.INFLATE_CHUNK)
+
+    def test_corrupt_deflate_closes_connection(self):
+        client = self.connect("permessage-deflate")
+        # a deflate block with the reserved block type 11
+        self.server.send_frame(b"\xff\xff\xff\xff", rsv1=True)
+
+        rc = self.run_until(client, lambda: self.disconnects)
+        self.assertNotEqual(rc, mqtt.MQTT_ERR_SUCCESS)
+        self.assertEqual(len(self.disconnects), 1)
+        self.assertFalse(client.is_connected())
+
+    def test_compressed_frame_without_deflate_closes_connection(self):
+        client = self.connect()
+        self.server.send_frame(zlib.compress(b"x")[2:-4], rsv1=True)
+
+        rc = self.run_until(client, lambda: self.disconnects)
+        self.assertNotEqual(rc, mqtt.MQTT_ERR_SUCCESS)
+        self.assertFalse(client.is_connected())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+# A WebSocket server stand-in for testing the websockets transport of
+# paho.mqtt.client without a broker. It accepts one connection, answers the
+# opening handshake, and then lets a test send and receive individual frames,
+# so that fragmentation, control frames and permessage-deflate can be driven
+# exactly.
+#
+# server = WebSocketStandIn(extensions="permessage-deflate")
+# client.connect("127.0.0.1", server.port)
+# server.wait_connected()
+# packet = server.read_packet()          # the CONNECT
+# server.send_message(b"\x20\x02\x00\x00")
+
+import base64
+import hashlib
+import socket
+import struct
+import threading
+import zlib
+
+GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_BINARY = 0x2
+OPCODE_CONNCLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+
+
+def publish_packet(topic, payload):
+    """Return a QoS 0 MQTT PUBLISH packet."""
+    topic = topic.encode('utf-8')
+    body = struct.pack('!H', len(topic)) + topic + payload
+    length = bytearray()
+    remaining = len(body)
+    while True:
+        byte = remaining % 128
+        remaining = remaining // 128
+        if remaining:
+            byte |= 0x80
+        length.append(byte)
+        if not remaining:
+            break
+    return b"\x30" + bytes(length) + body
+
+
+class WebSocketStandIn(object):
+    """Accept a single WebSocket connection on a free port of 127.0.0.1.
+
+    extensions is the Sec-WebSocket-Extensions value of the handshake
+    response, or None to accept no extension. If it starts with
+    permessage-deflate, compress() and read_packet() use its
+    server_no_context_takeover and client_no_context_takeover parameters."""
+    def __init__(self, extensions=None, timeout=5.0):
+        self.extensions = extensions
+        self.request = None
+        self._timeout = timeout
+        self._conn = None
+        self._buffer = bytearray()
+        self._connected = threading.Event()
+
+        params = []
+        if extensions:
+            params = [param.strip() for param in extensions.split(";")]
+        self._server_context_takeover = "server_no_context_takeover" not in params
+        self._client_context_takeover = "client_no_context_takeover" not in params
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-15)
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(1)
+        self.port = self._listener.getsockname()[1]
+
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        self._listener.settimeout(self._timeout)
+        conn = self._listener.accept()[0]
+        conn.settimeout(self._timeout)
+        self._conn = conn
+
+        request = self._recv_until(b"\r\n\r\n")
+        self.request = request
+        key = None
+        for line in request.split(b"\r\n")[1:]:
+            (name, _, value) = line.partition(b":")
+            if name.strip().lower() == b"sec-websocket-key":
+                key = value.strip()
+        accept = base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+        response = (b"HTTP/1.1 101 Switching Protocols\r\n"
+                    b"Upgrade: websocket\r\n"
+                    b"Connection: Upgrade\r\n"
+                    b"Sec-WebSocket-Accept: " + accept + b"\r\n"
+                    b"Sec-WebSocket-Protocol: mqtt\r\n")
+        if self.extensions:
+            response += b"Sec-WebSocket-Extensions: " + self.extensions.encode('ascii') + b"\r\n"
+        conn.sendall(response + b"\r\n")
+        self._connected.set()
+
+    def wait_connected(self):
+        """Wait for the handshake to complete."""
+        if not self._connected.wait(self._timeout):
+            raise AssertionError("no WebSocket connection")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._listener.close()
+
+    def _recv_until(self, marker):
+        while marker not in self._buffer:
+            self._recv()
+        end = self._buffer.index(marker) + len(marker)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    def _recv(self):
+        data = self._conn.recv(65536)
+        if not data:
+            raise EOFError("connection closed by the client")
+        self._buffer.extend(data)
+
+    def _recv_exactly(self, length):
+        while len(self._buffer) < length:
+            self._recv()
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def compress(self, data):
+        """Compress one message as the server would for permessage-deflate."""
+        if self._compressor is None or not self._server_context_takeover:
+            self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-4]
+
+    def send_frame(self, payload, opcode=OPCODE_BINARY, fin=True, rsv1=False):
+        """Send a single unmasked frame."""
+        first = opcode
+        if fin:
+            first |= 0x80
+        if rsv1:
+            first |= 0x40
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", first, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", first, 126, length)
+        else:
+            header = struct.pack("!BBQ", first, 127, length)
+        self._conn.sendall(header + payload)
+
+    def send_message(self, data, compress=False, fragments=1):
+        """Send data as one binary message, compressed if compress is True
+        and split into fragments frames of about equal size."""
+        if compress:
+            data = self.compress(data)
+        size = max(1, -(-len(data) // fragments))
+        for i in range(fragments):
+            opcode = OPCODE_BINARY if i == 0 else OPCODE_CONTINUATION
+            self.send_frame(data[i*size:(i+1)*size], opcode, i == fragments - 1, compress and i == 0)
+
+    def read_frame(self):
+        """Read one frame from the client and return (opcode, fin, rsv1,
+        payload), with the payload unmasked."""
+        (first, second) = struct.unpack("!BB", self._recv_exactly(2))
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack("!H", self._recv_exactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._recv_exactly(8))[0]
+        if not second & 0x80:
+            raise AssertionError("client frame is not masked")
+        mask = bytearray(self._recv_exactly(4))
+        payload = bytearray(self._recv_exactly(length))
+        for i in range(length):
+            payload[i] ^= mask[i % 4]
+        return (first & 0x0f, bool(first & 0x80), bool(first & 0x40), bytes(payload))
+
+    def read_message(self):
+        """Read one data message from the client, skipping control frames,
+        and return (compressed, data) with data decompressed."""
+        data = b""
+        compressed = None
+        while True:
+            (opcode, fin, rsv1, payload) = self.read_frame()
+            if opcode & 0x08:
+                continue
+            if compressed is None:
+                compressed = rsv1
+            data += payload
+            if fin:
+                break
+        if compressed:
+            if not self._client_context_takeover:
+                self._decompressor = zlib.decompressobj(-15)
+            data = self._decompressor.decompress(data + b"\x00\x00\xff\xff")
+        return (compressed, data)
+
+    def read_packet(self):
+        """Read one message from the client and return the MQTT data."""
+        return self.read_message()[1]